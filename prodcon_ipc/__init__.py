@@ -1,2 +1,11 @@
+import os
+import sys
+
+# The modules of this package import each other by their plain names (implicit relative imports of Python 2), so make
+# them importable in Python 3 as well:
+_directory = os.path.dirname(os.path.abspath(__file__))
+if _directory not in sys.path:
+    sys.path.insert(0, _directory)
+
 import producer_ipc
 import consumer_ipc
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+# Entry point of `python -m prodcon_ipc`, see `command_line`.
+
+import sys
+
+import command_line
+
+sys.exit(command_line.main())
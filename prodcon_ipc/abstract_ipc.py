@@ -3,15 +3,101 @@
 # Copyright (C) 2020 Adrian Böckenkamp
 # This code is licensed under the BSD 3-Clause license (see LICENSE for details).
 
+import errno
+import logging
 import logzero
-import PyQt5.QtCore
+import os
+import time
+import broadcast_ring
+import ipc_backend
+import ipc_log
+import ipc_stats
+import ring_buffer
+import segment_memory
+import spsc_ring
+import sysv_semaphore
+
+
+def load_key(path, log=True):
+    """
+    Alternatively loads the shared memory's name from a file named `SHARED_MEMORY_KEY_FILE`.
+
+    :param path: Path to file whose first name contains the unique name; the rest is ignored
+    :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+    :return: Unique name of shared memory or None if such a file did not exist
+    """
+    if path is None:
+        return None
+    # noinspection PyBroadException
+    try:
+        with open(path) as fp:
+            line = fp.readline().strip()
+            if fp.readline() and log:
+                logzero.logger.warn("Ignoring residual lines in " + path)
+            return line
+    except:
+        pass
+    return None
+
+
+PEER_CHECK_INTERVAL = 1.0  # seconds between checks of the other side while waiting (ring buffer mode only)
+
+
+def process_alive(pid):
+    """
+    Checks whether a process exists (on this host and in this PID namespace). Zombies, i.e., processes which have
+    exited but were not reaped by their parent yet, count as dead.
+
+    :param pid: Process ID
+    :return: `True` if the process is alive, `False` otherwise
+    """
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno != errno.EPERM:  # EPERM: it exists, but belongs to another user
+            return False
+    try:
+        with open("/proc/" + str(pid) + "/stat") as fp:
+            return fp.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (IOError, OSError, IndexError):
+        return True  # no procfs
+
+
+def heartbeat():
+    """
+    Returns the current heartbeat value, i.e., the seconds of the monotonic clock (see `ipc_stats.now()`, which is the
+    same for all processes on Linux) truncated to 32 bit.
+
+    :return: Heartbeat (int)
+    """
+    return (ipc_stats.now() // 1000000000) & 0xFFFFFFFF
+
+
+def lock(shared_memory):
+    """
+    Locks a shared memory segment system-wide (`QSharedMemory.lock()`) or raises.
+
+    :param shared_memory: `QSharedMemory` (or `SysVSharedMemory`) to lock
+    :except: `RuntimeError` if the segment cannot be locked
+    """
+    if not shared_memory.lock():
+        raise RuntimeError("Unable to lock the shared memory block: " + shared_memory.errorString())
+
+
+class TimeoutExpired(RuntimeError):
+    """
+    Raised by `begin()` if no transaction could be started within the given timeout (e.g. because the other side is
+    too slow or has died).
+    """
+    pass
 
 
 class AbstractIPC(object):
     """
     Encapsulates code that both the producer and the consumer requires.
     """
-    def __init__(self, id, key_file_path=None, log=True):
+    def __init__(self, id, key_file_path=None, log=True, slots=None, lock_free=False, broadcast=False, backend=None,
+                 hot_path=False):
         """
         Creates the underlying system resources.
 
@@ -21,37 +107,440 @@ class AbstractIPC(object):
         as the unique ID/name of the shared memory IF this file exists, can be empty (the default) which then uses `id`
         (first parameter)
         :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+        :param slots: Number of slots of the ring buffer inside the shared memory (see `ring_buffer`), `None` (the
+        default) stores exactly one item without any header (the original layout); must be equal in all processes
+        :param lock_free: `True` to use the lock-free single-producer/single-consumer ring instead (see `spsc_ring`,
+        requires `slots`); must be equal in all processes
+        :param broadcast: `True` to use the broadcast ring instead, i.e., every item is read by all consumers (see
+        `broadcast_ring`, requires `slots`); must be equal in all processes
+        :param backend: Name of the backend providing shared memory and semaphores (see `ipc_backend`), `None` (the
+        default) for Qt unless overridden by the environment variable `PRODCON_IPC_BACKEND`; processes may use different
+        backends
+        :param hot_path: `True` to disable the diagnostics of recurring events (see `ipc_log`) unless enabled on demand
+        by `enable_diagnostics()` or the environment variable `PRODCON_IPC_DIAGNOSTICS`, so transactions don't log
+        anything; `False` (the default) emits them (rate-limited) if `log` is `True`
         """
+        if (lock_free or broadcast) and not slots:
+            raise ValueError("The lock-free and the broadcast mode require slots.")
         self._log = log
         self._transaction_started = False
+        self._slots = slots
+        self._ring = None  # RingHeader of the attached segment (ring buffer mode only)
+        self._slot_memory = None  # QSharedMemory holding the slots of a generation > 0 (ring buffer mode only)
+        self._generation = 0  # generation of the slots we are attached to (ring buffer mode only)
+        self._lock_free = lock_free
+        self._spsc = None  # SpscRing of the attached segment (lock-free mode only)
+        self._id = str(id)
+        self._broadcast = broadcast
+        self._broadcast_ring = None  # BroadcastRing of the attached segment (broadcast mode only)
+        self._timed_semaphores = {}  # SysVSemaphore per key, used for waiting with a timeout
+        self._backend = ipc_backend.get(backend)
         if self._log:
-            logzero.logger.info("Using PyQt v" + PyQt5.QtCore.PYQT_VERSION_STR + " and Qt v" +
-                                PyQt5.QtCore.QT_VERSION_STR)
+            logzero.logger.info("Using " + self._backend.description)
 
         self._file_key = self._load_key(key_file_path)
-        self._shared_memory = PyQt5.QtCore.QSharedMemory(self._file_key if self._file_key else str(id))
+        self._shared_memory = self._backend.SharedMemory(self._file_key if self._file_key else str(id))
         if self._log:
             logzero.logger.debug("Creating shared memory with key=\"" + self._shared_memory.key() + "\" (" +
                                  ("loaded from file)" if self._file_key else "hardcoded)"))
-        self._sem_empty = PyQt5.QtCore.QSystemSemaphore(str(id) + "_sem_empty", 1, PyQt5.QtCore.QSystemSemaphore.Create)
-        self._sem_full = PyQt5.QtCore.QSystemSemaphore(str(id) + "_sem_full", 0, PyQt5.QtCore.QSystemSemaphore.Create)
+        # In lock-free and broadcast mode, the semaphores only wake up a sleeping side, they don't count the slots:
+        self._sem_empty = self._backend.SystemSemaphore(str(id) + "_sem_empty",
+                                                        0 if lock_free or broadcast else (slots if slots else 1),
+                                                        self._backend.SystemSemaphore.Create)
+        self._sem_full = self._backend.SystemSemaphore(str(id) + "_sem_full", 0, self._backend.SystemSemaphore.Create)
+        # Both semaphores count slots handed over between the processes, which Qt's operations (with SEM_UNDO) cannot
+        # do forever and a process exiting changes (see `sysv_semaphore.SysVSemaphore`), so operate on them without
+        # SEM_UNDO if possible. The objects above are kept since they own the semaphores.
+        self._owned_semaphores = (self._sem_empty, self._sem_full)
+        self._recover = sysv_semaphore.is_supported()
+        if self._recover:
+            self._sem_empty = sysv_semaphore.SysVSemaphore(self._sem_empty.key(), 0, sysv_semaphore.SysVSemaphore.Open,
+                                                           undo=False)
+            self._sem_full = sysv_semaphore.SysVSemaphore(self._sem_full.key(), 0, sysv_semaphore.SysVSemaphore.Open,
+                                                          undo=False)
+        # Liveness of the other side (ring buffer mode only), set by the subclasses:
+        self._role = None  # "producer" or "consumer"
+        self._peer_timeout = None
+        self._pid = os.getpid()
+        self._beat = 0  # last heartbeat written to the header
+        self._deadline = None  # end of the current wait, see `_acquire_ring()`
+        # Bound directly unless the instrumentation is enabled (see `_enable_stats()`), so it costs nothing otherwise:
+        self._stats = None
+        self._lock_segment = self._shared_memory.lock
+        self._unlock = self._shared_memory.unlock
+        self._locked_at = 0
+        # Diagnostics of recurring events (see `ipc_log`), `None` if disabled so the checks cost nothing:
+        self._diagnostics = None
+        if (log and not hot_path) or ipc_log.requested():
+            self.enable_diagnostics()
+        self._slot_layout = None  # cached by `_slot_view()`
+        # Placement of the pages (see `segment_memory`), set by the subclasses:
+        self._huge_pages = None
+        self._prefault = False
+        self._numa_node = None
+
+    def _enable_stats(self, stats, role):
+        """
+        Enables the instrumentation of the transactions (see `ipc_stats`).
+
+        :param stats: `True` to export snapshots to `ipc_stats.stats_key()`, a `str` to export them to this key
+        :param role: "producer" or "consumer"
+        """
+        key = ipc_stats.stats_key(self._shared_memory.key(), role) if stats is True else str(stats)
+        self._stats = ipc_stats.Stats(role, key, self._log, self._backend.name)
+        self._lock_segment = self._timed_lock
+        self._unlock = self._timed_unlock
+
+    def stats(self):
+        """
+        Returns a snapshot of the statistics collected so far (see `ipc_stats.Stats.snapshot()`).
+
+        :return: `dict` or `None` if the instrumentation is not enabled (see the `stats` parameter of the constructor)
+        """
+        return self._stats.snapshot() if self._stats is not None else None
+
+    def enable_diagnostics(self, enabled=True, sink=None, interval=ipc_log.DEFAULT_INTERVAL,
+                           burst=ipc_log.DEFAULT_BURST):
+        """
+        Enables (or disables) the diagnostics of recurring events, e.g. in hot path mode (see `ipc_log`).
+
+        :param enabled: `True` to enable them, `False` to disable them
+        :param sink: Callable getting the events as `dict`s, `None` (the default) to log them using `logzero.logger`
+        :param interval: Length of the rate limiting interval in seconds
+        :param burst: Maximum number of events of the same name per interval
+        """
+        self._diagnostics = (ipc_log.Diagnostics(self._shared_memory.key(), sink, interval, burst) if enabled else
+                             None)
+
+    def _lock(self):
+        """
+        Locks the shared memory segment system-wide (see `lock()`), timed if the instrumentation is enabled. A failure
+        is also reported to the diagnostics since it may recur for every transaction.
+
+        :except: `RuntimeError` if the segment cannot be locked
+        """
+        if not self._lock_segment():
+            if self._diagnostics is not None:
+                self._diagnostics.event("lock", logging.ERROR, "Unable to lock the shared memory block",
+                                        error=self._shared_memory.errorString())
+            raise RuntimeError("Unable to lock the shared memory block: " + self._shared_memory.errorString())
+
+    def _timed_lock(self):
+        if not self._shared_memory.lock():
+            return False
+        self._locked_at = ipc_stats.now()
+        return True
+
+    def _timed_unlock(self):
+        self._stats.add_lock(ipc_stats.now() - self._locked_at)
+        return self._shared_memory.unlock()
+
+    def _place_pages(self, shared_memory, created):
+        """
+        Applies the placement of the pages (see `segment_memory`) to a segment right after creating or attaching it:
+        transparent huge pages and the NUMA node first (only effective before the pages are touched), then
+        prefaulting.
+
+        :param shared_memory: Attached `QSharedMemory`
+        :param created: `True` if this process has just created the segment, `False` if it has attached to it
+        :except: `RuntimeError` if the placement is not supported
+        """
+        if created and self._huge_pages == segment_memory.THP:
+            segment_memory.advise_huge_pages(shared_memory)
+        if created and self._numa_node is not None:
+            segment_memory.bind(shared_memory, self._numa_node)
+        if self._prefault:
+            segment_memory.prefault(shared_memory, created)
 
     def _load_key(self, path):
         """
-        Alternatively loads the shared memory's name from a file named `SHARED_MEMORY_KEY_FILE`.
+        Alternatively loads the shared memory's name from a file named `SHARED_MEMORY_KEY_FILE`, see `load_key()`.
+        """
+        return load_key(path, self._log)
 
-        :param path: Path to file whose first name contains the unique name; the rest is ignored
-        :return: Unique name of shared memory or None if such a file did not exist
+    def _acquire(self, semaphore, timeout=None):
         """
-        if path is None:
-            return None
-        # noinspection PyBroadException
+        Acquires a system semaphore, optionally waiting at most `timeout` seconds.
+
+        :param semaphore: `QSystemSemaphore` (or `SysVSemaphore`) to acquire
+        :param timeout: Maximum time to wait in seconds (0 to not wait at all), `None` to wait forever
+        :return: `True` if acquired, `False` if the timeout expired
+        :except: `RuntimeError` if the semaphore cannot be acquired or timeouts are not supported on this platform
+        """
+        if self._stats is None:
+            return self._acquire_semaphore(semaphore, timeout)
+        start = ipc_stats.now()
         try:
-            with open(path) as fp:
-                line = fp.readline().strip()
-                if fp.readline() and self._log:
-                    logzero.logger.warn("Ignoring residual lines in " + path)
-                return line
-        except:
-            pass
-        return None
+            return self._acquire_semaphore(semaphore, timeout)
+        finally:
+            self._stats.add_wait(ipc_stats.now() - start)
+
+    def _acquire_semaphore(self, semaphore, timeout):
+        if timeout is None:
+            if not semaphore.acquire():
+                raise RuntimeError("Unable to acquire system semaphore (" + semaphore.key() + "): " +
+                                   semaphore.errorString())
+            return True
+        # QSystemSemaphore cannot time out, so operate on the System V semaphore behind it:
+        timed_semaphore = self._sysv_semaphore(semaphore)
+        if timed_semaphore.acquire(timeout):
+            return True
+        if timed_semaphore.errorString():
+            raise RuntimeError("Unable to acquire system semaphore (" + semaphore.key() + "): " +
+                               timed_semaphore.errorString())
+        return False
+
+    def _sysv_semaphore(self, semaphore):
+        """
+        Returns the System V semaphore behind a `QSystemSemaphore` (or the semaphore itself if it is one already).
+
+        :except: `RuntimeError` if not supported on this platform
+        """
+        if isinstance(semaphore, sysv_semaphore.SysVSemaphore):
+            return semaphore
+        timed_semaphore = self._timed_semaphores.get(semaphore.key())
+        if timed_semaphore is None:
+            if not sysv_semaphore.is_supported():
+                raise RuntimeError("Waiting for a system semaphore with a timeout is not supported on this platform.")
+            timed_semaphore = sysv_semaphore.SysVSemaphore(semaphore.key())
+            self._timed_semaphores[semaphore.key()] = timed_semaphore
+        return timed_semaphore
+
+    def _acquire_ring(self, semaphore, timeout):
+        """
+        Acquires `_sem_empty` (producer) or `_sem_full` (consumer) in ring buffer mode like `_acquire()`, but checks the
+        other side every `PEER_CHECK_INTERVAL` seconds while waiting (see `_check_ring()`). Call this without holding a
+        permit of `semaphore`.
+
+        :return: `True` if acquired, `False` if the timeout expired
+        """
+        self._deadline = None if timeout is None else time.time() + timeout
+        if not self._recover or self._ring is None:
+            return self._acquire(semaphore, timeout)
+        if self._stats is None and semaphore.try_acquire():
+            return True  # fast path: nothing to wait for
+        while True:
+            remaining = self._remaining()
+            if self._acquire(semaphore, PEER_CHECK_INTERVAL if remaining is None else
+                             min(remaining, PEER_CHECK_INTERVAL)):
+                return True
+            self._check_ring(semaphore)
+            if remaining is not None and remaining <= PEER_CHECK_INTERVAL:
+                return self._acquire(semaphore, 0)  # once more since _check_ring() may have fixed the semaphore
+
+    def _remaining(self):
+        """
+        Returns the time left until `_deadline` in seconds, `None` if there is none.
+        """
+        return None if self._deadline is None else max(0.0, self._deadline - time.time())
+
+    def _check_ring(self, semaphore):
+        """
+        Checks the ring buffer while waiting for `semaphore` (without holding a permit of it), i.e., recovers if the
+        other side has died (see `_peer_died()`) and resynchronizes `semaphore` with the indices if it has fewer permits
+        than free (producer) or full (consumer) slots, e.g. because a process exited or was killed while operating on
+        it. Also updates our heartbeat.
+
+        :except: `RuntimeError` if the shared memory cannot be locked
+        """
+        self._lock()
+        try:
+            self._heartbeat()
+            role = self._peer_role()
+            pid = self._ring.pid(role)
+            if pid and not self._peer_alive(pid, self._ring.heartbeat(role)):
+                self._ring.set_owner(role, 0, 0)
+                self._peer_died(pid)
+            self._resync(semaphore, self._permits())
+        finally:
+            self._unlock()
+
+    def _peer_role(self):
+        return "consumer" if self._role == "producer" else "producer"
+
+    def _peer_alive(self, pid, beat):
+        """
+        Checks whether the other side is alive given its process ID and heartbeat.
+        """
+        if not process_alive(pid):
+            return False
+        if self._peer_timeout is None or not beat:
+            return True
+        return (heartbeat() - beat) & 0xFFFFFFFF <= self._peer_timeout
+
+    def peer_alive(self):
+        """
+        Checks whether the other side (the producer for a consumer and vice versa) is alive according to the process ID
+        and heartbeat it has recorded in the ring buffer header (ring buffer mode only). The process must run on the
+        same host (in the same PID namespace).
+
+        :return: `True` if it is alive, `False` if it has died (or has not shown a heartbeat within the `peer_timeout`
+        passed to the constructor), `None` if unknown (e.g. it has not started yet or has exited)
+        :except: `RuntimeError` if the shared memory cannot be locked
+        """
+        if self._ring is None:
+            return None
+        self._lock()
+        role = self._peer_role()
+        pid, beat = self._ring.pid(role), self._ring.heartbeat(role)
+        self._unlock()
+        return self._peer_alive(pid, beat) if pid else None
+
+    def _heartbeat(self):
+        """
+        Records our process ID and heartbeat in the ring buffer header (at most once per second). Lock the shared
+        memory before calling this.
+        """
+        beat = heartbeat()
+        if beat != self._beat:
+            self._ring.set_owner(self._role, self._pid, beat)
+            self._beat = beat
+
+    def _resync(self, semaphore, permits):
+        """
+        Sets `semaphore` to `permits` if it differs (only possible if `_recover` is `True`). Lock the shared memory
+        before calling this.
+
+        :except: `RuntimeError` if the semaphore cannot be set
+        """
+        if not self._recover:
+            return
+        semaphore = self._sysv_semaphore(semaphore)
+        value = semaphore.value()
+        if value == permits:
+            return
+        if not semaphore.set_value(permits):
+            raise RuntimeError("Unable to set system semaphore (" + semaphore.key() + "): " + semaphore.errorString())
+        if self._diagnostics is not None:
+            self._diagnostics.event("resync", logging.WARNING, "Resynchronized system semaphore with the ring buffer",
+                                    semaphore=semaphore.key(), permits_before=value, permits=permits)
+
+    def _permits(self):
+        """
+        Returns the number of permits the semaphore we acquire in ring buffer mode must have according to the indices
+        if we don't hold any (implemented by the subclasses).
+        """
+        raise NotImplementedError()
+
+    def _peer_died(self, pid):
+        """
+        Called by `_check_ring()` (holding the lock) once the other side has died (implemented by the subclasses).
+
+        :param pid: Process ID of the other side
+        """
+        raise NotImplementedError()
+
+    def _attach_ring(self):
+        """
+        Attaches to the shared memory (if not done yet) and maps the ring buffer header. In ring buffer mode, the
+        segment stays attached until this object is deleted.
+
+        :return: `True` on success, `False` if the producer has not created the segment yet
+        :except: `RuntimeError` if the segment cannot be attached or doesn't contain a valid ring buffer
+        """
+        if not self._shared_memory.isAttached():
+            if not self._shared_memory.attach():
+                if self._shared_memory.error() == self._backend.SharedMemory.NotFound:
+                    return False
+                raise RuntimeError("Unable to attach to shared memory segment: " + self._shared_memory.errorString())
+            self._place_pages(self._shared_memory, False)
+        ring = ring_buffer.RingHeader(memoryview(self._shared_memory.data()))
+        if not ring.is_valid() or ring.slot_count != self._slots:
+            self._shared_memory.detach()
+            raise RuntimeError("Shared memory segment does not contain a ring buffer with " + str(self._slots) +
+                               " slots.")
+        self._ring = ring
+        return True
+
+    def _attach_spsc(self):
+        """
+        Attaches to the shared memory (if not done yet) and maps the lock-free ring. The segment stays attached until
+        this object is deleted.
+
+        :return: `True` on success, `False` if the producer has not created the segment yet
+        :except: `RuntimeError` if the segment cannot be attached or doesn't contain a valid lock-free ring
+        """
+        if not self._shared_memory.isAttached():
+            if not self._shared_memory.attach():
+                if self._shared_memory.error() == self._backend.SharedMemory.NotFound:
+                    return False
+                raise RuntimeError("Unable to attach to shared memory segment: " + self._shared_memory.errorString())
+            self._place_pages(self._shared_memory, False)
+        # The producer initializes the header while holding the lock:
+        self._lock()
+        spsc = spsc_ring.SpscRing(memoryview(self._shared_memory.data()))
+        self._unlock()
+        if not spsc.is_valid() or spsc.slot_count != self._slots:
+            self._shared_memory.detach()
+            raise RuntimeError("Shared memory segment does not contain a lock-free ring with " + str(self._slots) +
+                               " slots.")
+        self._spsc = spsc
+        return True
+
+    def _attach_broadcast(self):
+        """
+        Attaches to the shared memory (if not done yet) and maps the broadcast ring. The segment stays attached until
+        this object is deleted.
+
+        :return: `True` on success, `False` if the producer has not created the segment yet
+        :except: `RuntimeError` if the segment cannot be attached or doesn't contain a valid broadcast ring
+        """
+        if not self._shared_memory.isAttached():
+            if not self._shared_memory.attach():
+                if self._shared_memory.error() == self._backend.SharedMemory.NotFound:
+                    return False
+                raise RuntimeError("Unable to attach to shared memory segment: " + self._shared_memory.errorString())
+            self._place_pages(self._shared_memory, False)
+        self._lock()
+        ring = broadcast_ring.BroadcastRing(memoryview(self._shared_memory.data()))
+        self._unlock()
+        if not ring.is_valid() or ring.slot_count != self._slots:
+            self._shared_memory.detach()
+            raise RuntimeError("Shared memory segment does not contain a broadcast ring with " + str(self._slots) +
+                               " slots.")
+        self._broadcast_ring = ring
+        return True
+
+    def _attach_slots(self):
+        """
+        Attaches to the segment holding the slots of the current generation if the producer reallocated them since
+        the last call. Lock the shared memory before calling this.
+
+        :except: `RuntimeError` if the segment cannot be attached
+        """
+        generation = self._ring.generation
+        if generation == self._generation:
+            return
+        slot_memory = None
+        if generation:
+            slot_memory = self._backend.SharedMemory(ring_buffer.slot_key(self._shared_memory.key(), generation))
+            if not slot_memory.attach():
+                raise RuntimeError("Unable to attach to shared memory segment: " + slot_memory.errorString())
+            self._place_pages(slot_memory, False)
+        if self._slot_memory is not None:
+            self._slot_memory.detach()
+        self._slot_memory = slot_memory
+        self._generation = generation
+        if self._diagnostics is not None:
+            self._diagnostics.event("attach_slots", logging.DEBUG, "Attached to reallocated slots",
+                                    generation=generation)
+
+    def _slot_view(self, index, size, writable):
+        """
+        Returns the memory of a slot of the current generation.
+
+        :param index: Slot index (not the sequence number)
+        :param size: Number of bytes to return
+        :param writable: `True` for a writable view, `False` for a read-only one
+        :return: `memoryview` of `size` bytes
+        """
+        layout = self._slot_layout
+        if layout is None or layout[0] is not self._ring or layout[1] != self._generation:
+            # Only changes if the ring or its slots have been reattached or reallocated:
+            memory = self._slot_memory if self._slot_memory is not None else self._shared_memory
+            layout = (self._ring, self._generation, self._ring.slot_offset(0),
+                      ring_buffer.align(self._ring.slot_size), memoryview(memory.data()),
+                      memoryview(memory.constData()))
+            self._slot_layout = layout
+        offset = layout[2] + index * layout[3]
+        return (layout[4] if writable else layout[5])[offset:offset + size]
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import struct
+
+# Layout of an array stored in shared memory (the data of one item):
+#
+#   [magic, dtype, ndim][shape (ndim * int64)][strides (ndim * int64)][padding][array data]
+#
+# All header values are stored in little endian order, `dtype` is numpy's `dtype.str` (e.g. "|u1" or "<f4"). The
+# array data starts at a multiple of `ALIGNMENT` bytes (relative to the beginning of the item).
+MAGIC = b"PCND"
+ALIGNMENT = 64
+HEADER_FORMAT = "<4s8sI"  # magic, dtype, ndim
+
+_HEADER = struct.Struct(HEADER_FORMAT)
+
+
+def header_size(ndim):
+    """
+    Returns the number of bytes of the header (incl. padding) preceding the array data.
+
+    :param ndim: Number of dimensions
+    :return: Size in bytes
+    """
+    size = _HEADER.size + 2 * 8 * ndim
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def required_size(shape, dtype):
+    """
+    Returns the number of bytes needed to store a C-contiguous array incl. its header, i.e., what to pass to
+    `ScopedProducer` (or `ProducerIPC.begin()`).
+
+    :param shape: Shape of the array (tuple of ints)
+    :param dtype: Anything `numpy.dtype()` accepts
+    :return: Size in bytes
+    """
+    import numpy
+    return header_size(len(shape)) + int(numpy.prod(shape, dtype=numpy.int64)) * numpy.dtype(dtype).itemsize
+
+
+def write(buf, shape, dtype, strides=None):
+    """
+    Writes the header into `buf` and returns a writable array over the memory following it.
+
+    :param buf: Writable buffer (e.g. `memoryview`) of the item, at least `required_size()` bytes
+    :param shape: Shape of the array (tuple of ints)
+    :param dtype: Anything `numpy.dtype()` accepts
+    :param strides: Strides in bytes, `None` for C-contiguous
+    :return: `numpy.ndarray` viewing the shared memory (no copy)
+    :except: `ValueError` if `buf` is too small
+    """
+    import numpy
+    dtype = numpy.dtype(dtype)
+    ndim = len(shape)
+    if strides is None:
+        strides = _c_strides(shape, dtype.itemsize)
+    offset = header_size(ndim)
+    _HEADER.pack_into(buf, 0, MAGIC, dtype.str.encode("ascii"), ndim)
+    struct.pack_into("<" + "q" * (2 * ndim), buf, _HEADER.size, *(tuple(shape) + tuple(strides)))
+    return numpy.ndarray(shape, dtype, buffer=buf, offset=offset, strides=strides)
+
+
+def read(buf):
+    """
+    Returns an array over the memory of an item written by `write()`.
+
+    :param buf: Buffer (e.g. `memoryview`) of the item; the array is read-only if `buf` is
+    :return: `numpy.ndarray` viewing the shared memory (no copy)
+    :except: `ValueError` if `buf` does not contain an array header
+    """
+    import numpy
+    if len(buf) < _HEADER.size:
+        raise ValueError("Shared memory is too small to contain an array.")
+    magic, dtype, ndim = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Shared memory does not contain an array.")
+    values = struct.unpack_from("<" + "q" * (2 * ndim), buf, _HEADER.size)
+    return numpy.ndarray(values[:ndim], numpy.dtype(dtype.rstrip(b"\0").decode("ascii")), buffer=buf,
+                         offset=header_size(ndim), strides=values[ndim:])
+
+
+def _c_strides(shape, itemsize):
+    strides = []
+    stride = itemsize
+    for dim in reversed(shape):
+        strides.insert(0, stride)
+        stride *= dim
+    return tuple(strides)
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import threading
+
+import abstract_ipc
+import consumer_ipc
+import logzero
+import PyQt5.QtCore
+import sysv_semaphore
+
+
+class AsyncConsumerIPC(consumer_ipc.ConsumerIPC, PyQt5.QtCore.QObject):
+    """
+    Non-blocking variant of `ConsumerIPC`, the Python counterpart of the C++ `ConsumerIPC`.
+
+    A background thread waits for the producer and emits the signal `available` once data was produced and put into
+    the shared memory. Once triggered, use `begin()` ... `end()` (or `ScopedConsumer`) to access the data; `begin()`
+    never blocks. Alternatively, iterate over the produced items with `async for item in consumer` (Python >= 3.5),
+    each item is a copy (`bytes`) of the data in the shared memory.
+
+    Call `close()` to terminate the background thread.
+    """
+    available = PyQt5.QtCore.pyqtSignal()
+
+    def __init__(self, id, key_file_path=None, log=True, slots=None, lock_free=False, broadcast=None, stats=False,
+                 backend=None, prefault=False, encoded=False, peer_timeout=None, hot_path=False, parent=None):
+        """
+        Creates the shared memory reference and the internal semaphores and starts the background thread.
+
+        :param id: Unique system-wide unique name (str) of shared memory; this name is also used to create the unique
+        names for the two system-semapores `$id + "_sem_full"` and `$id + "_sem_empty"`
+        :param key_file_path: Optional file path to a file typically named "shared_memory.key" whose first line is used
+        as the unique ID/name of the shared memory IF this file exists, can be empty (the default) which then uses `id`
+        (first parameter)
+        :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+        :param slots: Number of slots of the ring buffer, must match the producer's value (`None` if the producer does
+        not use the ring buffer mode)
+        :param lock_free: `True` to use the lock-free single-producer/single-consumer ring, must match the producer's
+        value
+        :param broadcast: Not supported yet, must be `None`
+        :param stats: See `ConsumerIPC`
+        :param backend: See `ConsumerIPC`
+        :param prefault: See `ConsumerIPC`
+        :param encoded: See `ConsumerIPC`
+        :param peer_timeout: See `ConsumerIPC`
+        :param hot_path: See `ConsumerIPC`
+        :param parent: Parent `QObject`
+        """
+        if broadcast is not None:
+            raise ValueError("AsyncConsumerIPC does not support the broadcast mode yet.")
+        PyQt5.QtCore.QObject.__init__(self, parent)
+        consumer_ipc.ConsumerIPC.__init__(self, id, key_file_path, log, slots, lock_free, stats=stats, backend=backend,
+                                          prefault=prefault, encoded=encoded, peer_timeout=peer_timeout,
+                                          hot_path=hot_path)
+        self._terminate = False
+        # PyQt keeps the GIL while QSystemSemaphore.acquire() blocks, so wait on the underlying semaphore if possible
+        # (the semaphores of the Qt-free backend release it anyway):
+        self._sem_full_waiter = self._sem_full
+        if not isinstance(self._sem_full, sysv_semaphore.SysVSemaphore) and sysv_semaphore.is_supported():
+            try:
+                self._sem_full_waiter = sysv_semaphore.SysVSemaphore(self._sem_full.key())
+            except RuntimeError as err:
+                if self._log:
+                    logzero.logger.warn(str(err) + ", waiting will block other Python threads.")
+        self._data_acquired = threading.Semaphore(0)  # number of items received but not consumed yet
+        self._thread = threading.Thread(target=self._update_thread, name="AsyncConsumerIPC")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __del__(self):
+        if hasattr(self, "_thread"):
+            self.close()
+
+    def close(self):
+        """
+        Terminates the background thread and waits for its termination. Pending `async for` loops stop.
+        """
+        if self._terminate:
+            return
+        if self._log:
+            logzero.logger.debug("Requesting update thread to terminate...")
+        self._terminate = True
+        self._sem_full.release()  # fakes data to unblock the thread
+        self._thread.join()
+        self._data_acquired.release()  # wakes up `async for` loops
+        if self._log:
+            logzero.logger.debug("Update thread has terminated successfully.")
+
+    def _update_thread(self):
+        """
+        Thread function to wait for an updated shared memory block.
+        """
+        if self._lock_free:
+            return self._update_thread_lock_free()
+        while not self._terminate:
+            # Passively wait until a data is ready:
+            if not self._sem_full_waiter.acquire():
+                if self._log:
+                    logzero.logger.error("Unable to acquire system semaphore (_sem_full): " +
+                                         self._sem_full_waiter.errorString())
+                continue
+            if self._terminate:
+                break
+            self._data_acquired.release()
+            # Signal the GUI thread (queued, since we are not in the receiver's thread):
+            self.available.emit()
+
+    def _update_thread_lock_free(self):
+        """
+        Thread function to wait for new items in lock-free mode, i.e., until the head passes the last announced item.
+        """
+        acquire = lambda timeout: self._sem_full_waiter.acquire()  # woken up by close() as well
+        announced = 0  # sequence number of the next item to announce
+        while not self._terminate:
+            if self._spsc is None:
+                # The producer releases _sem_full once the segment has been created:
+                try:
+                    attached = self._attach_spsc()
+                except RuntimeError as err:
+                    if self._log:
+                        logzero.logger.error(str(err))
+                    attached = False
+                if not attached:
+                    acquire(None)
+                    continue
+                announced = self._spsc.tail
+            spsc = self._spsc
+            spsc.wait_for_data(lambda: self._terminate or spsc.head > announced, acquire)
+            if self._terminate:
+                break
+            head = spsc.head
+            while announced < head:
+                announced += 1
+                self._data_acquired.release()
+                self.available.emit()
+
+    def begin(self, timeout=None):
+        """
+        Starts reading from the shared memory. Call this only after `available` was emitted, it does not block.
+
+        :param timeout: Maximum time to wait for the background thread in seconds, `None` (the default) to not wait at
+        all (the data must have been acquired already)
+        :return: Data in shared memory (in ring buffer mode: a read-only `memoryview` of the next item)
+        :except: `RuntimeError` if no data was acquired yet or the shared memory cannot be accessed,
+        `abstract_ipc.TimeoutExpired` if `timeout` is given and no data was acquired within it
+        """
+        if self._transaction_started:
+            raise RuntimeError("You must call end() first, cannot start a another transaction.")
+        if timeout is not None:
+            if not self._data_acquired.acquire(True, timeout):
+                raise abstract_ipc.TimeoutExpired("No data was produced within " + str(timeout) + " seconds.")
+            return self._begin_acquired()
+        # Ensure that the thread was really signaled, otherwise end() would release _sem_empty for nothing:
+        if not self._data_acquired.acquire(False):
+            raise RuntimeError("Data was not acquired yet. Wait until the signal available() is emitted and call this "
+                               "method in a slot upon being notified.")
+        return self._begin_acquired()
+
+    def _acquire_full(self, timeout):
+        # The background thread has acquired _sem_full already:
+        if timeout is None:
+            return self._data_acquired.acquire()
+        return self._data_acquired.acquire(True, timeout)
+
+    def _next_item(self):
+        """
+        Blocks until an item was produced and returns a copy of it (executed in a worker thread of the event loop).
+        """
+        self._data_acquired.acquire()
+        if self._terminate:
+            self._data_acquired.release()  # wake up the next waiter as well
+            raise StopAsyncIteration
+        data = self._begin_acquired()
+        try:
+            return bytes(memoryview(data))
+        finally:
+            self.end()
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        import asyncio
+        return asyncio.get_event_loop().run_in_executor(None, self._next_item)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import struct
+
+# Layout of a batch of records stored as one item in shared memory (see `ProducerIPC.put_many()`):
+#
+#   [magic, count][length 0][record 0][length 1][record 1]...
+#
+# All values are stored in little endian order, records are not padded.
+MAGIC = b"PCBT"
+HEADER_FORMAT = "<4sI"  # magic, number of records
+LENGTH_FORMAT = "<I"
+
+_HEADER = struct.Struct(HEADER_FORMAT)
+_LENGTH = struct.Struct(LENGTH_FORMAT)
+
+
+def packed_size(records):
+    """
+    Returns the number of bytes needed to store the records as one batch.
+
+    :param records: Sequence of bytes-like objects
+    :return: Size in bytes
+    """
+    return _HEADER.size + sum(_LENGTH.size + memoryview(record).nbytes for record in records)
+
+
+def pack_into(buf, records):
+    """
+    Stores the records as one batch into `buf`.
+
+    :param buf: Writable buffer (e.g. `memoryview`) of at least `packed_size(records)` bytes
+    :param records: Sequence of bytes-like objects
+    """
+    buf = memoryview(buf)
+    _HEADER.pack_into(buf, 0, MAGIC, len(records))
+    offset = _HEADER.size
+    for record in records:
+        record = memoryview(record).cast("B") if hasattr(memoryview, "cast") else memoryview(record)
+        _LENGTH.pack_into(buf, offset, len(record))
+        offset += _LENGTH.size
+        buf[offset:offset + len(record)] = record
+        offset += len(record)
+
+
+def unpack(buf):
+    """
+    Splits a batch into its records without copying them.
+
+    :param buf: Buffer (e.g. `memoryview`) of the batch, as written by `pack_into()`
+    :return: List of `memoryview`s, one per record (only valid as long as `buf` is)
+    :except: `ValueError` if `buf` does not contain a batch
+    """
+    buf = memoryview(buf)
+    magic, count = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise ValueError("Shared memory does not contain a batch of records.")
+    records = []
+    offset = _HEADER.size
+    for _ in range(count):
+        length = _LENGTH.unpack_from(buf, offset)[0]
+        offset += _LENGTH.size
+        records.append(buf[offset:offset + length])
+        offset += length
+    return records
@@ -0,0 +1,309 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+# Headless throughput and latency benchmark of `ProducerIPC`/`ConsumerIPC`: for every combination of mode, slot count
+# and payload size, a consumer and a producer process exchange messages for a fixed duration. The results are printed
+# as JSON (one object with a list of cases), e.g.:
+#
+#   python prodcon_ipc/benchmark.py --sizes 64,4K,1M --slots 1,4 --duration 2 > results.json
+#
+# Every message starts with the producer's timestamp (see `ipc_stats.now()`) and a sequence number, so the consumer
+# measures the end-to-end latency (from the producer's `begin()` to the consumer's `end()`) and detects lost,
+# duplicated or reordered messages (`errors`). The consumer copies every message out of the shared memory.
+#
+# Both processes also report their page faults (see `getrusage()`) while exchanging the measured messages and while
+# setting up (creating/attaching the segment and the first message), e.g. to compare the placement of the pages:
+#
+#   python prodcon_ipc/benchmark.py --sizes 16M --slots 4 --backend sysv --huge-pages hugetlb --prefault
+#
+# `--overhead N` measures the time the Python wrappers need per transaction instead: producer and consumer run in one
+# process and alternate (so nobody waits) for N transactions, with the default settings (`log=True`) and in hot path
+# mode (`hot_path=True`, see `ipc_log`), e.g.:
+#
+#   python prodcon_ipc/benchmark.py --overhead 100000 --slots 4 --backend sysv
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import struct
+import sys
+import time
+
+import ipc_backend
+import ipc_stats
+import segment_memory
+
+DEFAULT_SIZES = "64,256,1K,4K,16K,64K,256K,1M,4M,16M,64M"
+DEFAULT_SLOTS = "1,4,16"
+DEFAULT_MODES = "ring,lock-free"
+MODES = ("ring", "lock-free")
+
+_MESSAGE = struct.Struct("<QQ")  # timestamp, sequence number
+_END = 2 ** 64 - 1  # sequence number of the message telling the consumer to stop
+_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(text):
+    """
+    Parses a size like "64", "4K" or "16M" (powers of 1024).
+
+    :param text: Size with an optional unit
+    :return: Size in bytes
+    :except: `ValueError` if `text` is invalid
+    """
+    text = text.strip().upper().rstrip("B")
+    unit = text[-1:] if text[-1:] in _UNITS else ""
+    return int(text[:len(text) - len(unit)]) * _UNITS[unit]
+
+
+def _ipc_args(case):
+    """
+    Returns the keyword arguments of `ProducerIPC`/`ConsumerIPC` for a case.
+    """
+    return {"log": False, "slots": case["slots"], "lock_free": case["mode"] == "lock-free", "backend": case["backend"],
+            "prefault": case["prefault"]}
+
+
+def _faults():
+    """
+    Returns the number of (minor, major) page faults of this process so far.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_minflt, usage.ru_majflt
+
+
+def _fault_counts(start, setup, end):
+    """
+    Returns the page faults while setting up (`start` to `setup`) and while exchanging the measured messages (`setup`
+    to `end`), each given by `_faults()`.
+    """
+    return {"setup": {"minor": setup[0] - start[0], "major": setup[1] - start[1]},
+            "transfer": {"minor": end[0] - setup[0], "major": end[1] - setup[1]}}
+
+
+def _consume(case, ready, finished, results):
+    import consumer_ipc
+
+    consumer = consumer_ipc.ConsumerIPC(case["key"], **_ipc_args(case))
+    # Copy through a memoryview (assigning to a slice of a bytearray copies the source first) into pages faulted in
+    # beforehand:
+    buffer = memoryview(bytearray(case["size"]))
+    buffer[::4096] = bytearray(len(buffer[::4096]))
+    latency = ipc_stats.Histogram()
+    messages = errors = 0
+    expected = 0
+    start = None
+    faults = setup_faults = _faults()
+    ready.set()
+    try:
+        while True:
+            data = memoryview(consumer.begin(case["timeout"]))
+            buffer[:len(data)] = data
+            consumer.end()
+            timestamp, sequence = _MESSAGE.unpack_from(buffer, 0)
+            if sequence == _END:
+                break
+            latency.add(ipc_stats.now() - timestamp)
+            if start is None:
+                start = time.time()  # the first message only starts the clock (attaching etc. is not measured)
+                setup_faults = _faults()
+            if sequence != expected:
+                errors += 1
+            expected = sequence + 1
+            messages += 1
+        elapsed = time.time() - start if start is not None else 0.0
+        measured = max(messages - 1, 0)
+        results.put({"messages": messages, "errors": errors, "elapsed": elapsed,
+                     "msgs_per_second": measured / elapsed if elapsed > 0 else 0.0,
+                     "gb_per_second": measured * case["size"] / elapsed / 1e9 if elapsed > 0 else 0.0,
+                     "latency_us": latency.summary(),
+                     "consumer_faults": _fault_counts(faults, setup_faults, _faults())})
+    except RuntimeError as e:
+        results.put({"error": "consumer: " + str(e)})
+    finished.set()
+
+
+def _produce(case, finished, results):
+    import producer_ipc
+
+    producer = producer_ipc.ProducerIPC(case["key"], slot_size=case["size"], grow=False,
+                                        huge_pages=case["huge_pages"], numa_node=case["numa_node"], **_ipc_args(case))
+    payload = os.urandom(case["size"])
+    sequence = 0
+    faults = setup_faults = _faults()
+    deadline = time.time() + case["duration"]
+    try:
+        while True:
+            size, data = producer.begin(case["size"], case["timeout"])
+            view = memoryview(data)[:size]
+            view[:] = payload[:size]
+            done = time.time() >= deadline
+            _MESSAGE.pack_into(view, 0, ipc_stats.now(), _END if done else sequence)
+            producer.end()
+            if done:
+                break
+            if not sequence:
+                setup_faults = _faults()
+            sequence += 1
+        results.put({"producer_faults": _fault_counts(faults, setup_faults, _faults())})
+    except (RuntimeError, ValueError) as e:
+        results.put({"error": "producer: " + str(e)})
+    # Exiting destroys the semaphores (we created them last), so wait until the consumer has read everything:
+    finished.wait(case["timeout"])
+
+
+def measure_overhead(case, transactions):
+    """
+    Measures the time per transaction of the producer and the consumer in this process (see `--overhead`).
+
+    :param case: `dict` like for `run_case()` plus "hot_path"
+    :param transactions: Number of transactions to measure
+    :return: `dict` with the case and "producer_ns" and "consumer_ns" (mean time of `begin()` plus `end()`) or "error"
+    """
+    import consumer_ipc
+    import producer_ipc
+
+    args = dict(_ipc_args(case), log=True, hot_path=case["hot_path"])
+    result = dict(case)
+    del result["key"]
+    try:
+        consumer = consumer_ipc.ConsumerIPC(case["key"], **args)
+        producer = producer_ipc.ProducerIPC(case["key"], slot_size=case["size"], grow=False, **args)
+        producer_time = consumer_time = 0.0
+        for measured in (False, True):  # warm up first
+            for _ in range(transactions if measured else min(transactions, 1000)):
+                start = time.time()
+                producer.begin(case["size"], case["timeout"])
+                producer.end()
+                middle = time.time()
+                consumer.begin(case["timeout"])
+                consumer.end()
+                if measured:
+                    producer_time += middle - start
+                    consumer_time += time.time() - middle
+        result.update(producer_ns=producer_time / transactions * 1e9, consumer_ns=consumer_time / transactions * 1e9)
+    except RuntimeError as e:
+        result["error"] = str(e)
+    return result
+
+
+def run_case(case):
+    """
+    Runs a single case in a consumer and a producer process.
+
+    :param case: `dict` with the keys "key" (name of the shared memory), "backend" (see `ipc_backend`), "mode",
+    "slots", "size" (payload size in bytes), "duration" (seconds), "timeout" (seconds to wait for the other side
+    before giving up), "huge_pages", "prefault" and "numa_node" (see `ProducerIPC`)
+    :return: `dict` with the case and its results (see `_consume()` and `_produce()`) or "error"
+    """
+    results = multiprocessing.Queue()
+    ready = multiprocessing.Event()
+    finished = multiprocessing.Event()
+    # The consumer must exist before the producer produces anything since both (re)create the semaphores:
+    consumer = multiprocessing.Process(target=_consume, args=(case, ready, finished, results))
+    consumer.start()
+    ready.wait()
+    producer = multiprocessing.Process(target=_produce, args=(case, finished, results))
+    producer.start()
+    result = dict(case)
+    del result["key"]
+    for _ in (producer, consumer):
+        try:
+            part = results.get(timeout=case["duration"] + 2 * case["timeout"] + 10)
+        except Exception:  # queue.Empty (module name differs in Python 2/3)
+            part = {"error": "no result"}
+        if "error" in part and "error" in result:
+            part["error"] = result["error"] + "; " + part["error"]
+        result.update(part)
+        if part.get("error") == "no result":
+            break
+    for process in (producer, consumer):
+        process.join(case["timeout"])
+        if process.is_alive():
+            process.terminate()
+            process.join()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measures the throughput and latency of prodcon_ipc.")
+    parser.add_argument("--sizes",
+                        help="comma separated payload sizes, e.g. 64,4K,16M (default: " + DEFAULT_SIZES + ", 64 with "
+                        "--overhead)")
+    parser.add_argument("--slots", default=DEFAULT_SLOTS,
+                        help="comma separated slot counts (default: " + DEFAULT_SLOTS + ")")
+    parser.add_argument("--modes", default=DEFAULT_MODES,
+                        help="comma separated modes out of " + ", ".join(MODES) + " (default: " + DEFAULT_MODES + ")")
+    parser.add_argument("--duration", type=float, default=1.0, help="seconds per case (default: 1)")
+    parser.add_argument("--timeout", type=float, default=10.0,
+                        help="seconds to wait for the other process before giving up (default: 10)")
+    parser.add_argument("--backend", choices=ipc_backend.BACKENDS,
+                        help="backend providing shared memory and semaphores (default: $" +
+                        ipc_backend.ENVIRONMENT_VARIABLE + " or " + ipc_backend.QT + ")")
+    parser.add_argument("--huge-pages", choices=segment_memory.HUGE_PAGES,
+                        help="back the segments by huge pages (" + segment_memory.HUGETLB + " requires --backend " +
+                        ipc_backend.SYSV + ", default: normal pages)")
+    parser.add_argument("--prefault", action="store_true",
+                        help="fault in all pages of the segments when creating/attaching them")
+    parser.add_argument("--numa-node", type=int, help="allocate the segments on this NUMA node")
+    parser.add_argument("--max-memory", default="1G",
+                        help="skip cases whose slots need more shared memory than this (default: 1G)")
+    parser.add_argument("--overhead", type=int, default=0, metavar="N",
+                        help="measure the time per transaction of the Python wrappers in one process over N "
+                        "transactions instead, without and with --hot-path")
+    parser.add_argument("--output", help="file to write the JSON results to (default: stdout)")
+    args = parser.parse_args(argv)
+
+    sizes = [parse_size(size) for size in (args.sizes or ("64" if args.overhead else DEFAULT_SIZES)).split(",")]
+    slot_counts = [int(slots) for slots in args.slots.split(",")]
+    if min(slot_counts) < 1:
+        # The single item mode recreates the segment for every item, which fails if the consumer is still attached
+        parser.error("slot counts must be positive, the single item mode is not supported")
+    modes = [mode.strip() for mode in args.modes.split(",")]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error("unknown mode " + mode)
+    max_memory = parse_size(args.max_memory)
+    backend = ipc_backend.get(args.backend)
+
+    cases = []
+    for mode in modes:
+        for slots in slot_counts:
+            for size in sizes:
+                case = {"backend": backend.name, "mode": mode, "slots": slots, "size": max(size, _MESSAGE.size),
+                        "duration": args.duration, "timeout": args.timeout, "huge_pages": args.huge_pages,
+                        "prefault": args.prefault, "numa_node": args.numa_node,
+                        "key": "prodcon_benchmark_" + str(os.getpid()) + "_" + str(len(cases))}
+                if slots * case["size"] > max_memory:
+                    result = dict(case)
+                    del result["key"]
+                    result["skipped"] = "needs more than --max-memory"
+                    results = [result]
+                elif args.overhead:
+                    results = [measure_overhead(dict(case, hot_path=hot_path, key=case["key"] + "_" + str(hot_path)),
+                                                args.overhead) for hot_path in (False, True)]
+                else:
+                    results = [run_case(case)]
+                for result in results:
+                    cases.append(result)
+                    sys.stderr.write(json.dumps(result, sort_keys=True) + "\n")
+
+    report = {"platform": platform.platform(), "python": platform.python_version(), "backend": backend.description,
+              "cpus": multiprocessing.cpu_count(), "cases": cases}
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    return 0 if not any("error" in case for case in cases) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import struct
+
+import ring_buffer
+
+# Layout of a shared memory segment in broadcast ring mode:
+#
+#   [header (HEADER_SIZE bytes)][consumer table (max_consumers * CONSUMER_SIZE bytes)][slot length table]
+#   [slot 0][slot 1]...[slot N-1]
+#
+# Every item is read by all registered consumers. Each consumer has its own entry in the consumer table holding its
+# cursor (the sequence number of the next item it reads) and its policy for the case that it is too slow: `BLOCK` lets
+# the producer wait until the consumer has read the oldest item, `DROP` lets the producer move the cursor ahead (the
+# skipped items are counted in `dropped`). A slot which is being read is never overwritten.
+#
+# Everything is accessed while holding the shared memory lock. The consumers wait on their own semaphores
+# (`semaphore_key()`), the producer on `_sem_empty`. To sleep, either side sets its `waiting` flag under the lock; the
+# other side releases the semaphore (after unlocking) only if the flag is set.
+MAGIC = b"PCBR"
+VERSION = 1
+ALIGNMENT = ring_buffer.ALIGNMENT
+HEADER_FORMAT = "<4sHHIIIIQ"  # magic, version, header size, slot count, slot size, max consumers, producer waiting, head
+HEADER_SIZE = ALIGNMENT
+CONSUMER_FORMAT = "<IIQQQI"  # active, policy, cursor, reading (sequence + 1, 0 if not reading), dropped, waiting
+CONSUMER_SIZE = ALIGNMENT
+LENGTH_FORMAT = "<Q"
+
+BLOCK = 0  # the producer waits for the consumer
+DROP = 1  # the producer skips items the consumer has not read yet
+
+_HEADER = struct.Struct(HEADER_FORMAT)
+_CONSUMER = struct.Struct(CONSUMER_FORMAT)
+_LENGTH = struct.Struct(LENGTH_FORMAT)
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+
+_PRODUCER_WAITING_OFFSET = 20
+_HEAD_OFFSET = 24
+# Offsets and formats of the fields of a consumer entry:
+_CONSUMER_FIELDS = {"active": (0, _U32), "policy": (4, _U32), "cursor": (8, _U64), "reading": (16, _U64),
+                    "dropped": (24, _U64), "waiting": (32, _U32)}
+
+
+def semaphore_key(id, index):
+    """
+    Returns the name of the semaphore the consumer registered at `index` waits on.
+
+    :param id: Unique name of the shared memory (as passed to `ProducerIPC`/`ConsumerIPC`)
+    :param index: Index of the consumer entry
+    :return: Name of the semaphore
+    """
+    return str(id) + "_sem_full_" + str(index)
+
+
+def lengths_offset(max_consumers):
+    """
+    Returns the offset of the slot length table.
+
+    :param max_consumers: Maximum number of consumers
+    :return: Offset in bytes
+    """
+    return HEADER_SIZE + max_consumers * CONSUMER_SIZE
+
+
+def data_offset(slot_count, max_consumers):
+    """
+    Returns the offset of the first slot.
+
+    :param slot_count: Number of slots
+    :param max_consumers: Maximum number of consumers
+    :return: Offset in bytes
+    """
+    return lengths_offset(max_consumers) + ring_buffer.align(slot_count * _LENGTH.size)
+
+
+def segment_size(slot_count, slot_size, max_consumers):
+    """
+    Returns the number of bytes a shared memory segment needs to hold the header, the tables and all slots.
+
+    :param slot_count: Number of slots
+    :param slot_size: Maximum number of bytes per slot
+    :param max_consumers: Maximum number of consumers
+    :return: Size in bytes
+    """
+    return data_offset(slot_count, max_consumers) + slot_count * ring_buffer.align(slot_size)
+
+
+class BroadcastRing(object):
+    """
+    Provides access to a broadcast ring located at the beginning of a shared memory segment.
+
+    This class does not synchronize anything, lock the shared memory before calling any method.
+    """
+    def __init__(self, buf):
+        """
+        Wraps the given memory.
+
+        :param buf: Writable `memoryview` of the whole shared memory segment
+        """
+        self._buf = buf
+        if self.is_valid():
+            self._cache_layout()
+
+    def initialize(self, slot_count, slot_size, max_consumers):
+        """
+        Writes a fresh header (an empty ring without consumers).
+
+        :param slot_count: Number of slots
+        :param slot_size: Maximum number of bytes per slot
+        :param max_consumers: Maximum number of consumers
+        """
+        size = data_offset(slot_count, max_consumers)
+        self._buf[:size] = b"\0" * size
+        _HEADER.pack_into(self._buf, 0, MAGIC, VERSION, HEADER_SIZE, slot_count, slot_size, max_consumers, 0, 0)
+        self._cache_layout()
+
+    def _cache_layout(self):
+        _, _, _, self.slot_count, self.slot_size, self.max_consumers, _, _ = _HEADER.unpack_from(self._buf, 0)
+        self._lengths_offset = lengths_offset(self.max_consumers)
+        self._data_offset = data_offset(self.slot_count, self.max_consumers)
+
+    def is_valid(self):
+        """
+        Checks whether the memory contains a broadcast ring header of a supported version.
+
+        :return: `True` if so, `False` otherwise
+        """
+        if len(self._buf) < HEADER_SIZE:
+            return False
+        magic, version = struct.unpack_from("<4sH", self._buf, 0)
+        return magic == MAGIC and version == VERSION
+
+    @property
+    def head(self):
+        """Sequence number of the next slot to be written by the producer."""
+        return _U64.unpack_from(self._buf, _HEAD_OFFSET)[0]
+
+    def get(self, index, name):
+        """
+        Returns a field of a consumer entry (see `CONSUMER_FORMAT`).
+
+        :param index: Index of the consumer entry
+        :param name: Name of the field, e.g. "cursor"
+        :return: Value of the field
+        """
+        offset, field = _CONSUMER_FIELDS[name]
+        return field.unpack_from(self._buf, HEADER_SIZE + index * CONSUMER_SIZE + offset)[0]
+
+    def set(self, index, name, value):
+        offset, field = _CONSUMER_FIELDS[name]
+        field.pack_into(self._buf, HEADER_SIZE + index * CONSUMER_SIZE + offset, value)
+
+    def length(self, index):
+        """
+        Returns the number of bytes stored in a slot.
+
+        :param index: Slot index (not the sequence number)
+        :return: Size in bytes
+        """
+        return _LENGTH.unpack_from(self._buf, self._lengths_offset + index * _LENGTH.size)[0]
+
+    def slot_offset(self, index):
+        """
+        Returns the offset of a slot relative to the beginning of the segment.
+
+        :param index: Slot index (not the sequence number)
+        :return: Offset in bytes
+        """
+        return self._data_offset + index * ring_buffer.align(self.slot_size)
+
+    def register(self, policy):
+        """
+        Adds a consumer which reads all items published from now on.
+
+        :param policy: `BLOCK` or `DROP`
+        :return: Index of the consumer entry, `None` if all entries are in use
+        """
+        for index in range(self.max_consumers):
+            if not self.get(index, "active"):
+                _CONSUMER.pack_into(self._buf, HEADER_SIZE + index * CONSUMER_SIZE, 1, policy, self.head, 0, 0, 0)
+                return index
+        return None
+
+    def unregister(self, index):
+        """
+        Removes a consumer.
+
+        :param index: Index of the consumer entry
+        :return: `True` if the producer waits and needs to be woken up by releasing `_sem_empty`, `False` otherwise
+        """
+        self.set(index, "active", 0)
+        return self._wake_producer()
+
+    def reserve(self):
+        """
+        Checks whether the producer may write the slot of `head`, i.e., whether all consumers have read the item stored
+        there (if any). Moves the cursors of consumers with the `DROP` policy ahead if they lag behind. Sets the
+        producer's waiting flag if the slot cannot be written yet.
+
+        :return: `True` if the slot may be written, `False` if the producer has to wait on `_sem_empty`
+        """
+        oldest = self.head - self.slot_count  # sequence number of the item to be overwritten
+        if oldest < 0:
+            return True
+        free = True
+        for index in range(self.max_consumers):
+            if not self.get(index, "active"):
+                continue
+            if self.get(index, "reading") == oldest + 1:
+                free = False  # never overwrite a slot which is being read
+                continue
+            cursor = self.get(index, "cursor")
+            if cursor > oldest:
+                continue
+            if self.get(index, "policy") == DROP:
+                self.set(index, "dropped", self.get(index, "dropped") + oldest + 1 - cursor)
+                self.set(index, "cursor", oldest + 1)
+            else:
+                free = False
+        if not free:
+            _U32.pack_into(self._buf, _PRODUCER_WAITING_OFFSET, 1)
+        return free
+
+    def publish(self, length):
+        """
+        Publishes the slot of `head` to all consumers.
+
+        :param length: Number of bytes stored in the slot
+        :return: Indices of the consumers which wait and need to be woken up by releasing their semaphores
+        """
+        head = self.head
+        _LENGTH.pack_into(self._buf, self._lengths_offset + (head % self.slot_count) * _LENGTH.size, length)
+        _U64.pack_into(self._buf, _HEAD_OFFSET, head + 1)
+        waiting = []
+        for index in range(self.max_consumers):
+            if self.get(index, "active") and self.get(index, "waiting"):
+                self.set(index, "waiting", 0)
+                waiting.append(index)
+        return waiting
+
+    def poll(self, index):
+        """
+        Checks whether an item is available for a consumer, sets its waiting flag otherwise.
+
+        :param index: Index of the consumer entry
+        :return: `True` if an item is available, `False` if the consumer has to wait on its semaphore
+        """
+        if self.get(index, "cursor") < self.head:
+            return True
+        self.set(index, "waiting", 1)
+        return False
+
+    def start(self, index):
+        """
+        Marks the item at the cursor of a consumer as being read (see `poll()`).
+
+        :param index: Index of the consumer entry
+        :return: Sequence number of the item
+        """
+        sequence = self.get(index, "cursor")
+        self.set(index, "reading", sequence + 1)
+        return sequence
+
+    def finish(self, index, sequence):
+        """
+        Marks an item as read by a consumer and advances its cursor.
+
+        :param index: Index of the consumer entry
+        :param sequence: Sequence number returned by `start()`
+        :return: `True` if the producer waits and needs to be woken up by releasing `_sem_empty`, `False` otherwise
+        """
+        self.set(index, "reading", 0)
+        self.set(index, "cursor", max(self.get(index, "cursor"), sequence + 1))
+        return self._wake_producer()
+
+    def pending(self):
+        """
+        Checks whether any consumer has not read all published items yet.
+
+        :return: `True` if so, `False` otherwise
+        """
+        head = self.head
+        return any(self.get(index, "active") and self.get(index, "cursor") < head
+                   for index in range(self.max_consumers))
+
+    def _wake_producer(self):
+        if _U32.unpack_from(self._buf, _PRODUCER_WAITING_OFFSET)[0]:
+            _U32.pack_into(self._buf, _PRODUCER_WAITING_OFFSET, 0)
+            return True
+        return False
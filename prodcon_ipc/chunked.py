@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import struct
+
+# Layout of a chunk of a payload which is split into several items (see `ProducerIPC.put_stream()`):
+#
+#   [magic, flags, stream, total size, offset, length][data]
+#
+# `stream` numbers the payloads of a producer, `total size` is 0 if the producer didn't know it in advance and
+# `offset` is the position of the chunk's data within the payload. The first chunk of a payload has the flag `FIRST`,
+# the last one `LAST` (possibly both); if the producer failed to produce the payload, its last chunk has the flag
+# `ABORTED`. All values are stored in little endian order.
+MAGIC = b"PCCK"
+HEADER_FORMAT = "<4sIQQQQ"  # magic, flags, stream, total size, offset, length
+FIRST = 0x1
+LAST = 0x2
+ABORTED = 0x4
+DEFAULT_CHUNK_SIZE = 1024 * 1024  # bytes of data per chunk if the slot size is unknown
+
+_HEADER = struct.Struct(HEADER_FORMAT)
+HEADER_SIZE = _HEADER.size
+
+
+def pack_header_into(buf, flags, stream, total_size, offset, length):
+    """
+    Stores the header of a chunk at the beginning of `buf`.
+    """
+    _HEADER.pack_into(buf, 0, MAGIC, flags, stream, total_size, offset, length)
+
+
+def unpack(buf):
+    """
+    Splits a chunk into its header and data without copying the latter.
+
+    :param buf: Buffer (e.g. `memoryview`) of the chunk, as written by `pack_header_into()` and the data
+    :return: (flags, stream, total size, offset, data) whereby `data` is a `memoryview` (only valid as long as `buf`
+    is)
+    :except: `ValueError` if `buf` does not contain a chunk
+    """
+    buf = memoryview(buf)
+    if len(buf) < HEADER_SIZE:
+        raise ValueError("Shared memory does not contain a chunk.")
+    magic, flags, stream, total_size, offset, length = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or HEADER_SIZE + length > len(buf):
+        raise ValueError("Shared memory does not contain a chunk.")
+    return flags, stream, total_size, offset, buf[HEADER_SIZE:HEADER_SIZE + length]
+
+
+def fill(view, source):
+    """
+    Reads from `source` into `view` until it is full or the end of `source` is reached.
+
+    :param view: Writable `memoryview`
+    :param source: File object providing `readinto()`
+    :return: Number of bytes read, less than `len(view)` at the end of `source` only
+    """
+    size = 0
+    while size < len(view):
+        read = source.readinto(view[size:])
+        if not read:
+            break
+        size += read
+    return size
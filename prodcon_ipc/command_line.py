@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+# Headless producer/consumer pipeline, run as `python -m prodcon_ipc produce|consume ...` (see `--help`). Only QtCore is
+# required (nothing of Qt with `--backend sysv`, see `ipc_backend`); QtGui is imported for `--raw-frames` only (no
+# QApplication in any case). Examples:
+#
+#   python -m prodcon_ipc consume --output frames/ &
+#   python -m prodcon_ipc produce images/
+#   ffmpeg -i video.mp4 -f rawvideo - | python -m prodcon_ipc produce --frame-size 6220800
+#
+# The producer finishes with an empty item which stops the consumer, and waits until the consumer has read everything
+# (so empty files are skipped). Start the consumer first: creating a producer or a consumer resets the semaphores. Items
+# larger than a slot are split into chunks with `--chunk-size` (the consumer needs `--chunked` then), e.g.:
+#
+#   python -m prodcon_ipc consume --chunked --output video_copy.mp4 &
+#   python -m prodcon_ipc produce --chunk-size 65536 --slot-size 65600 --lock-free video.mp4
+#
+# Items can be compressed with `--codec` (the consumer needs `--encoded` then, see `frame_codec`).
+#
+# Shared memory and semaphores left behind by crashed processes are listed by `python -m prodcon_ipc reap` and removed
+# by adding `--clean` (see `reaper`).
+
+import argparse
+import gc
+import itertools
+import json
+import os
+import sys
+import time
+
+import abstract_ipc
+import chunked
+import frame_codec
+import ipc_backend
+import segment_memory
+
+_START = time.time()
+DEFAULT_ID = "MySharedMemoryDefault"  # the one of the demo applications
+
+
+def _add_common_arguments(parser):
+    parser.add_argument("--id", default=DEFAULT_ID, help="unique name of the shared memory (default: " + DEFAULT_ID +
+                        ")")
+    parser.add_argument("--key-file", help="file whose first line overrides --id if it exists")
+    parser.add_argument("--slots", type=int, default=4,
+                        help="number of slots of the ring buffer, at least 2 (default: 4)")
+    parser.add_argument("--lock-free", action="store_true", help="use the lock-free single-producer/consumer ring")
+    parser.add_argument("--backend", choices=ipc_backend.BACKENDS,
+                        help="backend providing shared memory and semaphores (default: $" +
+                        ipc_backend.ENVIRONMENT_VARIABLE + " or " + ipc_backend.QT + ")")
+    parser.add_argument("--raw-frames", action="store_true",
+                        help="items are images stored as raw frames (requires QtGui), see raw_frame.py")
+    parser.add_argument("--timeout", type=float,
+                        help="seconds to wait for the other side (default: forever); the consumer stops then")
+    parser.add_argument("--prefault", action="store_true",
+                        help="fault in all pages of the shared memory up front (see segment_memory.py)")
+    parser.add_argument("--stats", action="store_true", help="print statistics as JSON to stderr when done")
+    parser.add_argument("--verbose", action="store_true", help="enable logging")
+
+
+def _file_item(path):
+    """
+    Returns (size, fill) for a file whereby `fill(view)` reads it directly into the shared memory.
+    """
+    def fill(view):
+        with open(path, "rb") as fp:
+            while len(view):
+                read = fp.readinto(view)
+                if not read:
+                    raise RuntimeError("File " + path + " was truncated while reading it.")
+                view = view[read:]
+    return os.path.getsize(path), fill
+
+
+def _buffer_item(data):
+    def fill(view):
+        view[:] = data
+    return len(data), fill
+
+
+def _image_item(path):
+    from PyQt5.QtGui import QImage
+    import raw_frame
+
+    image = QImage()
+    if not image.load(path):
+        raise RuntimeError("Unable to load image " + path)
+
+    def fill(view):
+        raw_frame.write(view, image, _image_item.sequence)
+        _image_item.sequence += 1
+    return raw_frame.frame_size(image), fill
+_image_item.sequence = 0
+
+
+def _stdin_items(frame_size):
+    """
+    Yields the standard input as one item (`frame_size` 0) or in items of `frame_size` bytes (the last one may be
+    smaller).
+    """
+    stdin = getattr(sys.stdin, "buffer", sys.stdin)
+    if not frame_size:
+        yield _buffer_item(stdin.read())
+        return
+    buffer = bytearray(frame_size)
+    while True:
+        size = 0
+        view = memoryview(buffer)
+        while size < frame_size:
+            read = stdin.readinto(view[size:])
+            if not read:
+                break
+            size += read
+        if not size:
+            return
+        yield _buffer_item(view[:size])
+
+
+def _items(paths, args):
+    """
+    Yields (size, fill, path) per item to produce whereby `path` is the file to read the item from (streamed by
+    `--chunk-size`), "-" for all of stdin (`--chunk-size` without `--frame-size`, the size is unknown then) or `None`.
+    """
+    for path in paths:
+        if path == "-":
+            if args.chunk_size and not args.frame_size:
+                yield None, None, "-"
+                continue
+            for size, fill in _stdin_items(args.frame_size):
+                yield size, fill, None
+            continue
+        files = [path]
+        if os.path.isdir(path):
+            files = [os.path.join(path, name) for name in sorted(os.listdir(path))]
+            files = [name for name in files if os.path.isfile(name)]
+        for name in files:
+            if args.raw_frames:
+                size, fill = _image_item(name)
+                yield size, fill, None
+            else:
+                size, fill = _file_item(name)
+                yield size, fill, name
+
+
+def _put(producer, size, fill, path, args):
+    """
+    Produces one item, split into chunks with `--chunk-size`.
+    """
+    if args.codec:
+        payload = bytearray(size)
+        fill(memoryview(payload))
+        producer.put_frame(payload, args.timeout)
+    elif not args.chunk_size:
+        avail_size, data = producer.begin(size, args.timeout)
+        try:
+            if avail_size < size:
+                raise RuntimeError("Item of " + str(size) + " bytes exceeds the slot size of " + str(avail_size) +
+                                   " bytes, increase --slot-size or use --chunk-size.")
+            fill(memoryview(data)[:size])
+        finally:
+            producer.end()
+    elif path == "-":
+        producer.put_stream(getattr(sys.stdin, "buffer", sys.stdin), None, args.chunk_size, args.timeout)
+    elif path is not None:
+        with open(path, "rb") as fp:  # read directly into the shared memory
+            producer.put_stream(fp, size, args.chunk_size, args.timeout)
+    else:
+        payload = bytearray(size)
+        fill(memoryview(payload))
+        producer.put_stream(payload, size, args.chunk_size, args.timeout)
+
+
+def _print_stats(ipc, startup, items):
+    snapshot = ipc.stats() or {}
+    snapshot["startup_seconds"] = startup
+    snapshot["items"] = items
+    sys.stderr.write(json.dumps(snapshot, sort_keys=True) + "\n")
+
+
+def produce(args):
+    import producer_ipc
+
+    producer = producer_ipc.ProducerIPC(args.id, args.key_file, args.verbose, slots=args.slots,
+                                        slot_size=args.slot_size, lock_free=args.lock_free, stats=args.stats,
+                                        backend=args.backend, huge_pages=args.huge_pages, prefault=args.prefault,
+                                        numa_node=args.numa_node, codec=args.codec,
+                                        codec_threads=args.codec_threads)
+    startup = None
+    count = 0
+    for _ in range(args.repeat):
+        for size, fill, path in _items(args.paths or ["-"], args):
+            if size == 0:
+                continue  # would end the stream
+            _put(producer, size, fill, path, args)
+            if startup is None:
+                startup = time.time() - _START
+            count += 1
+            if args.interval:
+                time.sleep(args.interval)
+    if args.chunk_size:
+        producer.put_stream(b"", timeout=args.timeout)  # end of stream
+    elif args.codec:
+        producer.put_frame(b"", args.timeout)  # end of stream (after the items still being encoded)
+    else:
+        producer.begin(0, args.timeout)  # end of stream
+        producer.end()
+    # Exiting may destroy the semaphores, so wait until everything has been read:
+    if not producer.flush(args.timeout):
+        sys.stderr.write("The consumer has not read all items within the timeout.\n")
+    if args.stats:
+        _print_stats(producer, startup, count)
+    return 0
+
+
+def _writer(args):
+    """
+    Returns a function writing an item (an iterable of `memoryview`s, i.e., its chunks) with a given index to the
+    output.
+    """
+    stdout = getattr(sys.stdout, "buffer", sys.stdout)
+    if args.output == "-":
+        def write(views, index):
+            for view in views:
+                stdout.write(view)
+            stdout.flush()
+        return write
+
+    pattern = args.output
+    directory = os.path.dirname(pattern) if "%" in pattern else pattern
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    if "%" not in pattern:
+        pattern = os.path.join(pattern, "%06d" + (".png" if args.raw_frames else ".bin"))
+
+    def write(views, index):
+        if args.raw_frames:
+            import raw_frame
+            image, _ = raw_frame.read(next(iter(views)))  # reassembled, see _write_chunked()
+            if not image.save(pattern % index):
+                raise RuntimeError("Unable to save image " + pattern % index)
+        else:
+            with open(pattern % index, "wb") as fp:
+                for view in views:
+                    fp.write(view)
+    return write
+
+
+def _write_chunked(consumer, write, index, args):
+    """
+    Writes the next item produced with `--chunk-size` chunk by chunk (raw frames are reassembled first).
+
+    :return: `False` at the end of the stream (an empty item), `True` otherwise
+    """
+    if args.raw_frames:
+        payload = consumer.get_large(args.timeout)
+        if payload:
+            write([memoryview(payload)], index)
+        return bool(payload)
+    chunks = consumer.get_stream(args.timeout)
+    first = next(chunks, None)
+    if first is None:
+        return False
+    write(itertools.chain([first], chunks), index)
+    return True
+
+
+def consume(args):
+    import consumer_ipc
+
+    consumer = consumer_ipc.ConsumerIPC(args.id, args.key_file, args.verbose, slots=args.slots,
+                                        lock_free=args.lock_free, stats=args.stats, backend=args.backend,
+                                        prefault=args.prefault, encoded=args.encoded)
+    write = _writer(args)
+    startup = None
+    count = 0
+    while args.count is None or count < args.count:
+        try:
+            if args.chunked:
+                if not _write_chunked(consumer, write, count, args):
+                    break  # end of stream
+            elif args.encoded:
+                data = consumer.get_frame(args.timeout)
+                if not len(data):
+                    break  # end of stream
+                write([memoryview(data)], count)
+            else:
+                data = consumer.begin(args.timeout)
+                try:
+                    view = memoryview(data)
+                    if not len(view):
+                        break  # end of stream
+                    write([view], count)
+                finally:
+                    consumer.end()
+        except abstract_ipc.TimeoutExpired:
+            break
+        if startup is None:
+            startup = time.time() - _START
+        count += 1
+    if args.stats:
+        _print_stats(consumer, startup, count)
+    return 0
+
+
+def reap(args):
+    import reaper
+
+    entries = reaper.scan()
+    removed = reaper.clean(entries) if args.clean else []
+    if args.json:
+        json.dump({"objects": entries, "removed": len(removed)}, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+        return 0
+    for entry in entries:
+        details = []
+        if entry["kind"] == reaper.SHARED_MEMORY and entry["id"] != -1:
+            details.append(str(entry["size"]) + " bytes, " + str(entry["attached"]) + " attached")
+            ring = entry["ring"]
+            if ring is not None:
+                for role in ("producer", "consumer"):
+                    if ring[role]["pid"]:
+                        details.append(role + " " + str(ring[role]["pid"]) +
+                                       (" alive" if ring[role]["alive"] else " dead"))
+                details.append(str(ring["head"] - ring["tail"]) + " unread items")
+        elif entry["id"] != -1:
+            details.append("value " + str(entry["value"]) + ", last used by " + str(entry["last"]) + ", " +
+                           str(entry["waiting"]) + " waiting")
+        if entry["stale"]:
+            details.append(("removed: " if entry in removed else "stale: ") + entry["reason"])
+        sys.stdout.write(entry["kind"] + " " + entry["name"] + " (id " + str(entry["id"]) + "): " +
+                         ", ".join(details) + "\n")
+    if not args.clean and any(entry["stale"] for entry in entries):
+        sys.stdout.write("Run with --clean to remove the stale objects.\n")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m prodcon_ipc",
+                                     description="Streams data through shared memory without a GUI.")
+    commands = parser.add_subparsers(dest="command")
+    producer = commands.add_parser("produce", help="put files, directories or stdin into shared memory")
+    _add_common_arguments(producer)
+    producer.add_argument("paths", nargs="*",
+                          help="files, directories (all files therein, sorted by name) or - for stdin (default)")
+    producer.add_argument("--slot-size", type=int, default=1024 * 1024,
+                          help="initial bytes per slot, grows if required unless --lock-free (default: 1M)")
+    producer.add_argument("--frame-size", type=int, default=0,
+                          help="split stdin into items of this many bytes (default: all of stdin is one item)")
+    producer.add_argument("--chunk-size", type=int, default=0,
+                          help="split every item into chunks of this many bytes (plus a header of " +
+                          str(chunked.HEADER_SIZE) + " bytes) to stream items larger than a slot, the consumer needs "
+                          "--chunked (default: 0, items must fit into a slot)")
+    producer.add_argument("--codec", choices=frame_codec.CODECS,
+                          help="encode every item, the consumer needs --encoded (installed: " +
+                          ", ".join(frame_codec.available()) + ", default: items are stored as they are)")
+    producer.add_argument("--codec-threads", type=int, default=0,
+                          help="number of threads encoding items in the background (default: 0)")
+    producer.add_argument("--repeat", type=int, default=1, help="number of times to produce all paths (default: 1)")
+    producer.add_argument("--huge-pages", choices=segment_memory.HUGE_PAGES,
+                          help="back the shared memory by huge pages (" + segment_memory.HUGETLB + " requires --backend "
+                          + ipc_backend.SYSV + ", default: normal pages)")
+    producer.add_argument("--numa-node", type=int, help="allocate the shared memory on this NUMA node")
+    producer.add_argument("--interval", type=float, default=0.0, help="seconds to sleep between items (default: 0)")
+    consumer = commands.add_parser("consume", help="write items from shared memory to files or stdout")
+    _add_common_arguments(consumer)
+    consumer.add_argument("--output", "-o", default="-",
+                          help="- for stdout (default), a directory or a pattern like frame_%%06d.png")
+    consumer.add_argument("--count", type=int, help="stop after this many items")
+    consumer.add_argument("--chunked", action="store_true", help="items are split into chunks (see --chunk-size)")
+    consumer.add_argument("--encoded", action="store_true", help="items are encoded (see --codec)")
+    reaper = commands.add_parser("reap", help="list (and remove) shared memory and semaphores left behind by crashed "
+                                 "processes (Linux only)")
+    reaper.add_argument("--clean", action="store_true", help="remove the stale objects")
+    reaper.add_argument("--json", action="store_true", help="print the objects as JSON")
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.error("missing command: produce, consume or reap")
+    if args.command == "reap":
+        try:
+            return reap(args)
+        except RuntimeError as e:
+            sys.stderr.write(str(e) + "\n")
+            return 1
+    if args.slots < 2:
+        # The single item mode recreates the segment for every item while the consumer may still be attached to it
+        # (and an empty item could not end the stream), so it is not offered here:
+        parser.error("--slots must be at least 2")
+    if getattr(args, "codec", None) and args.chunk_size or getattr(args, "encoded", False) and args.chunked:
+        parser.error("--codec and --encoded cannot be combined with --chunk-size and --chunked")
+
+    try:
+        return produce(args) if args.command == "produce" else consume(args)
+    except (RuntimeError, ValueError) as e:
+        sys.stderr.write(str(e) + "\n")
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        # Detach from the shared memory while Qt is still alive (the instrumentation creates reference cycles):
+        gc.collect()
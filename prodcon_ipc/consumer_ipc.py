@@ -4,7 +4,15 @@
 # This code is licensed under the BSD 3-Clause license (see LICENSE for details).
 
 import abstract_ipc
+import array_view
+import batch
+import broadcast_ring
+import chunked
+import collections
+import frame_codec
+import logging
 import logzero
+import time
 
 
 class ConsumerIPC(abstract_ipc.AbstractIPC):
@@ -14,8 +22,24 @@ class ConsumerIPC(abstract_ipc.AbstractIPC):
 
     Basically, the signal  available() is emitted once data was produced and put into the shared
  * memory. Once triggered, use \c begin() ... \c end() to access the data.
+
+    In ring buffer mode (`slots` given), the consumer stays attached to the shared memory and reads the items in the
+    order they were produced. It only re-attaches if the producer has reallocated the slots.
+
+    In lock-free mode (`lock_free=True`, with exactly one producer), the shared memory is not locked at all and the
+    semaphores are only used if the ring is empty (see `spsc_ring`).
+
+    In broadcast mode (`broadcast` given), the consumer registers itself at the producer on the first `begin()` and
+    reads every item published from then on, independently of other consumers (see `broadcast_ring`).
+
+    If the producer encodes the items (see its `codec`), `get_frame()` and `ScopedConsumer` decode them (`encoded=True`).
+
+    In ring buffer mode, both sides record their process ID and a heartbeat in the header. While waiting for items,
+    the consumer notices if the producer has died (see `peer_alive()`) and resynchronizes `_sem_full` with the indices if
+    it has lost permits, e.g. because a process was killed, so a restarted producer continues where the old one stopped.
     """
-    def __init__(self, id, key_file_path=None, log=True):
+    def __init__(self, id, key_file_path=None, log=True, slots=None, lock_free=False, broadcast=None, stats=False,
+                 backend=None, prefault=False, encoded=False, peer_timeout=None, hot_path=False):
         """
         Creates the shared memory reference and the internal semaphores.
 
@@ -25,43 +49,442 @@ class ConsumerIPC(abstract_ipc.AbstractIPC):
         as the unique ID/name of the shared memory IF this file exists, can be empty (the default) which then uses `id`
         (first parameter)
         :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+        :param slots: Number of slots of the ring buffer, must match the producer's value (`None` if the producer does
+        not use the ring buffer mode)
+        :param lock_free: `True` to use the lock-free single-producer/single-consumer ring, must match the producer's
+        value
+        :param broadcast: Policy if this consumer is too slow in broadcast mode (the producer must use it as well):
+        `broadcast_ring.BLOCK` to let the producer wait, `broadcast_ring.DROP` to skip items; `None` (the default) if
+        the producer does not use the broadcast mode
+        :param stats: `True` to collect statistics of the transactions (see `stats()`) and export them to a shared
+        memory segment named `ipc_stats.stats_key(key, "consumer")`, a `str` to export them to this key instead; the
+        end-to-end latency is only measured in ring buffer mode if the producer collects statistics as well
+        :param backend: Backend providing shared memory and semaphores (see `ipc_backend`), `None` (the default) for Qt
+        unless overridden by the environment variable `PRODCON_IPC_BACKEND`; may differ from the producer's
+        :param prefault: `True` to map all pages of a segment when attaching to it (see `segment_memory`), so reading
+        the first items doesn't page fault; `False` (the default) maps them on first access
+        :param encoded: `True` if the producer encodes the items with a codec (see `frame_codec`), which is then taken
+        from every item; `False` (the default) if it doesn't
+        :param peer_timeout: Seconds after which a producer without a heartbeat counts as dead even if its process still
+        exists (ring buffer mode only; it beats whenever it produces or waits), `None` (the default) to only check
+        whether its process exists
+        :param hot_path: `True` to not log anything per transaction or while waiting unless enabled on demand (see
+        `AbstractIPC.enable_diagnostics()` and `ipc_log`), `False` (the default) to log these events rate-limited if
+        `log` is `True`
         """
-        abstract_ipc.AbstractIPC.__init__(self, id, key_file_path, log)
+        abstract_ipc.AbstractIPC.__init__(self, id, key_file_path, log, slots, lock_free, broadcast is not None,
+                                          backend, hot_path)
+        self._records = collections.deque()  # records of the last batch not returned by get_many() yet
+        self._policy = broadcast
+        self._consumer_index = None  # index of our entry in the consumer table (broadcast mode only)
+        self._consumer_semaphore = None  # semaphore the producer wakes us up with (broadcast mode only)
+        self._sequence = None  # sequence number of the item being read (broadcast mode only)
+        self._timestamp = 0  # time the producer has started the item being read (ring buffer mode only)
+        self._prefault = prefault
+        self._decoder = frame_codec.Decoder() if encoded else None
+        self._role = "consumer"
+        self._peer_timeout = peer_timeout
+        if stats:
+            self._enable_stats(stats, "consumer")
+
+    def __del__(self):
+        if getattr(self, "_consumer_index", None) is not None:
+            self.unregister()
 
-    def begin(self):
+    def begin(self, timeout=None):
         """
         Starts reading from the shared memory. Blocks if not available.
 
-        :return: Data in shared memory
+        :param timeout: Maximum time to wait for data in seconds, `None` (the default) to wait forever
+        :return: Data in shared memory (in ring buffer mode: a read-only `memoryview` of the next item)
+        :except: `abstract_ipc.TimeoutExpired` if no data was produced within `timeout` (don't call `end()` then)
+        """
+        if self._transaction_started:
+            raise RuntimeError("You must call end() first, cannot start a another transaction.")
+
+        if not self._acquire_full(timeout):
+            raise abstract_ipc.TimeoutExpired("No data was produced within " + str(timeout) + " seconds.")
+        return self._begin_acquired()
+
+    def _acquire_full(self, timeout):
+        """
+        Waits for a full slot, see `AbstractIPC._acquire()`.
+        """
+        if self._broadcast:
+            return self._acquire_broadcast(timeout)
+        if not self._lock_free:
+            if self._slots and self._ring is None and self._recover and self._attach_ring():
+                self._adopt_ring()
+            return self._acquire_ring(self._sem_full, timeout)
+        # The producer releases _sem_full once the segment has been created:
+        while self._spsc is None and not self._attach_spsc():
+            if not self._acquire(self._sem_full, timeout):
+                return False
+        spsc = self._spsc
+        return spsc.wait_for_data(lambda: spsc.head != spsc.tail,
+                                  lambda remaining: self._acquire(self._sem_full, remaining), timeout)
+
+    def get_many(self, max_items, timeout=None):
+        """
+        Gets records put into the shared memory by `ProducerIPC.put_many()`. Each batch is copied out of the shared
+        memory at once (so the producer can continue immediately) and returned as views into that copy. Waits for the
+        first batch only, further batches are consumed if they are available already.
+
+        :param max_items: Maximum number of records to return, remaining records are returned by the next call
+        :param timeout: Maximum time to wait for the first batch in seconds, `None` to wait forever
+        :return: List of (at most `max_items`) `memoryview`s, one per record; empty if the timeout expired
+        :except: `RuntimeError` if the shared memory cannot be accessed
         """
         if self._transaction_started:
             raise RuntimeError("You must call end() first, cannot start a another transaction.")
+        records = []
+        while len(records) < max_items:
+            if not self._records:
+                if not self._acquire_full(0 if records else timeout):
+                    break
+                data = self._begin_acquired()
+                try:
+                    copy = bytearray(memoryview(data))
+                finally:
+                    self.end()
+                self._records.extend(batch.unpack(copy))
+            records.append(self._records.popleft())
+        return records
+
+    def get_stream(self, timeout=None):
+        """
+        Gets the next payload put into the shared memory by `ProducerIPC.put_stream()`, chunk by chunk. Every chunk is
+        read directly from the shared memory (its transaction ends when the next chunk is requested), so memory use is
+        bounded no matter how large the payload is. Chunks of a payload that has already started (e.g. when a
+        broadcast consumer registers in the middle of it) are skipped.
+
+        :param timeout: Maximum time to wait for each chunk in seconds, `None` to wait forever
+        :return: Generator of read-only `memoryview`s of the chunks' data in order, each one is only valid until the
+        next one is requested; an empty payload yields nothing
+        :except: `abstract_ipc.TimeoutExpired` if a chunk was not produced within `timeout`, `RuntimeError` if chunks
+        are missing or the producer has aborted the payload, `ValueError` if an item is not a chunk
+        """
+        for _, data in self._get_chunks(timeout):
+            yield data
 
-        if not self._sem_full.acquire():
-            raise RuntimeError("Unable to acquire system semaphore (_sem_full): " + self._sem_full.errorString())
+    def _get_chunks(self, timeout):
+        """
+        Implements `get_stream()`, yielding (total size, data) per chunk (the total size is 0 if unknown).
+        """
+        stream = None
+        offset = 0
+        while True:
+            data = self.begin(timeout)
+            try:
+                flags, number, total_size, position, data = chunked.unpack(data)
+                if stream is None:
+                    if not flags & chunked.FIRST:
+                        continue
+                    stream = number
+                elif number != stream or position != offset or flags & chunked.FIRST:
+                    raise RuntimeError("Chunks of payload " + str(stream) + " are missing.")
+                if flags & chunked.ABORTED:
+                    raise RuntimeError("The producer has aborted payload " + str(stream) + ".")
+                if len(data):
+                    yield total_size, data
+                offset = position + len(data)
+            finally:
+                self.end()
+            if flags & chunked.LAST:
+                return
+
+    def get_large(self, timeout=None):
+        """
+        Gets the next payload put into the shared memory by `ProducerIPC.put_stream()` as a whole, i.e., copies and
+        reassembles its chunks.
+
+        :param timeout: Maximum time to wait for each chunk in seconds, `None` to wait forever
+        :return: `bytearray` with the payload
+        :except: See `get_stream()`
+        """
+        payload = None
+        offset = 0
+        for total_size, data in self._get_chunks(timeout):
+            if payload is None:
+                payload = bytearray(total_size)  # preallocated if the producer knew the size
+            payload[offset:offset + len(data)] = data
+            offset += len(data)
+        return payload if payload is not None else bytearray()
+
+    def get_frame(self, timeout=None):
+        """
+        Gets the next item put into the shared memory by `ProducerIPC.put_frame()` (or `ScopedProducer` with a codec)
+        and decodes it, so the transaction ends before this returns. Delta frames whose previous frame is missing (e.g.
+        dropped by the overflow policy) are skipped until the next keyframe.
+
+        :param timeout: Maximum time to wait for each item in seconds, `None` to wait forever
+        :return: Bytes-like item, only valid until the next call
+        :except: `abstract_ipc.TimeoutExpired` if no item was produced within `timeout`, `RuntimeError` without
+        `encoded=True`, if the shared memory cannot be accessed or the codec is not installed, `ValueError` if an item
+        is not encoded
+        """
+        if self._decoder is None:
+            raise RuntimeError("get_frame() requires encoded=True.")
+        while True:
+            data = self.begin(timeout)
+            try:
+                return self._decoder.decode(data)
+            except frame_codec.MissingReference:
+                if self._diagnostics is not None:
+                    self._diagnostics.event("missing_reference", logging.DEBUG,
+                                            "Skipping a delta frame without its reference frame")
+            finally:
+                self.end()
+
+    def _begin_acquired(self):
+        """
+        Continues `begin()` once a full slot has been acquired (i.e., `_sem_full` was decremented). Errors release
+        `_sem_full` again.
+        """
+        data = self._begin_item()
+        if self._stats is not None:
+            self._stats.begin(memoryview(data).nbytes)
+        return data
+
+    def _begin_item(self):
+        """
+        Implements `_begin_acquired()` depending on the mode.
+        """
+        if self._lock_free:
+            return self._begin_lock_free()
+        if self._broadcast:
+            return self._begin_broadcast()
+        if self._slots:
+            return self._begin_ring()
 
         if not self._shared_memory.attach():
             self._sem_full.release()  # undo
             raise RuntimeError("Unable to attach to shared memory segment: " + self._shared_memory.errorString())
 
-        if not self._shared_memory.lock():
-            err_str = self._shared_memory.errorString()  # may be overwritten by errors in detach()
+        try:
+            self._lock()
+        except RuntimeError:
             self._sem_full.release()  # dito
             self._shared_memory.detach()  # dito
-            raise RuntimeError("Unable to attach to shared memory segment: " + err_str)
+            raise
         self._transaction_started = True
         return self._shared_memory.constData()
 
+    def _adopt_ring(self):
+        """
+        Takes over the ring buffer right after attaching to it: the item a dead consumer was reading is read again and
+        `_sem_full` is resynchronized with the indices (e.g. a restarted consumer has reset it).
+        """
+        self._lock()
+        pid = self._ring.pid("consumer")
+        if pid and pid != self._pid and self._ring.reading and not abstract_ipc.process_alive(pid):
+            self._ring.reading = False
+            if self._diagnostics is not None:
+                self._diagnostics.event("peer_died", logging.WARNING, "Previous consumer has died while reading an "
+                                        "item, reading it again", pid=pid)
+        self._unlock()
+        self._check_ring(self._sem_full)
+
+    def _permits(self):
+        return max(0, self._ring.head - self._ring.tail)
+
+    def _peer_died(self, pid):
+        if self._diagnostics is not None:
+            self._diagnostics.event("peer_died", logging.WARNING, "Producer has died, waiting for a new one", pid=pid)
+
+    def _begin_ring(self):
+        """
+        Implements `begin()` in ring buffer mode after a full slot has been acquired.
+        """
+        if self._ring is None:
+            try:
+                if not self._attach_ring():
+                    raise RuntimeError("Unable to attach to shared memory segment: " +
+                                       self._shared_memory.errorString())
+            except RuntimeError:
+                self._sem_full.release()  # undo
+                raise
+
+        while True:
+            try:
+                self._lock()
+            except RuntimeError:
+                self._sem_full.release()  # dito
+                raise
+            if self._ring.head != self._ring.tail:
+                break
+            # The permit was not backed by an item (e.g. a process has reset the semaphore or exited while operating on
+            # it), so keep it (i.e., correct the count) and wait again:
+            try:
+                self._resync(self._sem_full, 0)
+            finally:
+                self._unlock()
+            if not self._acquire_full(self._remaining()):
+                raise abstract_ipc.TimeoutExpired("No data was produced within the timeout.")
+        try:
+            self._attach_slots()
+        except RuntimeError:
+            self._unlock()
+            self._sem_full.release()  # dito
+            raise
+        self._heartbeat()
+        index = self._ring.tail % self._ring.slot_count
+        length = self._ring.length(index)
+        self._timestamp = self._ring.timestamp(index)
+        self._ring.reading = True  # the producer must not overwrite this item now
+        self._unlock()
+
+        self._transaction_started = True
+        return self._slot_view(index, length, False)
+
+    def _begin_lock_free(self):
+        """
+        Implements `begin()` in lock-free mode after the ring was found non-empty.
+        """
+        index = self._spsc.tail % self._spsc.slot_count
+        offset = self._spsc.slot_offset(index)
+        self._transaction_started = True
+        return memoryview(self._shared_memory.constData())[offset:offset + self._spsc.length(index)]
+
+    def _end_lock_free(self):
+        """
+        Implements `end()` in lock-free mode: hands the slot back to the producer.
+        """
+        if self._spsc.release(self._spsc.tail + 1) and not self._sem_empty.release():
+            raise RuntimeError("Unable to release system semaphore (_sem_empty): " + self._sem_empty.errorString())
+        self._transaction_started = False
+
+    def _register(self, timeout):
+        """
+        Registers this consumer in the broadcast ring, waiting (polling) for the producer to create it.
+
+        :param timeout: Maximum time to wait in seconds, `None` to wait forever
+        :return: `True` on success, `False` if the timeout expired
+        :except: `RuntimeError` if the segment cannot be attached or all consumer entries are in use
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._attach_broadcast():
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        self._lock()
+        index = self._broadcast_ring.register(self._policy)
+        self._unlock()
+        if index is None:
+            raise RuntimeError("All " + str(self._broadcast_ring.max_consumers) + " consumers of the broadcast ring " +
+                               "are in use.")
+        # The producer only releases it after we have set our waiting flag, so creating (resetting) it is fine:
+        self._consumer_semaphore = self._backend.SystemSemaphore(broadcast_ring.semaphore_key(self._id, index), 0,
+                                                                 self._backend.SystemSemaphore.Create)
+        self._consumer_index = index
+        if self._log:
+            logzero.logger.debug("Registered as consumer " + str(index) + " of the broadcast ring.")
+        return True
+
+    def unregister(self):
+        """
+        Removes this consumer from the broadcast ring, i.e., the producer does not wait for it anymore. The next
+        `begin()` registers it again (and continues with the items published from then on).
+        """
+        if self._consumer_index is None:
+            return
+        self._lock()
+        wake_producer = self._broadcast_ring.unregister(self._consumer_index)
+        self._unlock()
+        self._consumer_index = None
+        if wake_producer and not self._sem_empty.release():
+            raise RuntimeError("Unable to release system semaphore (_sem_empty): " + self._sem_empty.errorString())
+
+    def dropped(self):
+        """
+        Returns the number of items skipped since the registration because this consumer was too slow (broadcast mode
+        with `broadcast_ring.DROP` only).
+
+        :return: Number of items
+        """
+        if self._consumer_index is None:
+            return 0
+        self._lock()
+        dropped = self._broadcast_ring.get(self._consumer_index, "dropped")
+        self._unlock()
+        return dropped
+
+    def _acquire_broadcast(self, timeout):
+        """
+        Implements `_acquire_full()` in broadcast mode: waits until an item is available for this consumer.
+        """
+        if self._consumer_index is None and not self._register(timeout):
+            return False
+        while True:
+            self._lock()
+            available = self._broadcast_ring.poll(self._consumer_index)
+            self._unlock()
+            if available:
+                return True
+            # Released by the producer since poll() has set our waiting flag:
+            if not self._acquire(self._consumer_semaphore, timeout):
+                return False
+
+    def _begin_broadcast(self):
+        """
+        Implements `begin()` in broadcast mode once an item is available.
+        """
+        ring = self._broadcast_ring
+        self._lock()
+        self._sequence = ring.start(self._consumer_index)
+        index = self._sequence % ring.slot_count
+        length = ring.length(index)
+        self._unlock()
+
+        offset = ring.slot_offset(index)
+        self._transaction_started = True
+        return memoryview(self._shared_memory.constData())[offset:offset + length]
+
+    def _end_broadcast(self):
+        """
+        Implements `end()` in broadcast mode: advances our cursor (the slot may be reused once all consumers did).
+        """
+        self._lock()
+        wake_producer = self._broadcast_ring.finish(self._consumer_index, self._sequence)
+        self._unlock()
+        if wake_producer and not self._sem_empty.release():
+            raise RuntimeError("Unable to release system semaphore (_sem_empty): " + self._sem_empty.errorString())
+        self._sequence = None
+        self._transaction_started = False
+
+    def _end_ring(self):
+        """
+        Implements `end()` in ring buffer mode: hands the slot back to the producer.
+        """
+        self._lock()
+        self._ring.tail += 1
+        self._ring.reading = False
+        # Released while holding the lock, so the semaphore always matches the indices for whoever holds it:
+        released = self._sem_empty.release()
+        self._unlock()
+        if not released:
+            raise RuntimeError("Unable to release system semaphore (_sem_empty): " + self._sem_empty.errorString())
+        self._transaction_started = False
+
     def end(self):
         """
         Stops reading from shared memory.
         """
         if not self._transaction_started:
             raise RuntimeError("You must call begin() first.")
-        if not self._shared_memory.unlock():
+        if self._stats is not None:
+            self._stats.end(self._timestamp)
+        if self._lock_free:
+            return self._end_lock_free()
+        if self._broadcast:
+            return self._end_broadcast()
+        if self._slots:
+            return self._end_ring()
+        if not self._unlock():
             raise RuntimeError("Unable to unlock shared memory segment: " + self._shared_memory.errorString())
-        if not self._shared_memory.detach() and self.log:
-            logzero.logger.error("Unable to detach shared memory: " + self._shared_memory.errorString())
+        if not self._shared_memory.detach() and self._diagnostics is not None:
+            self._diagnostics.event("detach", logging.ERROR, "Unable to detach shared memory",
+                                    error=self._shared_memory.errorString())
         if not self._sem_empty.release():
             raise RuntimeError("Unable to release system semaphore (_sem_empty): " + self._sem_empty.errorString())
         self._transaction_started = False
@@ -70,16 +493,24 @@ class ConsumerIPC(abstract_ipc.AbstractIPC):
 class ScopedConsumer(object):
     """
     Allows to use an object of ConsumerIPC in combination with Python's "with" statement conveniently.
+
+    If the consumer decodes the items (`encoded=True`), the item is decoded and the transaction ended right away (see
+    `ConsumerIPC.get_frame()`).
     """
-    def __init__(self, consumer_ipc):
+    def __init__(self, consumer_ipc, timeout=None):
         assert isinstance(consumer_ipc, ConsumerIPC)
         self.__con_ipc = consumer_ipc
+        self.__timeout = timeout
         self.__success = False
         self.__data = None
 
     def __enter__(self):
         try:
-            self.__data = self.__con_ipc.begin()
+            if self.__con_ipc._decoder is not None:
+                self.__data = self.__con_ipc.get_frame(self.__timeout)
+                self.__success = True
+                return self
+            self.__data = self.__con_ipc.begin(self.__timeout)
             self.__success = True
         except RuntimeError:
             self.__success = False
@@ -94,6 +525,28 @@ class ScopedConsumer(object):
         """
         return self.__data if self.__success else None
 
+    def view(self):
+        """
+        Returns a read-only view of the shared memory block to read data in place (without copying it).
+
+        :return: `memoryview` of the shared memory (of the current item in ring buffer mode)
+        """
+        if not self.__success:
+            return None
+        return memoryview(self.__data)
+
+    def ndarray(self):
+        """
+        Returns a read-only NumPy array located in the shared memory, written by `ScopedProducer.ndarray()`. Copy it
+        if it is needed after leaving the "with" statement.
+
+        :return: `numpy.ndarray` viewing the shared memory (requires NumPy)
+        :except: `ValueError` if the shared memory does not contain an array
+        """
+        if not self.__success:
+            return None
+        return array_view.read(self.view())
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.__success:
+        if self.__success and self.__con_ipc._decoder is None:
             self.__con_ipc.end()
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import collections
+import threading
+
+import abstract_ipc
+import logzero
+
+
+def _run(stages, data):
+    """
+    Applies the stages of a pipeline to an item (a module-level function, so it can run in a process pool).
+    """
+    for stage in stages:
+        data = stage(data)
+    return data
+
+
+class ConsumerPipeline(object):
+    """
+    Processes the items of a `ConsumerIPC` (e.g. decoding images and scaling or converting them) in a thread or process
+    pool, so the slot of an item is released long before it has been processed and several items are processed in
+    parallel. Results are returned (or passed to `callback`) in the order the items were read, numbered by a sequence
+    number starting at 0. Usage:
+
+        pipeline = ConsumerPipeline(consumer_ipc, decode=read_image, transforms=[scale])
+        for sequence, image in pipeline:
+            ...
+
+    or, e.g. in a GUI reading the items on `AsyncConsumerIPC.available`, call `submit()` for every item and receive the
+    results by `callback`.
+
+    By default, every item is copied out of the shared memory and the transaction ended before `decode` runs. With
+    `copy=False` (thread pool only), `decode` gets a read-only view of the slot instead, which is released as soon as
+    `decode` returns; the next item is read once that happened, so only one slot is held at a time and `decode` must
+    not return anything referencing the view (like `raw_frame.read()` does, use `QImage.copy()`).
+    """
+    def __init__(self, consumer_ipc, decode=None, transforms=(), workers=2, processes=False, copy=True,
+                 max_pending=None, callback=None, log=True):
+        """
+        Creates the pool.
+
+        :param consumer_ipc: `ConsumerIPC` to read the items from; with `encoded=True`, the items are decoded by
+        `ConsumerIPC.get_frame()` in the calling thread (the codecs are not thread-safe) and the result is copied
+        :param decode: Callable turning the item (`bytes`, or a `memoryview` with `copy=False`) into the first result,
+        `None` to keep the `bytes`
+        :param transforms: Callables applied to the result of `decode` one after the other (e.g. scaling), in the same
+        worker
+        :param workers: Number of threads or processes
+        :param processes: `True` to use a process pool (for CPU-bound stages holding the GIL); then `decode` and
+        `transforms` must be picklable (e.g. module-level functions) and so must be their results
+        :param copy: `True` (the default) to copy each item out of the shared memory, `False` to pass a view of the
+        slot to `decode` (see above)
+        :param max_pending: Maximum number of items read ahead by iterating or `get()`, `None` for twice the number of
+        workers
+        :param callback: Optional callable getting (sequence, result, error) for every item in order (`error` being the
+        exception raised by a stage or `None`), called by a worker thread (use a queued Qt signal to get to the GUI
+        thread); `get()` cannot be used then
+        :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+        :except: `ValueError` if `copy=False` is combined with a process pool or an encoded consumer
+        """
+        if not copy and (processes or consumer_ipc._decoder is not None):
+            raise ValueError("copy=False requires a thread pool and a consumer without encoded=True.")
+        import concurrent.futures  # "futures" package in Python 2
+        self._consumer = consumer_ipc
+        self._decode = decode
+        self._stages = ((decode,) if decode is not None else ()) + tuple(transforms)
+        self._copy = copy
+        self._workers = workers
+        self._max_pending = max_pending if max_pending else 2 * workers
+        self._callback = callback
+        self._log = log
+        self._pool = (concurrent.futures.ProcessPoolExecutor if processes else
+                      concurrent.futures.ThreadPoolExecutor)(workers)
+        self._pending = collections.deque()  # (sequence, future) in the order of the items
+        self._pending_lock = threading.Lock()  # guards `_pending` if `callback` is used
+        self._sequence = 0  # sequence number of the next item
+        self._held = None  # set once the slot passed to `decode` has been released (copy=False only)
+
+    def close(self, wait=True):
+        """
+        Shuts the pool down.
+
+        :param wait: `True` to wait until all items read so far have been processed
+        """
+        self._release_held()
+        self._pool.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(exc_type is None)
+        return False
+
+    def pending(self):
+        """
+        Returns the number of items read but not returned (or passed to `callback`) yet.
+        """
+        return len(self._pending)
+
+    def _release_held(self):
+        """
+        Waits until the slot held by `decode` has been released (copy=False only).
+        """
+        if self._held is not None:
+            self._held.wait()
+            self._held = None
+
+    def submit(self, timeout=None):
+        """
+        Reads the next item from the consumer and starts processing it, releasing its slot right away (or, with
+        `copy=False`, once `decode` has returned).
+
+        :param timeout: Maximum time to wait for the item in seconds, `None` to wait forever
+        :return: Sequence number of the item
+        :except: `abstract_ipc.TimeoutExpired` if no item was produced within `timeout`, see `ConsumerIPC.begin()`
+        """
+        self._release_held()
+        consumer = self._consumer
+        if consumer._decoder is not None:
+            future = self._pool.submit(_run, self._stages, bytes(consumer.get_frame(timeout)))
+        elif self._copy:
+            data = consumer.begin(timeout)
+            try:
+                data = memoryview(data).tobytes()
+            finally:
+                consumer.end()
+            future = self._pool.submit(_run, self._stages, data)
+        else:
+            view = memoryview(consumer.begin(timeout))
+            self._held = threading.Event()
+            try:
+                future = self._pool.submit(self._process_held, view, self._held)
+            except Exception:
+                self._held = None
+                consumer.end()
+                raise
+        sequence = self._sequence
+        self._sequence += 1
+        with self._pending_lock:
+            self._pending.append((sequence, future))
+        if self._callback is not None:
+            future.add_done_callback(self._deliver)
+        return sequence
+
+    def _process_held(self, view, released):
+        try:
+            data = self._decode(view) if self._decode is not None else view.tobytes()
+        finally:
+            try:
+                self._consumer.end()
+            finally:
+                released.set()
+        return _run(self._stages[1 if self._decode is not None else 0:], data)
+
+    def _deliver(self, _):
+        """
+        Passes the leading completed results to `callback` (called whenever an item has been processed).
+        """
+        with self._pending_lock:
+            while self._pending and self._pending[0][1].done():
+                sequence, future = self._pending.popleft()
+                error = future.exception()
+                if error is not None and self._log:
+                    logzero.logger.error("Processing item " + str(sequence) + " failed: " + str(error))
+                self._callback(sequence, None if error is not None else future.result(), error)
+
+    def get(self, timeout=None):
+        """
+        Returns the next result, reading further items ahead (up to `max_pending`) while waiting for it.
+
+        :param timeout: Maximum time to wait for the next item in seconds if none is pending, `None` to wait forever
+        :return: Tuple (sequence, result)
+        :except: `abstract_ipc.TimeoutExpired` if no item was produced within `timeout`, any exception raised by a
+        stage for this item, `RuntimeError` if `callback` is used
+        """
+        if self._callback is not None:
+            raise RuntimeError("get() cannot be used with a callback.")
+        while not self._pending or (not self._pending[0][1].done() and len(self._pending) < self._max_pending):
+            try:
+                # Only wait for the consumer if nothing is pending, otherwise take what is available:
+                self.submit(0 if self._pending else timeout)
+            except abstract_ipc.TimeoutExpired:
+                if not self._pending:
+                    raise
+                break
+        sequence, future = self._pending.popleft()
+        return sequence, future.result()
+
+    def __iter__(self):
+        while True:
+            yield self.get()
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import struct
+
+from PyQt5.QtGui import QImage
+from frame_codec import MissingReference
+
+# Layout of an image stored as the difference to the previous one (for mostly static images like screenshots):
+#
+#   [header (HEADER_SIZE bytes)][tile index table (tile count * uint32), padded to 64 bytes][tile data]
+#
+# The scanlines are divided into tiles of `tile rows` rows times `tile bytes` bytes (the tiles at the right and bottom
+# border may be smaller). Only the tiles which changed since the frame `reference` are stored: the table lists their
+# indices (row-major) and the data their bytes, tile by tile and row by row within a tile. A keyframe (flag `KEYFRAME`,
+# no table) stores all scanlines instead, like `raw_frame`. Working on bytes (not pixels) makes this independent of the
+# image format. All header values are stored in little endian order, `format` is the value of `QImage.Format`.
+MAGIC = b"PCDF"
+# magic, width, height, bytes per line, QImage.Format, flags, tile rows, tile bytes, tile count, (padding), frame
+# number, reference frame number
+HEADER_FORMAT = "<4sIIIIIIII4xQQ"
+HEADER_SIZE = 64  # the tile index table starts at a cache line boundary
+KEYFRAME = 0x1
+TILE_ROWS = 32
+TILE_BYTES = 128  # 32 pixels of 32 bit images, a multiple of 4
+DEFAULT_KEYFRAME_INTERVAL = 100  # frames
+
+_HEADER = struct.Struct(HEADER_FORMAT)
+
+
+def _pad(size):
+    return (size + 63) // 64 * 64
+
+
+def _pixels(image, writable):
+    """
+    Returns a NumPy array (height x bytes per line) viewing the scanlines of an image.
+    """
+    import numpy
+    bits = image.bits() if writable else image.constBits()
+    bits.setsize(image.bytesPerLine() * image.height())
+    return numpy.frombuffer(bits, numpy.uint8).reshape(image.height(), image.bytesPerLine())
+
+
+class DeltaEncoder(object):
+    """
+    Encodes the images of a producer as the tiles which changed since the previous image, found by a vectorized
+    comparison (requires NumPy). Usage:
+
+        size = encoder.update(image)
+        with ScopedProducer(producer_ipc, size) as sp:
+            encoder.write(sp.view())
+
+    If an encoded image is not put into the shared memory (e.g. `begin()` failed), call `request_keyframe()`.
+    """
+    def __init__(self, tile_rows=TILE_ROWS, tile_bytes=TILE_BYTES, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL,
+                 max_changed=0.5):
+        """
+        :param tile_rows: Number of rows of a tile
+        :param tile_bytes: Number of bytes per row of a tile, must be a multiple of 4
+        :param keyframe_interval: Number of frames after which a keyframe is sent again, so consumers recover from
+        missed frames; 0 to send keyframes only if required
+        :param max_changed: Fraction of the tiles which may change before a keyframe is sent instead (which is cheaper
+        to decode)
+        """
+        if tile_bytes % 4 or tile_rows <= 0 or tile_bytes <= 0:
+            raise ValueError("tile_bytes must be a positive multiple of 4 and tile_rows positive.")
+        self._tile_rows = tile_rows
+        self._tile_bytes = tile_bytes
+        self._keyframe_interval = keyframe_interval
+        self._max_changed = max_changed
+        self._reference = None  # copy of the scanlines of the previous image (NumPy array)
+        self._geometry = None  # (width, height, bytes per line, format) of `_reference`
+        self._frame = -1  # number of the last frame passed to `update()`
+        self._keyframe = 0  # number of the last keyframe
+        self._tiles = None  # indices of the changed tiles (None for a keyframe)
+        self._columns = 0  # number of tiles per row
+        self._size = 0  # number of bytes of the frame
+
+    def request_keyframe(self):
+        """
+        Makes the next frame a keyframe.
+        """
+        self._reference = None
+
+    def update(self, image):
+        """
+        Compares an image to the previous one and remembers the changed tiles for `write()`.
+
+        :param image: `QImage`
+        :return: Number of bytes needed to store the frame, i.e., what to pass to `ScopedProducer`
+        """
+        import numpy
+        self._frame += 1
+        current = _pixels(image, False)
+        geometry = (image.width(), image.height(), image.bytesPerLine(), int(image.format()))
+        if (self._reference is None or geometry != self._geometry or
+                (self._keyframe_interval and self._frame - self._keyframe >= self._keyframe_interval)):
+            return self._update_keyframe(current, geometry)
+        # QImage's scanlines are 32 bit aligned, so compare words:
+        changed = current.view(numpy.uint32) != self._reference.view(numpy.uint32)
+        changed = numpy.logical_or.reduceat(changed, numpy.arange(0, changed.shape[0], self._tile_rows), axis=0)
+        changed = numpy.logical_or.reduceat(changed, numpy.arange(0, changed.shape[1], self._tile_bytes // 4), axis=1)
+        tiles = numpy.flatnonzero(changed).astype(numpy.uint32)
+        if len(tiles) > self._max_changed * changed.size:
+            return self._update_keyframe(current, geometry)
+        self._tiles = tiles
+        size = 0
+        for y, x in self._tile_rects(tiles, changed.shape[1]):
+            self._reference[y, x] = current[y, x]
+            size += self._reference[y, x].size
+        self._columns = changed.shape[1]
+        self._size = _pad(HEADER_SIZE + 4 * len(tiles)) + size
+        return self._size
+
+    def _update_keyframe(self, current, geometry):
+        self._reference = current.copy()
+        self._geometry = geometry
+        self._keyframe = self._frame
+        self._tiles = None
+        self._size = HEADER_SIZE + current.size
+        return self._size
+
+    def _tile_rects(self, tiles, columns):
+        """
+        Yields the slices (rows, bytes) of tiles given by their indices.
+        """
+        for index in tiles:
+            row, column = divmod(int(index), columns)
+            yield (slice(row * self._tile_rows, (row + 1) * self._tile_rows),
+                   slice(column * self._tile_bytes, (column + 1) * self._tile_bytes))
+
+    def write(self, buf):
+        """
+        Stores the frame of the last call to `update()`.
+
+        :param buf: Writable buffer (e.g. `memoryview`) of at least the size returned by `update()`
+        :except: `ValueError` if `buf` is too small
+        """
+        import numpy
+        buf = memoryview(buf)
+        if len(buf) < self._size:
+            raise ValueError("Shared memory is too small for the frame.")
+        width, height, bytes_per_line, fmt = self._geometry
+        key = self._tiles is None
+        tiles = () if key else self._tiles
+        _HEADER.pack_into(buf, 0, MAGIC, width, height, bytes_per_line, fmt, KEYFRAME if key else 0, self._tile_rows,
+                          self._tile_bytes, len(tiles), self._frame, self._frame if key else self._frame - 1)
+        if key:
+            numpy.frombuffer(buf, numpy.uint8, self._reference.size, HEADER_SIZE)[:] = self._reference.reshape(-1)
+            return
+        offset = _pad(HEADER_SIZE + 4 * len(tiles))
+        buf[HEADER_SIZE:HEADER_SIZE + 4 * len(tiles)] = tiles.astype("<u4").tobytes()
+        for y, x in self._tile_rects(tiles, self._columns):
+            tile = self._reference[y, x]
+            numpy.frombuffer(buf, numpy.uint8, tile.size, offset).reshape(tile.shape)[:] = tile
+            offset += tile.size
+
+
+class DeltaDecoder(object):
+    """
+    Decodes the frames written by `DeltaEncoder` into a retained image, i.e., patches the changed tiles only (requires
+    NumPy).
+    """
+    def __init__(self):
+        self._image = None  # QImage patched by read()
+        self._pixels = None  # NumPy array viewing the scanlines of `_image`
+        self._frame = None  # number of the frame `_image` shows
+
+    def read(self, buf):
+        """
+        Applies a frame to the retained image.
+
+        :param buf: Buffer (e.g. `memoryview`) of the frame, as written by `DeltaEncoder.write()`
+        :return: Tuple (image, frame number) whereby `image` is the retained `QImage`, which is changed by the next
+        call (call `QImage.copy()` to keep it)
+        :except: `ValueError` if `buf` does not contain a frame, `frame_codec.MissingReference` if the previous frame is
+        missing (e.g. it was dropped), so wait for the next keyframe
+        """
+        import numpy
+        buf = memoryview(buf)
+        if len(buf) < HEADER_SIZE:
+            raise ValueError("Shared memory is too small to contain a frame.")
+        (magic, width, height, bytes_per_line, fmt, flags, tile_rows, tile_bytes, count, frame,
+         reference) = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("Shared memory does not contain a valid delta frame.")
+        if flags & KEYFRAME:
+            if len(buf) < HEADER_SIZE + bytes_per_line * height:
+                raise ValueError("Shared memory does not contain a valid delta frame.")
+            if (self._image is None or self._image.width() != width or self._image.height() != height or
+                    int(self._image.format()) != fmt):
+                image = QImage(width, height, QImage.Format(fmt))
+                if image.isNull() or image.bytesPerLine() != bytes_per_line:
+                    raise ValueError("Unable to create an image for the delta frames.")
+                self._image = image
+                self._pixels = _pixels(image, True)
+            self._pixels.reshape(-1)[:] = numpy.frombuffer(buf, numpy.uint8, bytes_per_line * height, HEADER_SIZE)
+        else:
+            if (self._image is None or self._frame != reference or self._image.width() != width or
+                    self._image.height() != height or int(self._image.format()) != fmt):
+                self._frame = None  # wait for the next keyframe
+                raise MissingReference("Delta frame " + str(frame) + " without its reference frame.")
+            offset = _pad(HEADER_SIZE + 4 * count)
+            if len(buf) < offset:
+                raise ValueError("Shared memory does not contain a valid delta frame.")
+            columns = (bytes_per_line + tile_bytes - 1) // tile_bytes
+            for index in numpy.frombuffer(buf, "<u4", count, HEADER_SIZE):
+                row, column = divmod(int(index), columns)
+                tile = self._pixels[row * tile_rows:(row + 1) * tile_rows,
+                                    column * tile_bytes:(column + 1) * tile_bytes]
+                if len(buf) < offset + tile.size:
+                    raise ValueError("Shared memory does not contain a valid delta frame.")
+                tile[:] = numpy.frombuffer(buf, numpy.uint8, tile.size, offset).reshape(tile.shape)
+                offset += tile.size
+        self._frame = frame
+        return self._image, frame
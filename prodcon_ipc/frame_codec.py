@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import struct
+import threading
+import zlib
+
+# Layout of an encoded frame (the data of one item, see the `codec` parameter of `ProducerIPC` and `encoded` of
+# `ConsumerIPC`):
+#
+#   [magic, codec, flags, frame number, reference frame number, raw size, length][encoded data]
+#
+# `codec` tells the consumer how to decode the data, so only the producer chooses one:
+#
+# - NONE: the payload as it is
+# - DELTA: the 64 byte blocks which changed since the previous frame (`reference frame number`), preceded by a bitmap
+#   of these blocks (one bit per block) and followed by the bytes after the last full block. Frames with the flag
+#   `KEYFRAME` contain the whole payload instead. Meant for mostly static frames, requires NumPy on both sides.
+# - ZLIB: `zlib` (always available), LZ4: `lz4.block` (package "lz4"), ZSTD: package "zstandard"
+#
+# All values are stored in little endian order.
+MAGIC = b"PCCF"
+HEADER_FORMAT = "<4sHHQQQQ"  # magic, codec, flags, frame number, reference frame number, raw size, length
+NONE = "none"
+DELTA = "delta"
+ZLIB = "zlib"
+LZ4 = "lz4"
+ZSTD = "zstd"
+CODECS = (NONE, DELTA, ZLIB, LZ4, ZSTD)
+KEYFRAME = 0x1
+BLOCK_SIZE = 64  # granularity of DELTA
+DEFAULT_KEYFRAME_INTERVAL = 100  # frames (DELTA only)
+
+_HEADER = struct.Struct(HEADER_FORMAT)
+HEADER_SIZE = _HEADER.size
+_IDS = dict((codec, index) for index, codec in enumerate(CODECS))
+
+
+class MissingReference(ValueError):
+    """
+    Raised by `Decoder.decode()` for a DELTA frame whose reference frame has not been decoded (e.g. it was dropped). The
+    consumer can continue with the next keyframe.
+    """
+    pass
+
+
+def _import(codec):
+    """
+    Imports the module of a codec.
+
+    :except: `RuntimeError` if it is not installed
+    """
+    try:
+        if codec == DELTA:
+            import numpy
+            return numpy
+        if codec == LZ4:
+            import lz4.block
+            return lz4.block
+        if codec == ZSTD:
+            import zstandard
+            return zstandard
+    except ImportError:
+        raise RuntimeError("The codec " + codec + " requires the package " +
+                           {DELTA: "numpy", LZ4: "lz4", ZSTD: "zstandard"}[codec] + ".")
+    return zlib
+
+
+def available():
+    """
+    Returns the codecs which can be used in this environment.
+
+    :return: Tuple of codec names
+    """
+    codecs = []
+    for codec in CODECS:
+        try:
+            _import(codec)
+            codecs.append(codec)
+        except RuntimeError:
+            pass
+    return tuple(codecs)
+
+
+class Encoder(object):
+    """
+    Encodes the frames of a producer. Pass an instance as `codec` to `ProducerIPC` to choose a compression level or
+    keyframe interval.
+    """
+    def __init__(self, codec=NONE, level=None, keyframe_interval=DEFAULT_KEYFRAME_INTERVAL):
+        """
+        :param codec: `NONE`, `DELTA`, `ZLIB`, `LZ4` or `ZSTD`
+        :param level: Compression level (`ZLIB`, `LZ4` and `ZSTD` only), `None` for a fast default
+        :param keyframe_interval: Number of frames after which `DELTA` sends the whole payload again, so consumers
+        recover from missed frames (e.g. dropped by the overflow policy); 0 to send keyframes only if the size changes
+        :except: `ValueError` if the codec is unknown, `RuntimeError` if it is not installed
+        """
+        if codec not in CODECS:
+            raise ValueError("Unknown codec " + str(codec) + ", use one of " + ", ".join(CODECS) + ".")
+        self.codec = codec
+        self._module = _import(codec) if codec != NONE else None
+        self._level = level
+        self._keyframe_interval = keyframe_interval
+        self._frame = 0  # number of the next frame
+        self._reference = None  # copy of the previous payload (DELTA only)
+        self._keyframe = 0  # number of the last keyframe (DELTA only)
+        self._local = threading.local()  # compressor objects are not thread-safe (ZSTD only)
+
+    def prepare(self, payload, copy=False):
+        """
+        Does the part of encoding a frame which depends on the previous frames (call in order). The returned function
+        does the rest and can be called from any thread, e.g. of a thread pool.
+
+        :param payload: Bytes-like payload
+        :param copy: `True` to copy `payload` (if the function is called after the caller has changed it)
+        :return: Function returning the encoded frame as a list of bytes-like pieces (header first)
+        """
+        frame = self._frame
+        self._frame += 1
+        payload = memoryview(payload).cast("B") if not isinstance(payload, bytes) else payload
+        if self.codec != DELTA:
+            if copy:
+                payload = bytes(payload)
+            return lambda: self._encode(frame, payload)
+        reference = self._reference
+        current = bytes(payload)  # the reference of the next frame
+        key = (reference is None or len(reference) != len(current) or
+               (self._keyframe_interval and frame - self._keyframe >= self._keyframe_interval))
+        if key:
+            self._keyframe = frame
+        self._reference = current
+        return lambda: self._encode_delta(frame, None if key else reference, current)
+
+    def encode(self, payload):
+        """
+        Encodes a frame in this thread.
+
+        :param payload: Bytes-like payload
+        :return: List of bytes-like pieces (header first), see `prepare()`
+        """
+        return self.prepare(payload)()
+
+    @staticmethod
+    def _header(codec, flags, frame, reference, raw_size, data):
+        return _HEADER.pack(MAGIC, _IDS[codec], flags, frame, reference, raw_size, sum(len(piece) for piece in data))
+
+    def _encode(self, frame, payload):
+        if self.codec == NONE:
+            data = [payload]
+        elif self.codec == ZLIB:
+            data = [zlib.compress(payload, 1 if self._level is None else self._level)]
+        elif self.codec == LZ4:
+            data = [self._module.compress(payload, store_size=False,
+                                          **({"compression": self._level, "mode": "high_compression"}
+                                             if self._level else {}))]
+        else:
+            compressor = getattr(self._local, "compressor", None)
+            if compressor is None:
+                compressor = self._module.ZstdCompressor(level=1 if self._level is None else self._level)
+                self._local.compressor = compressor
+            data = [compressor.compress(payload)]
+        return [self._header(self.codec, 0, frame, 0, len(payload), data)] + data
+
+    def _encode_delta(self, frame, reference, current):
+        if reference is None:
+            data = [current]
+            return [self._header(DELTA, KEYFRAME, frame, frame, len(current), data)] + data
+        numpy = self._module
+        full = len(current) // BLOCK_SIZE * BLOCK_SIZE
+        blocks = numpy.frombuffer(current, numpy.uint64, full // 8).reshape(-1, BLOCK_SIZE // 8)
+        changed = (blocks != numpy.frombuffer(reference, numpy.uint64, full // 8).reshape(
+            -1, BLOCK_SIZE // 8)).any(axis=1)
+        data = [numpy.packbits(changed).tobytes(), blocks[changed].tobytes(), current[full:]]
+        return [self._header(DELTA, 0, frame, frame - 1, len(current), data)] + data
+
+
+class Decoder(object):
+    """
+    Decodes the frames of a consumer, the codec of each frame is taken from its header.
+    """
+    def __init__(self):
+        self._modules = {}
+        self._reference = None  # bytearray holding the previous payload (DELTA only)
+        self._frame = None  # frame number of `_reference`
+
+    def decode(self, buf):
+        """
+        Decodes a frame (an empty buffer decodes to an empty payload).
+
+        :param buf: Buffer (e.g. `memoryview`) of the frame, as encoded by `Encoder`
+        :return: Bytes-like payload, which is only valid until the next call (for `DELTA`)
+        :except: `ValueError` if `buf` does not contain a frame, `MissingReference` if the previous frame of a DELTA
+        frame is missing, `RuntimeError` if the codec is not installed
+        """
+        buf = memoryview(buf)
+        if not len(buf):
+            return b""
+        if len(buf) < HEADER_SIZE:
+            raise ValueError("Shared memory does not contain an encoded frame.")
+        magic, codec, flags, frame, reference, raw_size, length = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or codec >= len(CODECS) or HEADER_SIZE + length > len(buf):
+            raise ValueError("Shared memory does not contain an encoded frame.")
+        codec = CODECS[codec]
+        data = buf[HEADER_SIZE:HEADER_SIZE + length]
+        if codec == NONE:
+            return data.tobytes()
+        module = self._modules.get(codec)
+        if module is None:
+            module = _import(codec)
+            self._modules[codec] = module
+        if codec == DELTA:
+            return self._decode_delta(module, flags, frame, reference, raw_size, data)
+        if codec == ZLIB:
+            return zlib.decompress(data)
+        if codec == LZ4:
+            return module.decompress(data, uncompressed_size=raw_size)
+        return module.ZstdDecompressor().decompress(data, max_output_size=raw_size)
+
+    def _decode_delta(self, numpy, flags, frame, reference, raw_size, data):
+        if flags & KEYFRAME:
+            self._reference = bytearray(data)
+        elif self._reference is None or self._frame != reference or len(self._reference) != raw_size:
+            self._frame = None  # wait for the next keyframe
+            raise MissingReference("Delta frame " + str(frame) + " without its reference frame.")
+        else:
+            full = raw_size // BLOCK_SIZE * BLOCK_SIZE
+            count = full // BLOCK_SIZE
+            mask_size = (count + 7) // 8
+            changed = numpy.unpackbits(numpy.frombuffer(data, numpy.uint8, mask_size))[:count].astype(bool)
+            target = numpy.frombuffer(self._reference, numpy.uint8, full).reshape(-1, BLOCK_SIZE)
+            end = mask_size + int(changed.sum()) * BLOCK_SIZE
+            target[changed] = numpy.frombuffer(data, numpy.uint8, end - mask_size, mask_size).reshape(-1, BLOCK_SIZE)
+            self._reference[full:] = data[end:]
+        self._frame = frame
+        return self._reference
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import os
+
+# Backends providing the system resources of `AbstractIPC`, `latest_value` and `shared_struct`:
+#
+# - QT: `QSharedMemory` and `QSystemSemaphore` of `PyQt5.QtCore` (the default)
+# - SYSV: the same System V shared memory and semaphores Qt uses on Unix, accessed using ctypes (see
+#   `sysv_shared_memory` and `sysv_semaphore`), so `PyQt5` is never imported. Processes using different backends can
+#   be connected to each other (including the C++ code), since both use the same names. Linux only.
+#
+# A backend is chosen by the `backend` parameter of the constructors, which defaults to the environment variable
+# `PRODCON_IPC_BACKEND` or else `QT`.
+QT = "qt"
+SYSV = "sysv"
+BACKENDS = (QT, SYSV)
+ENVIRONMENT_VARIABLE = "PRODCON_IPC_BACKEND"
+
+_backends = {}
+
+
+class Backend(object):
+    """
+    Factory of the system resources of one backend.
+
+    `SharedMemory(key)` must provide the part of the `QSharedMemory` interface used by this package (including the
+    error codes like `SharedMemory.NotFound`) and `SystemSemaphore(key, initial_value, mode)` the part of the
+    `QSystemSemaphore` interface (including the modes `SystemSemaphore.Open` and `SystemSemaphore.Create`).
+    """
+    def __init__(self, name, shared_memory, system_semaphore, description):
+        self.name = name
+        self.SharedMemory = shared_memory
+        self.SystemSemaphore = system_semaphore
+        self.description = description
+
+
+def _create(name):
+    if name == QT:
+        import PyQt5.QtCore
+        return Backend(QT, PyQt5.QtCore.QSharedMemory, PyQt5.QtCore.QSystemSemaphore,
+                       "PyQt v" + PyQt5.QtCore.PYQT_VERSION_STR + " and Qt v" + PyQt5.QtCore.QT_VERSION_STR)
+    import sysv_shared_memory
+    if not sysv_shared_memory.is_supported():
+        raise RuntimeError("The " + SYSV + " backend is not supported on this platform.")
+    import sysv_semaphore
+    return Backend(SYSV, sysv_shared_memory.SysVSharedMemory, sysv_semaphore.SysVSemaphore,
+                   "System V shared memory and semaphores (without Qt)")
+
+
+def get(name=None):
+    """
+    Returns a backend, importing its modules on first use.
+
+    :param name: `QT`, `SYSV` or `None` (the default) for the value of the environment variable `PRODCON_IPC_BACKEND`
+    or else `QT`
+    :return: `Backend`
+    :except: `ValueError` if the name is unknown, `RuntimeError` if the backend is not supported on this platform
+    """
+    if name is None:
+        name = os.environ.get(ENVIRONMENT_VARIABLE) or QT
+    if name not in BACKENDS:
+        raise ValueError("Unknown backend " + str(name) + ", use one of " + ", ".join(BACKENDS) + ".")
+    backend = _backends.get(name)
+    if backend is None:
+        backend = _create(name)
+        _backends[name] = backend
+    return backend
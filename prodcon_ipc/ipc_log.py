@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import os
+import time
+
+import logzero
+
+# Diagnostics of `AbstractIPC` (and the classes built on it) about events which may recur for every transaction or
+# while waiting, e.g. resynchronized semaphores, dead peers or segments which had to be recreated. Unlike the messages
+# logged once while setting up, they are
+#
+# - structured: every event has a name, a constant message and fields; the text "message (key=value, ...)" is only
+#   built if the event is emitted, and a callable may receive the events as `dict`s instead of `logzero.logger`,
+# - rate-limited: at most `burst` events of the same name are emitted per `interval` seconds, the number of suppressed
+#   ones is added to the next emitted event of that name (field "suppressed"), and
+# - disabled in hot path mode (`hot_path=True` of `ProducerIPC`/`ConsumerIPC`) unless enabled on demand by
+#   `AbstractIPC.enable_diagnostics()` or the environment variable `PRODCON_IPC_DIAGNOSTICS` (any non-empty value but
+#   "0"), so the transactions don't check or format anything then.
+ENVIRONMENT_VARIABLE = "PRODCON_IPC_DIAGNOSTICS"
+DEFAULT_INTERVAL = 10.0  # seconds
+DEFAULT_BURST = 5  # events per name and interval
+
+
+def requested():
+    """
+    Checks whether the diagnostics are enabled by the environment variable `PRODCON_IPC_DIAGNOSTICS`.
+
+    :return: `True` if so, `False` otherwise
+    """
+    return os.environ.get(ENVIRONMENT_VARIABLE, "0") not in ("", "0")
+
+
+class Diagnostics(object):
+    """
+    Emits the rate-limited events of one producer or consumer (see the description above).
+    """
+    def __init__(self, source, sink=None, interval=DEFAULT_INTERVAL, burst=DEFAULT_BURST):
+        """
+        :param source: Name of the emitter, e.g. the key of the shared memory, added to every event (field "source")
+        :param sink: Callable getting every emitted event as `dict` with the keys "name", "level" (see `logging`),
+        "message", "source", "time" (see `time.time()`) and the fields; `None` (the default) logs them using
+        `logzero.logger` instead
+        :param interval: Length of the rate limiting interval in seconds
+        :param burst: Maximum number of events of the same name per interval
+        """
+        self._source = source
+        self._sink = sink
+        self._interval = interval
+        self._burst = burst
+        self._windows = {}  # name -> [start of the interval, events emitted, events suppressed]
+
+    def event(self, name, level, message, **fields):
+        """
+        Emits an event unless too many events of the same name have been emitted recently.
+
+        :param name: Name of the event (e.g. "resync"), also the unit of rate limiting
+        :param level: Level of the event, e.g. `logging.WARNING`
+        :param message: Constant description of the event
+        :param fields: Values describing this occurrence, e.g. `key=...`
+        :return: `True` if emitted, `False` if suppressed
+        """
+        now = time.time()
+        window = self._windows.get(name)
+        if window is None or now - window[0] >= self._interval:
+            suppressed = window[2] if window is not None else 0
+            window = [now, 0, 0]
+            self._windows[name] = window
+        else:
+            suppressed = 0
+        if window[1] >= self._burst:
+            window[2] += 1
+            return False
+        window[1] += 1
+        if suppressed:
+            fields["suppressed"] = suppressed
+        if self._sink is not None:
+            event = dict(fields, name=name, level=level, message=message, source=self._source, time=now)
+            self._sink(event)
+        else:
+            logzero.logger.log(level, message + " (" + ", ".join(
+                key + "=" + str(value) for key, value in sorted(fields.items())) + ", source=" + self._source + ")")
+        return True
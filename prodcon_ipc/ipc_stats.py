@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import json
+import os
+import time
+
+import latest_value
+import logzero
+
+# Instrumentation of `ProducerIPC`/`ConsumerIPC` (enabled by their `stats` parameter). Durations are measured in
+# nanoseconds and collected in histograms with 8 sub-buckets per power of two (i.e., percentiles are accurate to about
+# 6%), so recording a value is a few integer operations and never allocates memory.
+#
+# A snapshot (see `Stats.snapshot()`) is exported as JSON into a "latest value" channel (see `latest_value`) named
+# `stats_key(key, role)` at most every `EXPORT_INTERVAL` seconds. A monitor process polls it using `StatsMonitor`
+# without ever blocking the producer or the consumer.
+EXPORT_INTERVAL = 0.5
+EXPORT_CAPACITY = 16384  # maximum size of an exported snapshot in bytes
+
+_SUB_BITS = 3
+_SUB_BUCKETS = 1 << _SUB_BITS
+_LINEAR = 2 * _SUB_BUCKETS  # values below are counted exactly
+_BUCKETS = _LINEAR + 64 * _SUB_BUCKETS
+
+try:
+    _monotonic_ns = time.monotonic_ns
+except AttributeError:  # Python < 3.7
+    _monotonic = getattr(time, "monotonic", time.time)
+
+    def _monotonic_ns():
+        return int(_monotonic() * 1e9)
+
+
+def now():
+    """
+    Returns the current time of the monotonic clock in nanoseconds. On Linux, this is `CLOCK_MONOTONIC` which is the
+    same for all processes, so timestamps can be compared across processes (e.g. to compute the end-to-end latency).
+
+    :return: Time in nanoseconds
+    """
+    return _monotonic_ns()
+
+
+def stats_key(key, role):
+    """
+    Returns the name of the shared memory segment a snapshot is exported to by default.
+
+    :param key: Name of the shared memory segment of the producer/consumer
+    :param role: "producer" or "consumer"
+    :return: Name of the segment
+    """
+    return key + "_stats_" + role
+
+
+class Histogram(object):
+    """
+    Histogram of non-negative integers (typically durations in nanoseconds).
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = 0
+        self._buckets = [0] * _BUCKETS
+
+    def add(self, value):
+        """
+        Counts a value.
+
+        :param value: Non-negative integer, negative values are counted as 0 (e.g. caused by clock adjustments)
+        """
+        if value < 0:
+            value = 0
+        if value < _LINEAR:
+            index = value
+        else:
+            shift = value.bit_length() - _SUB_BITS - 1
+            index = _LINEAR + (shift - 1) * _SUB_BUCKETS + (value >> shift) - _SUB_BUCKETS
+        self._buckets[min(index, _BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if value > self.max:
+            self.max = value
+
+    @staticmethod
+    def _bucket_value(index):
+        """
+        Returns the value representing a bucket (the center of its range).
+        """
+        if index < _LINEAR:
+            return index
+        shift = (index - _LINEAR) // _SUB_BUCKETS + 1
+        top = (index - _LINEAR) % _SUB_BUCKETS + _SUB_BUCKETS
+        return (top << shift) + (1 << shift) // 2
+
+    def percentile(self, percent):
+        """
+        Returns the (approximated) value below which `percent` percent of the values are.
+
+        :param percent: Percentage, e.g. 99.9
+        :return: Value, 0 if nothing was counted yet
+        """
+        if not self.count:
+            return 0
+        rank = max(1, int(self.count * percent / 100.0 + 0.5))
+        seen = 0
+        for index, count in enumerate(self._buckets):
+            seen += count
+            if seen >= rank:
+                return min(max(self._bucket_value(index), self.min), self.max)
+        return self.max
+
+    def summary(self, scale=1e-3):
+        """
+        Summarizes the histogram.
+
+        :param scale: Factor applied to all values, the default converts nanoseconds to microseconds
+        :return: `dict` with the keys "count", "mean", "min", "max", "p50", "p99" and "p999"
+        """
+        return {"count": self.count,
+                "mean": self.total * scale / self.count if self.count else 0.0,
+                "min": (self.min or 0) * scale, "max": self.max * scale,
+                "p50": self.percentile(50) * scale, "p99": self.percentile(99) * scale,
+                "p999": self.percentile(99.9) * scale}
+
+
+class Stats(object):
+    """
+    Counters and histograms of the transactions of one producer or consumer:
+
+    - "wait": time blocked on a semaphore
+    - "lock": time the shared memory was locked
+    - "copy": time between `begin()` and `end()`, i.e., writing resp. reading the item
+    - "latency": time from the producer's `begin()` to the consumer's `end()` (consumer in ring buffer mode only)
+    """
+    def __init__(self, role, export_key=None, log=True, backend=None):
+        """
+        :param role: "producer" or "consumer"
+        :param export_key: Name of the shared memory segment to export snapshots to, `None` to not export them
+        :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+        :param backend: Backend providing the shared memory to export to (see `ipc_backend`), `None` for the default
+        """
+        self._role = role
+        self._export_key = export_key
+        self._log = log
+        self._backend = backend
+        self._exporter = None
+        self._exported = 0  # time of the last export
+        self.begin_time = 0  # time the current transaction has been started (returned by `begin()`)
+        self._size = 0
+        self._histograms = {"wait": Histogram(), "lock": Histogram(), "copy": Histogram(), "latency": Histogram()}
+        self.reset()
+
+    def reset(self):
+        """
+        Resets all counters and histograms.
+        """
+        self._start = now()
+        self.transactions = 0
+        self.bytes = 0
+        for histogram in self._histograms.values():
+            histogram.reset()
+
+    def add_wait(self, duration):
+        self._histograms["wait"].add(duration)
+
+    def add_lock(self, duration):
+        self._histograms["lock"].add(duration)
+
+    def begin(self, size):
+        """
+        Records that a transaction of `size` bytes has been started.
+        """
+        self.begin_time = now()
+        self._size = size
+
+    def end(self, timestamp=0):
+        """
+        Records that the current transaction has been finished and exports a snapshot if due.
+
+        :param timestamp: Time the producer has started the item (see `now()`), 0 if unknown
+        """
+        end_time = now()
+        self._histograms["copy"].add(end_time - self.begin_time)
+        if timestamp:
+            self._histograms["latency"].add(end_time - timestamp)
+        self.transactions += 1
+        self.bytes += self._size
+        if self._export_key is not None and end_time - self._exported >= EXPORT_INTERVAL * 1e9:
+            self._exported = end_time
+            self.export()
+
+    def snapshot(self):
+        """
+        Returns the current values. Durations are given in microseconds.
+
+        :return: `dict` with the keys "role", "pid", "elapsed" (seconds since the last reset), "transactions",
+        "bytes", "transactions_per_second", "bytes_per_second" and "wait", "lock", "copy", "latency" (see
+        `Histogram.summary()`)
+        """
+        elapsed = (now() - self._start) * 1e-9
+        snapshot = {"role": self._role, "pid": os.getpid(), "elapsed": elapsed, "transactions": self.transactions,
+                    "bytes": self.bytes,
+                    "transactions_per_second": self.transactions / elapsed if elapsed > 0 else 0.0,
+                    "bytes_per_second": self.bytes / elapsed if elapsed > 0 else 0.0}
+        for name, histogram in self._histograms.items():
+            snapshot[name] = histogram.summary()
+        return snapshot
+
+    def export(self):
+        """
+        Publishes a snapshot into the shared stats segment (creating it if required).
+        """
+        if self._exporter is None:
+            self._exporter = latest_value.LatestValueProducer(self._export_key, EXPORT_CAPACITY, log=self._log,
+                                                              backend=self._backend)
+        data = json.dumps(self.snapshot(), sort_keys=True).encode("utf-8")
+        if len(data) <= EXPORT_CAPACITY:
+            self._exporter.publish(data)
+        elif self._log:
+            logzero.logger.warn("Stats snapshot exceeds " + str(EXPORT_CAPACITY) + " bytes, not exported.")
+
+
+class StatsMonitor(object):
+    """
+    Polls the snapshots exported by a producer or consumer (e.g. in a separate monitoring process).
+    """
+    def __init__(self, key, backend=None):
+        """
+        :param key: Name of the shared stats segment, see `stats_key()`
+        :param backend: Backend providing the shared memory (see `ipc_backend`), `None` for the default
+        """
+        self._consumer = latest_value.LatestValueConsumer(key, log=False, backend=backend)
+        self._sequence = 0
+
+    def poll(self):
+        """
+        Returns the latest snapshot if a new one was exported since the last call.
+
+        :return: `dict` (see `Stats.snapshot()`) or `None`
+        """
+        data, self._sequence = self._consumer.read(self._sequence)
+        if data is None:
+            return None
+        return json.loads(data.decode("utf-8"))
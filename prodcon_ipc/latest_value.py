@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import ctypes
+import struct
+import time
+
+import abstract_ipc
+import ipc_backend
+import logzero
+import spsc_ring
+
+# Layout of a shared memory segment holding the latest value only (must match `src/prodcon_ipc/latest_value.h`):
+#
+#   offset   0: magic, version, header size, capacity (maximum number of bytes of a value)
+#   offset  64: sequence (uint64), length of the value in bytes (uint64)
+#   offset 128: value
+#
+# The producer overwrites the value under a sequence lock: it increments the sequence (odd: write in progress), writes
+# length and value and increments the sequence again (even: value complete). A reader copies the value and retries if
+# the sequence was odd or has changed meanwhile, i.e., readers never block the producer and any number of readers (in
+# Python or C++) can read the same value. There must be only one producer. The sequence divided by 2 is the number of
+# values published so far. If writing a value fails (an exception in `LatestValueProducer.write()`), the producer sets
+# the length to `INVALID_LENGTH` before incrementing the sequence, so readers get no value instead of a torn one until
+# the next value is published.
+MAGIC = b"PCLV"
+VERSION = 1
+ALIGNMENT = spsc_ring.ALIGNMENT
+HEADER_FORMAT = "<4sHHI"  # magic, version, header size, capacity
+HEADER_SIZE = 2 * ALIGNMENT
+INVALID_LENGTH = 2 ** 64 - 1  # length of a value whose write has failed
+
+_HEADER = struct.Struct(HEADER_FORMAT)
+_SEQUENCE_OFFSET = ALIGNMENT
+_LENGTH_OFFSET = ALIGNMENT + 8
+
+
+def _map(shared_memory):
+    """
+    Returns (memoryview, sequence, length) of the segment whereby `sequence` and `length` are ctypes integers.
+    """
+    buf = memoryview(shared_memory.data())
+    return buf, ctypes.c_uint64.from_buffer(buf, _SEQUENCE_OFFSET), ctypes.c_uint64.from_buffer(buf, _LENGTH_OFFSET)
+
+
+class LatestValueProducer(object):
+    """
+    Publishes values (e.g. frames of a live preview) to any number of `LatestValueConsumer`s. Each value replaces the
+    previous one, publishing never blocks (see the layout description above).
+    """
+    def __init__(self, id, capacity, key_file_path=None, log=True, backend=None):
+        """
+        Creates the shared memory segment.
+
+        :param id: Unique system-wide unique name (str) of shared memory
+        :param capacity: Maximum number of bytes of a value
+        :param key_file_path: Optional file path to a file typically named "shared_memory.key" whose first line is used
+        as the unique ID/name of the shared memory IF this file exists (see `ProducerIPC`)
+        :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+        :param backend: Backend providing the shared memory (see `ipc_backend`), `None` for the default
+        :except: `RuntimeError` when the shared memory cannot be created
+        """
+        self._log = log
+        file_key = abstract_ipc.load_key(key_file_path, log)
+        self._backend = ipc_backend.get(backend)
+        self._shared_memory = self._backend.SharedMemory(file_key if file_key else str(id))
+        if not self._shared_memory.create(HEADER_SIZE + capacity):
+            # Try to recover from a previous crash (see ProducerIPC):
+            self._shared_memory.attach()
+            self._shared_memory.detach()
+            if not self._shared_memory.create(HEADER_SIZE + capacity):
+                raise RuntimeError("Unable to create or recover shared memory segment: " +
+                                   self._shared_memory.errorString())
+        self._buf, self._sequence, self._length = _map(self._shared_memory)
+        self._capacity = capacity
+        abstract_ipc.lock(self._shared_memory)
+        _HEADER.pack_into(self._buf, 0, MAGIC, VERSION, HEADER_SIZE, capacity)
+        self._sequence.value = 0
+        self._length.value = 0
+        self._shared_memory.unlock()
+        if self._log:
+            logzero.logger.debug("Created latest value channel " + self._shared_memory.key() + " with " +
+                                 str(capacity) + " bytes.")
+
+    def __del__(self):
+        if hasattr(self, "_shared_memory"):
+            self._shared_memory.detach()
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def publish(self, data):
+        """
+        Replaces the value (one copy into the shared memory).
+
+        :param data: Bytes-like object of at most `capacity` bytes
+        :return: Sequence number of the value (see `LatestValueConsumer.read()`)
+        :except: `ValueError` if `data` is too large
+        """
+        data = memoryview(data)
+        if data.nbytes > self._capacity:
+            raise ValueError("Value of " + str(data.nbytes) + " bytes exceeds the capacity of " +
+                             str(self._capacity) + " bytes.")
+        with self.write(data.nbytes) as buf:
+            buf[:] = data.cast("B") if hasattr(data, "cast") else data
+        return self._sequence.value
+
+    def write(self, size):
+        """
+        Writes the value in place, e.g. `with producer.write(size) as buf: ...` whereby `buf` is a writable
+        `memoryview` of `size` bytes. Readers retry until the "with" statement has been left. If it is left by an
+        exception, the previous value is lost (it may have been overwritten partially) and readers get no value until
+        the next one is published.
+
+        :param size: Number of bytes of the value
+        :return: Context manager
+        :except: `ValueError` if `size` exceeds the capacity
+        """
+        if size > self._capacity:
+            raise ValueError("Value of " + str(size) + " bytes exceeds the capacity of " + str(self._capacity) +
+                             " bytes.")
+        return _Write(self, size)
+
+
+class _Write(object):
+    """
+    Context manager returned by `LatestValueProducer.write()`.
+    """
+    def __init__(self, producer, size):
+        self._producer = producer
+        self._size = size
+
+    def __enter__(self):
+        producer = self._producer
+        producer._sequence.value += 1  # odd: readers retry
+        spsc_ring.fence()
+        producer._length.value = self._size
+        return producer._buf[HEADER_SIZE:HEADER_SIZE + self._size]
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self._producer._length.value = INVALID_LENGTH  # never let readers accept a partially written value
+        spsc_ring.fence()
+        self._producer._sequence.value += 1  # even: complete
+        return False
+
+
+class LatestValueConsumer(object):
+    """
+    Reads the latest value published by a `LatestValueProducer` without blocking it.
+    """
+    def __init__(self, id, key_file_path=None, log=True, backend=None):
+        """
+        Creates the shared memory reference, it is attached by the first read.
+
+        :param id: Unique system-wide unique name (str) of shared memory
+        :param key_file_path: Optional file path to a file typically named "shared_memory.key" whose first line is used
+        as the unique ID/name of the shared memory IF this file exists (see `ConsumerIPC`)
+        :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+        :param backend: Backend providing the shared memory (see `ipc_backend`), `None` for the default
+        """
+        self._log = log
+        file_key = abstract_ipc.load_key(key_file_path, log)
+        self._backend = ipc_backend.get(backend)
+        self._shared_memory = self._backend.SharedMemory(file_key if file_key else str(id))
+        self._buf = None
+
+    def __del__(self):
+        if hasattr(self, "_shared_memory"):
+            self._shared_memory.detach()
+
+    def _attach(self):
+        """
+        Attaches to the shared memory if not done yet.
+
+        :return: `True` on success, `False` if the producer has not created the segment yet
+        :except: `RuntimeError` if the segment doesn't contain a latest value channel
+        """
+        if self._buf is not None:
+            return True
+        if not self._shared_memory.attach():
+            if self._shared_memory.error() == self._backend.SharedMemory.NotFound:
+                return False
+            raise RuntimeError("Unable to attach to shared memory segment: " + self._shared_memory.errorString())
+        buf, sequence, length = _map(self._shared_memory)
+        magic, version, _, _ = _HEADER.unpack_from(buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self._shared_memory.detach()
+            raise RuntimeError("Shared memory segment does not contain a latest value channel.")
+        self._buf, self._sequence, self._length = buf, sequence, length
+        return True
+
+    def sequence(self):
+        """
+        Returns the sequence number of the latest value (without reading it), 0 if nothing was published yet.
+        """
+        if not self._attach():
+            return 0
+        return self._sequence.value & ~1
+
+    def view(self):
+        """
+        Returns the latest value without copying it. The producer may overwrite it anytime, so call `is_valid()` once
+        done with it: if that returns `False`, the data might have been torn and must be discarded (read again).
+
+        :return: Tuple (view, sequence) whereby `view` is a read-only `memoryview` (`None` if nothing was published
+        yet or writing the latest value has failed) and `sequence` the sequence number of the value
+        """
+        while True:
+            if not self._attach():
+                return None, 0
+            sequence = self._sequence.value
+            if sequence & 1:
+                time.sleep(0)  # write in progress, let the producer continue
+                continue
+            spsc_ring.fence()
+            if sequence == 0:
+                return None, 0
+            length = self._length.value
+            if length == INVALID_LENGTH:
+                return None, sequence
+            view = self._buf[HEADER_SIZE:HEADER_SIZE + length]
+            if hasattr(view, "toreadonly"):  # Python >= 3.8
+                view = view.toreadonly()
+            return view, sequence
+
+    def is_valid(self, sequence):
+        """
+        Checks whether the value returned by `view()` has not been overwritten meanwhile.
+
+        :param sequence: Sequence number returned by `view()`
+        :return: `True` if the data read from the view is consistent, `False` otherwise
+        """
+        spsc_ring.fence()
+        return self._sequence.value == sequence
+
+    def read(self, newer_than=0):
+        """
+        Copies the latest value out of the shared memory (retrying on torn reads).
+
+        :param newer_than: Only return a value if its sequence number is greater than this (e.g. the one returned by
+        the previous call), 0 to return any value
+        :return: Tuple (data, sequence) whereby `data` is a `bytes` object or `None` if no (newer) valid value was
+        published yet and `sequence` the sequence number of `data` (or `newer_than` if `data` is `None`)
+        """
+        while True:
+            view, sequence = self.view()
+            if view is None or sequence <= newer_than:
+                return None, newer_than
+            data = view.tobytes()
+            if self.is_valid(sequence):
+                return data, sequence
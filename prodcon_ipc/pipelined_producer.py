@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import collections
+
+import logzero
+
+
+class PipelinedProducer(object):
+    """
+    Puts items into a `ProducerIPC` in stages which overlap: while item k is rendered straight into its slot (and, in
+    ring buffer mode, the items before it are read by the consumer), `prepare` already runs for the items after it in a
+    thread pool (e.g. loading and decoding the source image, which releases the GIL). Each item is written by `render`
+    into the slot reserved for it, without an intermediate copy, and published by a single `end()`. Usage:
+
+        def render(source, data, sequence):
+            frame = raw_frame.image(data, source.width(), source.height(), QImage.Format_RGB32, sequence)
+            painter = QPainter(frame)
+            painter.drawImage(0, 0, source)
+            ...  # overlay
+            painter.end()
+
+        with PipelinedProducer(producer_ipc, prepare=QImage, render=render,
+                               size=lambda source: raw_frame.required_size(source.width(), source.height(),
+                                                                           QImage.Format_RGB32)) as pipeline:
+            for path in paths:
+                pipeline.put(path)
+
+    The next slot can only be reserved while the consumer reads the previous item if the producer has a ring buffer
+    (`slots` >= 2); without one, `put()` waits until the previous item has been read.
+    """
+    def __init__(self, producer_ipc, render, size, prepare=None, workers=1, timeout=None, log=True):
+        """
+        Creates the pool.
+
+        :param producer_ipc: `ProducerIPC` to put the items into (without a codec, the items are written in place)
+        :param render: Callable getting (prepared, data, sequence) which writes an item into `data`, a writable
+        `memoryview` of its slot of exactly the reserved size (see `size`); `sequence` numbers the items starting at 0
+        :param size: Number of bytes to reserve per item, or a callable returning it for a prepared item
+        :param prepare: Callable turning the item passed to `put()` into what `render` gets, run in the thread pool;
+        `None` to pass the item as it is
+        :param workers: Number of threads preparing items, i.e., the number of items prepared ahead of the one rendered
+        :param timeout: Maximum time to wait for a free slot in seconds, see `ProducerIPC.begin()`
+        :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+        :except: `ValueError` if the producer has a codec
+        """
+        if producer_ipc._encoder is not None:
+            raise ValueError("A producer with a codec cannot be rendered into, use ProducerIPC.put_frame() instead.")
+        import concurrent.futures  # "futures" package in Python 2
+        self._producer = producer_ipc
+        self._render = render
+        self._size = size
+        self._prepare = prepare
+        self._workers = workers
+        self._timeout = timeout
+        self._log = log
+        self._pool = concurrent.futures.ThreadPoolExecutor(workers) if prepare is not None else None
+        self._pending = collections.deque()  # futures of the items being prepared (oldest first)
+        self._sequence = 0  # sequence number of the next item rendered
+
+    def close(self, wait=True):
+        """
+        Shuts the pool down.
+
+        :param wait: `True` to put the items passed to `put()` so far first (see `flush()`), `False` to discard them
+        """
+        try:
+            if wait:
+                self.flush()
+        finally:
+            if self._pool is not None:
+                for future in self._pending:
+                    future.cancel()
+                self._pending.clear()
+                self._pool.shutdown(wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(exc_type is None)
+        return False
+
+    def pending(self):
+        """
+        Returns the number of items passed to `put()` but not put into the shared memory yet.
+        """
+        return len(self._pending)
+
+    def put(self, item):
+        """
+        Starts preparing an item and puts the oldest prepared items into the shared memory as long as more than
+        `workers` items are pending, so call `flush()` (or `close()`) at the end.
+
+        :param item: Item passed to `prepare`
+        :return: Sequence number of the item
+        :except: Any exception raised by `prepare` or `render` for an earlier item (or this one without `prepare`; the
+        slot of an item `render` has failed on is given back unpublished, see `ProducerIPC.abort()`), `RuntimeError` if
+        an item exceeds the slot size, see `ProducerIPC.begin()`
+        """
+        sequence = self._sequence + len(self._pending)
+        if self._pool is None:
+            self._publish(item)
+            return sequence
+        self._pending.append(self._pool.submit(self._prepare, item))
+        while len(self._pending) > self._workers:
+            self._publish(self._pending.popleft().result())
+        return sequence
+
+    def flush(self):
+        """
+        Waits until all items passed to `put()` so far have been prepared and puts them into the shared memory.
+
+        :except: See `put()`
+        """
+        while self._pending:
+            self._publish(self._pending.popleft().result())
+
+    def _publish(self, prepared):
+        """
+        Reserves a slot, lets `render` write the item into it and publishes it (or gives the slot back if that fails).
+        """
+        size = self._size(prepared) if callable(self._size) else self._size
+        avail_size, data = self._producer.begin(size, self._timeout)
+        sequence = self._sequence
+        self._sequence += 1
+        try:
+            if avail_size < size:
+                raise RuntimeError("Item of " + str(size) + " bytes exceeds the slot size of " + str(avail_size) +
+                                   " bytes.")
+            self._render(prepared, memoryview(data)[:size], sequence)
+        except BaseException as e:
+            if self._log:
+                logzero.logger.error("Rendering item " + str(sequence) + " failed: " + str(e))
+            self._producer.abort()
+            raise
+        self._producer.end()
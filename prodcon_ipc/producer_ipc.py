@@ -4,7 +4,24 @@
 # This code is licensed under the BSD 3-Clause license (see LICENSE for details).
 
 import abstract_ipc
+import array_view
+import batch
+import broadcast_ring
+import chunked
+import collections
+import frame_codec
+import ipc_backend
+import logging
 import logzero
+import ring_buffer
+import segment_memory
+import spsc_ring
+import time
+
+# Overflow policies, i.e., what `ProducerIPC.begin()` does if no slot becomes free within its timeout:
+BLOCK = 0  # raise `abstract_ipc.TimeoutExpired` (waits forever without a timeout)
+DROP_NEWEST = 1  # discard the new item: `begin()` returns scratch memory which `end()` throws away
+OVERWRITE_OLDEST = 2  # discard the oldest item the consumer has not started reading yet and reuse its slot
 
 
 class ProducerIPC(abstract_ipc.AbstractIPC):
@@ -14,8 +31,37 @@ class ProducerIPC(abstract_ipc.AbstractIPC):
 
     Basically, to put data into the shared memory, call `begin()` with the amount of memory your data needs. You can
     then store the data under the provided `data` attribute. Afterwards, call `end()` to complete the transaction.
+
+    In ring buffer mode (`slots` given), the shared memory is created only once and holds `slots` items of up to
+    `slot_size` bytes each, so the producer can run ahead of the consumer by up to `slots` items. Both sides stay
+    attached across transactions; if an item exceeds `slot_size`, the slots are reallocated (see `ring_buffer`). Use
+    `slots=1` to keep the semantics of a single item but avoid creating the shared memory on every transaction.
+
+    In lock-free mode (`lock_free=True`, with exactly one consumer), the shared memory is not locked at all and the
+    semaphores are only used if the ring is full (see `spsc_ring`); the slots are not reallocated then.
+
+    In broadcast mode (`max_consumers` given), every item is read by all registered consumers (up to `max_consumers`)
+    and a slot is only reused once all of them have read it or skipped it (see `broadcast_ring`); the slots are not
+    reallocated then either.
+
+    If the consumer is too slow (or has died), the overflow policy decides what happens once the timeout of `begin()`
+    has expired: raise `abstract_ipc.TimeoutExpired` (`BLOCK`), discard the new item (`DROP_NEWEST`) or discard the
+    oldest one (`OVERWRITE_OLDEST`). This way, a producer can keep its frame budget under backpressure.
+
+    For large items, the pages of the segments can be placed up front (see `segment_memory`): backed by huge pages,
+    bound to a NUMA node and prefaulted, so the transactions neither page fault nor miss the TLB as often.
+
+    With a codec (see `frame_codec`), `put_frame()` and `ScopedProducer` encode every item (e.g. compress it or send only
+    what changed since the previous one), optionally in a thread pool overlapping with producing the next item.
+
+    In ring buffer mode, both sides record their process ID and a heartbeat in the header. While waiting for a free slot,
+    the producer notices if the consumer has died (see `peer_alive()`), so the item it was reading is delivered again to
+    the next consumer, and resynchronizes `_sem_empty` with the indices if it has lost permits. A producer started while
+    the segment still exists (the consumer is attached to it) takes over the ring buffer of a dead producer.
     """
-    def __init__(self, id, key_file_path=None, log=True):
+    def __init__(self, id, key_file_path=None, log=True, slots=None, slot_size=0, grow=True, lock_free=False,
+                 max_consumers=0, overflow=BLOCK, stats=False, backend=None, huge_pages=None, prefault=False,
+                 numa_node=None, codec=None, codec_threads=0, peer_timeout=None, hot_path=False):
         """
         Creates the shared memory reference and the internal semaphores.
 
@@ -25,55 +71,545 @@ class ProducerIPC(abstract_ipc.AbstractIPC):
         as the unique ID/name of the shared memory IF this file exists, can be empty (the default) which then uses `id`
         (first parameter)
         :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+        :param slots: Number of slots of the ring buffer, `None` (the default) to store a single item only (without
+        any header, compatible to consumers not using the ring buffer mode)
+        :param slot_size: Initial maximum number of bytes per slot (ring buffer mode only)
+        :param grow: `True` to reallocate the slots if an item exceeds their size, `False` to return less memory than
+        desired in `begin()` then (ring buffer mode only)
+        :param lock_free: `True` to use the lock-free single-producer/single-consumer ring (requires `slots` and a
+        positive `slot_size`, `grow` is ignored)
+        :param max_consumers: Maximum number of consumers to enable the broadcast mode (requires `slots` and a positive
+        `slot_size`, `grow` is ignored), 0 (the default) to deliver every item to one consumer only
+        :param overflow: Overflow policy: `BLOCK` (the default), `DROP_NEWEST` or `OVERWRITE_OLDEST` (not supported in
+        lock-free and broadcast mode, see `broadcast_ring.DROP` for the latter)
+        :param stats: `True` to collect statistics of the transactions (see `stats()`) and export them to a shared
+        memory segment named `ipc_stats.stats_key(key, "producer")`, a `str` to export them to this key instead; in
+        ring buffer mode, the start time of each item is also stored for measuring the latency at the consumer
+        :param backend: Backend providing shared memory and semaphores (see `ipc_backend`), `None` (the default) for Qt
+        unless overridden by the environment variable `PRODCON_IPC_BACKEND`
+        :param huge_pages: `segment_memory.HUGETLB` to allocate the segments from the pool of huge pages (requires the
+        System V backend), `segment_memory.THP` to advise transparent huge pages or `None` (the default) for normal
+        pages
+        :param prefault: `True` to allocate all pages of a segment when creating it, `False` (the default) to allocate
+        them on first access
+        :param numa_node: Index of the NUMA node to allocate the pages on, `None` (the default) for the kernel's policy
+        :param codec: Codec of the items put by `put_frame()` and `ScopedProducer`: a name like `frame_codec.LZ4` or a
+        `frame_codec.Encoder`, `None` (the default) to store them as they are (without the header of `frame_codec`);
+        the consumer needs `encoded=True` then
+        :param codec_threads: Number of threads encoding items in parallel to the caller, 0 (the default) encodes them
+        in `put_frame()`
+        :param peer_timeout: Seconds after which a consumer without a heartbeat counts as dead even if its process still
+        exists (ring buffer mode only; it beats whenever it starts reading or waits), `None` (the default) to only check
+        whether its process exists
+        :param hot_path: `True` to not log anything per transaction (e.g. recreating the segment without slots) or while
+        waiting unless enabled on demand (see `AbstractIPC.enable_diagnostics()` and `ipc_log`), `False` (the default)
+        to log these events rate-limited if `log` is `True`
         """
-        abstract_ipc.AbstractIPC.__init__(self, id, key_file_path, log)
+        abstract_ipc.AbstractIPC.__init__(self, id, key_file_path, log, slots, lock_free, max_consumers > 0, backend,
+                                          hot_path)
+        if huge_pages not in (None,) + segment_memory.HUGE_PAGES:
+            raise ValueError("Unknown huge_pages " + str(huge_pages) + ", use one of " +
+                             ", ".join(segment_memory.HUGE_PAGES) + ".")
+        if huge_pages == segment_memory.HUGETLB and self._backend.name != ipc_backend.SYSV:
+            raise ValueError("huge_pages=" + segment_memory.HUGETLB + " requires the " + ipc_backend.SYSV +
+                             " backend.")
+        self._huge_pages = huge_pages
+        self._prefault = prefault
+        self._numa_node = numa_node
+        self._role = "producer"
+        self._peer_timeout = peer_timeout
+        if (lock_free or max_consumers > 0) and slot_size <= 0:
+            raise ValueError("A positive slot_size is required in lock-free and broadcast mode.")
+        if overflow == OVERWRITE_OLDEST and (lock_free or max_consumers > 0):
+            raise ValueError("OVERWRITE_OLDEST is not supported in lock-free and broadcast mode.")
+        self._overflow = overflow
+        self._dropped = 0  # number of items discarded by the overflow policy
+        self._scratch = bytearray()  # memory for items discarded by DROP_NEWEST
+        self._discarding = False  # True if the current transaction writes into _scratch
+        if stats:
+            self._enable_stats(stats, "producer")
+        self._slot_size = slot_size
+        self._max_consumers = max_consumers
+        self._consumer_semaphores = {}  # QSystemSemaphore per consumer index (broadcast mode only)
+        self._grow = grow
+        self._reserved = None  # (slot index, size) of the current transaction (ring buffer mode only)
+        self._held_permits = 0  # permits of _sem_empty held while reallocating the slots (ring buffer mode only)
+        self._head = 0  # next sequence number to publish (lock-free mode only)
+        self._tail = 0  # last tail seen, avoids reading the consumer's cache line if not full (lock-free mode only)
+        self._streams = 0  # number of payloads put by put_stream()
+        self._encoder = None
+        if codec is not None:
+            self._encoder = codec if isinstance(codec, frame_codec.Encoder) else frame_codec.Encoder(codec)
+        self._codec_threads = codec_threads
+        self._pool = None  # encodes the items if codec_threads > 0
+        self._encoding = collections.deque()  # futures of the encoded items not put yet (oldest first)
+        self._frame = bytearray()  # memory ScopedProducer lets the caller write an item to before encoding it
+        if self._encoder is not None and codec_threads > 0:
+            import concurrent.futures  # "futures" package in Python 2
+            self._pool = concurrent.futures.ThreadPoolExecutor(codec_threads)
 
     def __del__(self):
         # VERY IMPORTANT: ensure to call unlock() if not needed anymore AND to
         # detach from the memory before exiting. Otherwise, the shmem is somewhat locked and
         # starting the application again will fail to create / access the shmem.
+        if getattr(self, "_pool", None) is not None:
+            self._pool.shutdown(False)
         self._shared_memory.detach()
+        if self._slot_memory is not None:
+            self._slot_memory.detach()
 
-    def begin(self, desired_memory_size):
+    def begin(self, desired_memory_size, timeout=None):
         """
         Begins "producing" data for the memory, i.e., starts a transaction on the shared memory block. After writing to
         the memory, call `end()` but only do this if `begin()` succeeded previously.
 
         :param desired_memory_size: Amount of desired memory in bytes
+        :param timeout: Maximum time to wait for a free slot in seconds before applying the overflow policy; `None`
+                (the default) waits forever with `BLOCK` and does not wait at all with the other policies
         :return: a tuple (size, data) whereby `size` denotes the available shared memory size in bytes and `data` is
-                the allocated memory; `size` MAY be <= `desired_memory_size` so ensure to only write up to `size` bytes
+                the allocated memory; `size` MAY be <= `desired_memory_size` so ensure to only write up to `size` bytes;
+                in ring buffer mode, `data` is a `memoryview` of exactly `size` bytes (the reserved slot)
         :except: `RuntimeError` when the shared memory cannot be created / accessed (don't call `end()` then) or if a
-                call to `end()` is missing
+                call to `end()` is missing; `abstract_ipc.TimeoutExpired` if no slot became free within `timeout` and
+                the overflow policy is `BLOCK` (or the consumer is reading the only item that could be overwritten)
         """
         if self._transaction_started:
             raise RuntimeError("You must call end() first, cannot start a second transaction.")
+        if timeout is None and self._overflow != BLOCK:
+            timeout = 0
+        try:
+            if self._lock_free:
+                size, data = self._begin_lock_free(desired_memory_size, timeout)
+            elif self._broadcast:
+                size, data = self._begin_broadcast(desired_memory_size, timeout)
+            elif self._slots:
+                size, data = self._begin_ring(desired_memory_size, timeout)
+            else:
+                size, data = self._begin_single(desired_memory_size, timeout)
+        except abstract_ipc.TimeoutExpired:
+            if self._overflow != DROP_NEWEST:
+                raise
+            return self._begin_discarded(desired_memory_size)
+        if self._stats is not None:
+            self._stats.begin(size)
+        return size, data
+
+    def dropped(self):
+        """
+        Returns the number of items discarded by the overflow policy so far (the new ones with `DROP_NEWEST`, the old
+        ones with `OVERWRITE_OLDEST`).
+
+        :return: Number of items
+        """
+        return self._dropped
+
+    def _begin_single(self, desired_memory_size, timeout):
+        """
+        Implements `begin()` without slots (the original layout holding exactly one item).
+        """
+        # Producer-consumer sync: we are the producer here, so wait for a free slot. This must come first since detaching
+        # deletes the segment of the previous item if the consumer has not attached to it yet:
+        acquired = self._acquire_empty(timeout)
+
         if self._shared_memory.isAttached():
             self._shared_memory.detach()
 
+        try:
+            self._create(desired_memory_size)
+            self._lock()
+        except RuntimeError:
+            if acquired:
+                self._sem_empty.release()  # undo
+            raise
+        self._transaction_started = True
+        return min(self._shared_memory.size(), desired_memory_size), self._shared_memory.data()
+
+    def _begin_discarded(self, desired_memory_size):
+        """
+        Starts a transaction whose item is discarded (overflow policy `DROP_NEWEST`): the caller writes into scratch
+        memory, so it doesn't need to distinguish this case.
+        """
+        if len(self._scratch) < desired_memory_size:
+            self._scratch = bytearray(desired_memory_size)
+        self._dropped += 1
+        self._discarding = True
+        self._transaction_started = True
+        return desired_memory_size, memoryview(self._scratch)[:desired_memory_size]
+
+    def _acquire_empty(self, timeout):
+        """
+        Waits for a free slot (ring buffer mode and without slots), overwriting the oldest item if the timeout expires
+        and the overflow policy is `OVERWRITE_OLDEST`.
+
+        :param timeout: Maximum time to wait in seconds, `None` to wait forever
+        :return: `True` if `_sem_empty` was acquired, `False` if the oldest item was discarded instead (i.e., its slot
+        is used without acquiring `_sem_empty`)
+        :except: `abstract_ipc.TimeoutExpired` if no slot became free
+        """
+        if self._acquire_ring(self._sem_empty, timeout):
+            return True
+        if self._overflow == OVERWRITE_OLDEST and self._discard_oldest():
+            self._dropped += 1
+            return False
+        raise abstract_ipc.TimeoutExpired("No free slot within " + str(timeout) + " seconds.")
+
+    def _discard_oldest(self):
+        """
+        Takes the oldest item the consumer has not started reading yet away from it.
+
+        :return: `True` on success, `False` if there is no such item (the consumer is reading the oldest one)
+        """
+        # Whoever decrements _sem_full owns the item, so take it from the consumer:
+        if not self._acquire(self._sem_full, 0):
+            return False
+        if not self._slots:
+            return True  # the item gets replaced by the new one
+        try:
+            self._lock()
+        except RuntimeError:
+            self._sem_full.release()  # undo
+            raise
+        if self._ring.reading:
+            # The consumer reads the item at tail and will advance tail itself, we must not skip any other item:
+            self._unlock()
+            self._sem_full.release()  # dito
+            return False
+        if self._ring.head == self._ring.tail:
+            self._unlock()  # the permit was not backed by an item, so keep it (see _check_ring())
+            return False
+        self._ring.tail += 1
+        self._unlock()
+        return True
+
+    def _create(self, size, shared_memory=None):
+        """
+        Creates a shared memory segment, recovering from a previous crash if required.
+
+        :param size: Size of the segment in bytes
+        :param shared_memory: `QSharedMemory` to create, `None` for the main one
+        :except: `RuntimeError` when the shared memory cannot be created
+        """
+        if shared_memory is None:
+            shared_memory = self._shared_memory
+        args = ()
+        if self._huge_pages == segment_memory.HUGETLB:
+            # QSharedMemory.create() has no flags, HUGETLB is only accepted with SysVSharedMemory (see __init__); the
+            # size is rounded up since the kernel maps whole huge pages anyway (and mbind() requires it):
+            page_size = segment_memory.huge_page_size()
+            size = (size + page_size - 1) // page_size * page_size
+            args = (True,)
         # The following can fail if the app crashed previously being unable to detach from the shared memory:
-        if not self._shared_memory.create(desired_memory_size):
-            # Try to recover:
-            if self._log:
-                logzero.logger.warn("Shared memory seems to be still existing, unable to create it. Trying to "
-                                    "recover by gaining ownership and detaching to delete it...")
-            self._shared_memory.attach()
-            self._shared_memory.detach()
-            if not self._shared_memory.create(desired_memory_size):
+        if not shared_memory.create(size, *args):
+            # Try to recover (happens for every item without slots if the consumer is still attached):
+            if self._diagnostics is not None:
+                self._diagnostics.event("recreate", logging.WARNING, "Shared memory seems to be still existing, unable "
+                                        "to create it. Trying to recover by gaining ownership and detaching to delete "
+                                        "it", key=shared_memory.key(), size=size)
+            shared_memory.attach()
+            shared_memory.detach()
+            if not shared_memory.create(size, *args):
                 # We really still failed:
                 raise RuntimeError("Unable to create or recover shared memory segment: " +
-                                   self._shared_memory.errorString() + "\n\nYou probably need to reboot to fix this.")
-            elif self._log:
-                logzero.logger.info("Shared memory successfully created.")
+                                   shared_memory.errorString() + "\n\nAnother process is still attached to it. List "
+                                   "stale segments by \"python -m prodcon_ipc reap\" (and remove them by adding "
+                                   "--clean).")
+            elif self._diagnostics is not None:
+                self._diagnostics.event("recreated", logging.INFO, "Shared memory successfully created",
+                                        key=shared_memory.key(), size=size)
+        try:
+            self._place_pages(shared_memory, True)
+        except RuntimeError:
+            shared_memory.detach()
+            raise
 
-        # Producer-consumer sync: we are the producer here, so wait for a free slot:
-        if not self._sem_empty.acquire():
-            raise RuntimeError("Unable to acquire the system semaphore (_sem_empty): " + self._shared_memory.errorString())
+    def _create_ring(self):
+        """
+        Creates the shared memory segment holding the ring buffer and initializes its header.
+
+        :except: `RuntimeError` when the shared memory cannot be created or locked
+        """
+        if self._slot_size <= 0 and not self._grow:
+            raise RuntimeError("A positive slot_size is required in ring buffer mode if growing is disabled.")
+        if self._adopt_ring():
+            return
+        self._create(ring_buffer.segment_size(self._slots, self._slot_size))
+        self._lock()
+        self._ring = ring_buffer.RingHeader(memoryview(self._shared_memory.data()))
+        self._ring.initialize(self._slots, self._slot_size)
+        self._heartbeat()
+        try:
+            self._resync(self._sem_empty, self._slots)
+        finally:
+            self._unlock()
+        if self._log:
+            logzero.logger.debug("Created ring buffer with " + str(self._slots) + " slots of " +
+                                 str(self._slot_size) + " bytes each.")
+
+    def _adopt_ring(self):
+        """
+        Takes over the ring buffer of a producer which has died (the segment still exists since the consumer is
+        attached to it), so the consumer keeps its items and we continue after them.
+
+        :return: `True` on success, `False` if there is no segment or it does not contain a matching ring buffer
+        :except: `RuntimeError` if another producer is alive
+        """
+        if not self._shared_memory.attach():
+            return False
+        ring = ring_buffer.RingHeader(memoryview(self._shared_memory.data()))
+        if not ring.is_valid() or ring.slot_count != self._slots:
+            self._shared_memory.detach()
+            return False
+        try:
+            self._lock()
+        except RuntimeError:
+            self._shared_memory.detach()
+            raise
+        try:
+            pid = ring.pid("producer")
+            if pid and pid != self._pid and abstract_ipc.process_alive(pid):
+                raise RuntimeError("The shared memory segment is used by another producer (process " + str(pid) + ").")
+            self._ring = ring
+            self._attach_slots()
+            self._slot_size = ring.slot_size
+            self._heartbeat()
+            self._resync(self._sem_empty, self._permits())
+        except RuntimeError:
+            self._ring = None
+            self._unlock()
+            self._shared_memory.detach()
+            raise
+        self._unlock()
+        self._place_pages(self._shared_memory, False)
+        if self._log:
+            logzero.logger.info("Took over the ring buffer of " + ("process " + str(pid) if pid else "a previous producer")
+                                + " with " + str(ring.head - ring.tail) + " unread items.")
+        return True
+
+    def _permits(self):
+        # Permits held by _grow_slots() are not reflected by the indices yet:
+        return max(0, self._ring.slot_count - (self._ring.head - self._ring.tail) - self._held_permits)
+
+    def _peer_died(self, pid):
+        if self._ring.reading:
+            self._ring.reading = False  # its item is read again by the next consumer
+        if self._diagnostics is not None:
+            self._diagnostics.event("peer_died", logging.WARNING, "Consumer has died, waiting for a new one", pid=pid)
+
+    def _begin_ring(self, desired_memory_size, timeout):
+        """
+        Implements `begin()` in ring buffer mode: waits for a free slot and returns it. The shared memory is only
+        locked while reading the indices, so writing the slot does not block the consumer.
+        """
+        if self._ring is None:
+            self._create_ring()
+
+        # If the oldest item was discarded, its slot is free but not counted by _sem_empty, so releasing _sem_empty
+        # below undoes both cases. Slots are not reallocated then (they are all in use).
+        acquired = self._acquire_empty(timeout)
+        while True:
+            if acquired and desired_memory_size > self._ring.slot_size and self._grow:
+                try:
+                    self._grow_slots(desired_memory_size)
+                except RuntimeError:
+                    self._sem_empty.release()  # undo
+                    raise
+            try:
+                self._lock()
+            except RuntimeError:
+                self._sem_empty.release()  # dito
+                raise
+            if not acquired or self._ring.head - self._ring.tail < self._ring.slot_count:
+                break
+            # The permit was not backed by a free slot (e.g. a process has reset the semaphore or exited while operating
+            # on it), so keep it (i.e., correct the count) and wait again:
+            try:
+                self._resync(self._sem_empty, 0)
+            finally:
+                self._unlock()
+            acquired = self._acquire_empty(self._remaining())
+        index = self._ring.head % self._ring.slot_count
+        self._unlock()
+
+        size = min(self._ring.slot_size, desired_memory_size)
+        self._reserved = (index, size)
+        self._transaction_started = True
+        return size, self._slot_view(index, size, True)
+
+    def _create_spsc(self):
+        """
+        Creates the shared memory segment holding the lock-free ring and initializes its header.
+
+        :except: `RuntimeError` when the shared memory cannot be created or locked
+        """
+        self._create(spsc_ring.segment_size(self._slots, self._slot_size))
+        self._lock()
+        self._spsc = spsc_ring.SpscRing(memoryview(self._shared_memory.data()))
+        self._spsc.initialize(self._slots, self._slot_size)
+        self._unlock()
+        # Wake up a consumer waiting for the segment to be created:
+        if not self._sem_full.release():
+            raise RuntimeError("Releasing the system semaphore failed: " + self._sem_full.errorString())
+        if self._log:
+            logzero.logger.debug("Created lock-free ring with " + str(self._slots) + " slots of " +
+                                 str(self._slot_size) + " bytes each.")
+
+    def _begin_lock_free(self, desired_memory_size, timeout):
+        """
+        Implements `begin()` in lock-free mode: waits for a free slot (only sleeps if the ring is full) and returns it.
+        """
+        if self._spsc is None:
+            self._create_spsc()
 
-        if self._shared_memory.lock():
-            self._transaction_started = True
-            return min(self._shared_memory.size(), desired_memory_size), self._shared_memory.data()
-        else:
-            raise RuntimeError("Unable to lock the shared memory block: " + self._shared_memory.errorString())
+        head, spsc = self._head, self._spsc
+        if head - self._tail >= spsc.slot_count:
+            if not spsc.wait_for_space(lambda: head - spsc.tail < spsc.slot_count,
+                                       lambda remaining: self._acquire(self._sem_empty, remaining), timeout):
+                raise abstract_ipc.TimeoutExpired("No free slot within " + str(timeout) + " seconds.")
+            self._tail = spsc.tail
+
+        index = head % spsc.slot_count
+        size = min(spsc.slot_size, desired_memory_size)
+        offset = spsc.slot_offset(index)
+        self._reserved = (index, size)
+        self._transaction_started = True
+        return size, memoryview(self._shared_memory.data())[offset:offset + size]
+
+    def _end_lock_free(self):
+        """
+        Implements `end()` in lock-free mode: publishes the slot reserved by `begin()`.
+        """
+        index, size = self._reserved
+        self._spsc.set_length(index, size)
+        self._head += 1
+        if self._spsc.publish(self._head) and not self._sem_full.release():
+            raise RuntimeError("Releasing the system semaphore failed: " + self._sem_full.errorString())
+        self._reserved = None
+        self._transaction_started = False
+
+    def _create_broadcast(self):
+        """
+        Creates the shared memory segment holding the broadcast ring and initializes its header.
+
+        :except: `RuntimeError` when the shared memory cannot be created or locked
+        """
+        self._create(broadcast_ring.segment_size(self._slots, self._slot_size, self._max_consumers))
+        self._lock()
+        self._broadcast_ring = broadcast_ring.BroadcastRing(memoryview(self._shared_memory.data()))
+        self._broadcast_ring.initialize(self._slots, self._slot_size, self._max_consumers)
+        self._unlock()
+        if self._log:
+            logzero.logger.debug("Created broadcast ring with " + str(self._slots) + " slots of " +
+                                 str(self._slot_size) + " bytes each for up to " + str(self._max_consumers) +
+                                 " consumers.")
+
+    def _begin_broadcast(self, desired_memory_size, timeout):
+        """
+        Implements `begin()` in broadcast mode: waits until all blocking consumers have read the oldest item and
+        returns its slot.
+        """
+        if self._broadcast_ring is None:
+            self._create_broadcast()
+
+        ring = self._broadcast_ring
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self._lock()
+            free = ring.reserve()
+            index = ring.head % ring.slot_count
+            self._unlock()
+            if free:
+                break
+            # Released by the consumers since reserve() has set our waiting flag:
+            remaining = None if deadline is None else max(0.0, deadline - time.time())
+            if not self._acquire(self._sem_empty, remaining):
+                raise abstract_ipc.TimeoutExpired("No free slot within " + str(timeout) + " seconds.")
+
+        size = min(ring.slot_size, desired_memory_size)
+        offset = ring.slot_offset(index)
+        self._reserved = (index, size)
+        self._transaction_started = True
+        return size, memoryview(self._shared_memory.data())[offset:offset + size]
+
+    def _end_broadcast(self):
+        """
+        Implements `end()` in broadcast mode: publishes the slot reserved by `begin()` and wakes up waiting consumers.
+        """
+        self._lock()
+        waiting = self._broadcast_ring.publish(self._reserved[1])
+        self._unlock()
+        for index in waiting:
+            semaphore = self._consumer_semaphores.get(index)
+            if semaphore is None:
+                semaphore = self._backend.SystemSemaphore(broadcast_ring.semaphore_key(self._id, index), 0,
+                                                          self._backend.SystemSemaphore.Open)
+                self._consumer_semaphores[index] = semaphore
+            if not semaphore.release():
+                raise RuntimeError("Releasing the system semaphore failed: " + semaphore.errorString())
+        self._reserved = None
+        self._transaction_started = False
+
+    def _grow_slots(self, desired_memory_size):
+        """
+        Reallocates the slots in a new segment of the next generation so that they can hold `desired_memory_size`
+        bytes. Call this while holding one permit of `_sem_empty`; all other slots are acquired as well (i.e., the
+        consumer has finished reading all items, or they are discarded according to the overflow policy) before the old
+        slots are released. Waits until the deadline of `begin()` at most, checking the consumer while waiting.
+
+        :param desired_memory_size: Minimum number of bytes per slot
+        :except: `RuntimeError` when the new segment cannot be created, `abstract_ipc.TimeoutExpired` if the other slots
+        did not become free in time (the permits acquired here are given back then, the caller's one is not)
+        """
+        self._held_permits = 1  # the caller's
+        try:
+            while self._held_permits < self._slots:
+                self._acquire_empty(self._remaining())
+                self._held_permits += 1
+            # Grow geometrically to not reallocate again for slightly larger items:
+            slot_size = ring_buffer.align(max(desired_memory_size, 2 * self._ring.slot_size))
+            generation = self._ring.generation + 1
+            slot_memory = self._backend.SharedMemory(ring_buffer.slot_key(self._shared_memory.key(), generation))
+            self._create(ring_buffer.slots_size(self._slots, slot_size), slot_memory)
+
+            try:
+                self._lock()
+            except RuntimeError:
+                slot_memory.detach()
+                raise
+            self._ring.slot_size = slot_size
+            self._ring.generation = generation
+            self._unlock()
+
+            if self._slot_memory is not None:
+                self._slot_memory.detach()  # destroyed once the consumer has detached as well
+            self._slot_memory = slot_memory
+            self._generation = generation
+            if self._diagnostics is not None:
+                self._diagnostics.event("grow", logging.DEBUG, "Reallocated slots", slot_size=slot_size,
+                                        generation=generation)
+        finally:
+            others = self._held_permits - 1
+            self._held_permits = 0
+            if others and not self._sem_empty.release(others):
+                raise RuntimeError("Releasing the system semaphore failed: " + self._sem_empty.errorString())
+
+    def _end_ring(self):
+        """
+        Implements `end()` in ring buffer mode: publishes the slot reserved by `begin()`.
+        """
+        index, size = self._reserved
+        self._lock()
+        self._ring.set_length(index, size)
+        self._ring.set_timestamp(index, self._stats.begin_time if self._stats is not None else 0)
+        self._ring.head += 1
+        self._heartbeat()
+        # Released while holding the lock, so the semaphore always matches the indices for whoever holds it:
+        released = self._sem_full.release()
+        self._unlock()
+
+        if not released:
+            raise RuntimeError("Releasing the system semaphore failed: " + self._sem_full.errorString())
+        self._reserved = None
+        self._transaction_started = False
 
     def end(self):
         """
@@ -84,31 +620,319 @@ class ProducerIPC(abstract_ipc.AbstractIPC):
         """
         if not self._transaction_started:
             raise RuntimeError("You must call begin() first.")
-        if not self._shared_memory.unlock() and self.log:
+        if self._discarding:
+            self._discarding = False
+            self._transaction_started = False
+            return
+        if self._stats is not None:
+            self._stats.end()
+        if self._lock_free:
+            return self._end_lock_free()
+        if self._broadcast:
+            return self._end_broadcast()
+        if self._slots:
+            return self._end_ring()
+        if not self._unlock():
             raise RuntimeError("Unlocking the shared memory failed: " + self._shared_memory.errorString())
 
         # We've written data, so let the consumer know that
-        if not self._sem_full.release() and self.log:
+        if not self._sem_full.release():
             raise RuntimeError("Releasing the system semaphore failed: " + self._sem_full.errorString())
         self._transaction_started = False
         # Do not detech here to not let the shared memory be accidentally destroyed (e.g. on Windows).
 
+    def abort(self):
+        """
+        Aborts a transaction instead of ending it, e.g. if the item does not fit into the memory returned by `begin()`
+        or writing it has failed: the reserved slot is given back without publishing anything, so the consumer never
+        sees the (partially) written memory. With `OVERWRITE_OLDEST`, an item discarded for the slot stays discarded.
+
+        :return: None
+        :except: `RuntimeError` if `begin()` has not been called or the slot cannot be given back
+        """
+        if not self._transaction_started:
+            raise RuntimeError("You must call begin() first.")
+        self._transaction_started = False
+        self._reserved = None
+        if self._discarding:
+            self._discarding = False
+            return
+        if self._lock_free or self._broadcast:
+            return  # nothing is visible to the consumers before end() has advanced head
+        if not self._slots and not self._unlock():
+            raise RuntimeError("Unlocking the shared memory failed: " + self._shared_memory.errorString())
+        # head has not been advanced, so the slot is free again (also if the oldest item was discarded for it):
+        if not self._sem_empty.release():
+            raise RuntimeError("Releasing the system semaphore failed: " + self._sem_empty.errorString())
+
+    def flush(self, timeout=None):
+        """
+        Waits until the consumer(s) have read all items produced so far, e.g. before exiting (which destroys the
+        semaphores if this process has created them last). Items still being encoded (see `put_frame()`) are put
+        first.
+
+        :param timeout: Maximum time to wait in seconds, `None` to wait forever
+        :return: `True` if all items have been read, `False` if the timeout expired
+        :except: `RuntimeError` if a transaction is in progress or a semaphore cannot be acquired
+        """
+        if self._transaction_started:
+            raise RuntimeError("You must call end() first.")
+        deadline = None if timeout is None else time.time() + timeout
+        while self._encoding:
+            encoding = self._encoding.popleft()
+            try:
+                self._put_encoded(encoding.result(), None if deadline is None else max(0.0, deadline - time.time()))
+            except abstract_ipc.TimeoutExpired:
+                self._encoding.appendleft(encoding)
+                return False
+        if self._lock_free:
+            if self._spsc is None:
+                return True
+            head, spsc = self._head, self._spsc
+            return spsc.wait_for_space(lambda: spsc.tail >= head,
+                                       lambda remaining: self._acquire(self._sem_empty, remaining), timeout)
+        if self._broadcast:
+            while self._broadcast_ring is not None:
+                self._lock()
+                pending = self._broadcast_ring.pending()
+                self._unlock()
+                if not pending:
+                    break
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                time.sleep(0.001)  # the consumers only wake up a waiting producer if a slot is needed
+            return True
+        if self._slots:
+            # The header tells whether everything has been read. Waiting for _sem_empty instead would block until the
+            # timeout if the consumer exits after reading the last item (e.g. the end of the stream), destroying the
+            # semaphores if it has created them last:
+            while self._ring is not None and not self._read_all():
+                if deadline is not None and time.time() >= deadline:
+                    return False
+                time.sleep(0.001)
+            return True
+        # The item has been read once the permit of _sem_empty could be acquired:
+        if not self._acquire(self._sem_empty, None if deadline is None else max(0.0, deadline - time.time())):
+            return False
+        if not self._sem_empty.release():
+            raise RuntimeError("Releasing the system semaphore failed: " + self._sem_empty.errorString())
+        return True
+
+    def _read_all(self):
+        """
+        Returns `True` if the consumer has read all items according to the ring buffer header (`False` without one).
+        """
+        return self._ring is not None and self._ring.tail >= self._ring.head
+
+    def put_many(self, records):
+        """
+        Puts many (small) records into the shared memory within a single transaction, i.e., the semaphores and the
+        lock are only acquired once for all of them. The consumer gets them via `ConsumerIPC.get_many()`.
+
+        :param records: Iterable of bytes-like objects (e.g. created by `struct.pack()`)
+        :return: Number of records put into the shared memory
+        :except: `RuntimeError` when the shared memory cannot be accessed or is too small (see `begin()`)
+        """
+        records = list(records)
+        size = batch.packed_size(records)
+        avail_size, data = self.begin(size)
+        try:
+            if avail_size < size:
+                raise RuntimeError("Not enough shared memory for " + str(len(records)) + " records (" + str(size) +
+                                   " bytes).")
+            batch.pack_into(memoryview(data)[:size], records)
+        except BaseException:
+            self.abort()  # never publish the previous content of the slot
+            raise
+        self.end()
+        return len(records)
+
+    def put_stream(self, source, size=None, chunk_size=None, timeout=None):
+        """
+        Puts a payload of any size into the shared memory, split into chunks of at most `chunk_size` bytes which are
+        put one after another as separate items (see `chunked`). Memory use on both sides is therefore bounded by the
+        slots, no matter how large the payload is, and nothing is truncated. The consumer gets the payload via
+        `ConsumerIPC.get_stream()` (chunk by chunk) or `ConsumerIPC.get_large()`.
+
+        :param source: Bytes-like payload, file object (read by `readinto()` directly into the shared memory) or
+        iterable of bytes-like pieces (e.g. generated while computing the payload)
+        :param size: Total size of the payload in bytes if known in advance, it is passed to the consumer (determined
+        automatically for bytes-like payloads)
+        :param chunk_size: Maximum number of bytes of a chunk's data, `None` (the default) to fill a slot (or
+        `chunked.DEFAULT_CHUNK_SIZE` bytes if the slot size is unknown)
+        :param timeout: Maximum time to wait for a free slot per chunk in seconds, `None` to wait forever
+        :return: Number of bytes put into the shared memory
+        :except: `RuntimeError` when the shared memory cannot be accessed or a slot is smaller than a chunk,
+        `abstract_ipc.TimeoutExpired` (see `begin()`), `ValueError` without slots (the single item mode recreates the
+        segment for every item, even while the consumer may still attach to the previous one) or if the overflow
+        policy is not `BLOCK` (discarded chunks would corrupt the payload); if reading `source` fails, the consumer is
+        told that the payload was aborted
+        """
+        if not self._slots:
+            raise ValueError("Streaming chunks requires slots.")
+        if self._overflow != BLOCK:
+            raise ValueError("Streaming chunks requires the overflow policy BLOCK.")
+        if chunk_size is None:
+            slot_size = self._ring.slot_size if self._ring is not None else self._slot_size
+            chunk_size = slot_size - chunked.HEADER_SIZE if slot_size > chunked.HEADER_SIZE else \
+                chunked.DEFAULT_CHUNK_SIZE
+        stream = self._streams
+        self._streams += 1
+        offset = 0
+        flags = chunked.FIRST
+
+        if hasattr(source, "readinto"):
+            while True:
+                capacity = chunk_size if size is None else min(chunk_size, size - offset)
+                if size is not None and offset + capacity >= size:
+                    flags |= chunked.LAST
+                length = self._put_chunk(flags, stream, size, offset, capacity, timeout,
+                                         lambda view: chunked.fill(view, source))
+                offset += length
+                if length < capacity or flags & chunked.LAST:
+                    return offset  # the last chunk (possibly empty) has been put
+                flags = 0
+
+        if not isinstance(source, (list, tuple)):
+            try:
+                source = [memoryview(source)]  # bytes-like
+                size = source[0].nbytes
+            except TypeError:
+                pass  # iterable
+        pieces = self._split(source, chunk_size)
+        current = next(pieces, b"")  # an empty payload is put as one empty chunk
+        while True:
+            try:
+                following = next(pieces, None)  # to flag the last chunk
+            except BaseException:
+                self._put_chunk(chunked.ABORTED, stream, size, offset, 0, timeout, lambda view: 0)
+                raise
+            if following is None:
+                flags |= chunked.LAST
+            length = len(current)
+            self._put_chunk(flags, stream, size, offset, length, timeout, lambda view: self._copy(view, current))
+            offset += length
+            if following is None:
+                return offset
+            current = following
+            flags = 0
+
+    def put_frame(self, payload, timeout=None):
+        """
+        Encodes an item with the codec (see the constructor) and puts it into the shared memory. With `codec_threads`,
+        the item is encoded in the background and this returns once the previous items (all but `codec_threads`) have
+        been put, so call `flush()` at the end.
+
+        :param payload: Bytes-like item, may be changed by the caller once this returns
+        :param timeout: See `begin()`, applies to every item put by this call
+        :except: `RuntimeError` without a codec, if the encoded item exceeds the slot size or see `begin()`
+        """
+        if self._encoder is None:
+            raise RuntimeError("put_frame() requires a codec.")
+        if self._pool is None:
+            return self._put_encoded(self._encoder.encode(payload), timeout)
+        self._encoding.append(self._pool.submit(self._encoder.prepare(payload, True)))
+        while len(self._encoding) > self._codec_threads:
+            self._put_encoded(self._encoding.popleft().result(), timeout)
+
+    def _put_encoded(self, pieces, timeout):
+        """
+        Puts an item encoded by `frame_codec.Encoder` into the shared memory.
+        """
+        size = sum(len(piece) for piece in pieces)
+        avail_size, data = self.begin(size, timeout)
+        try:
+            if avail_size < size:
+                raise RuntimeError("Encoded item of " + str(size) + " bytes exceeds the slot size of " +
+                                   str(avail_size) + " bytes.")
+            view = memoryview(data)
+            offset = 0
+            for piece in pieces:
+                view[offset:offset + len(piece)] = piece
+                offset += len(piece)
+        except BaseException:
+            self.abort()  # never publish a truncated item
+            raise
+        self.end()
+
+    def _frame_buffer(self, size):
+        """
+        Returns the memory `ScopedProducer` lets the caller write an item of `size` bytes to (with a codec).
+        """
+        if len(self._frame) < size:
+            self._frame = bytearray(size)
+        return memoryview(self._frame)[:size]
+
+    @staticmethod
+    def _split(pieces, chunk_size):
+        """
+        Yields the pieces as byte `memoryview`s of at most `chunk_size` bytes, skipping empty ones.
+        """
+        for piece in pieces:
+            piece = memoryview(piece)
+            if hasattr(piece, "cast") and (piece.format != "B" or piece.ndim != 1):
+                piece = piece.cast("B")
+            for start in range(0, len(piece), chunk_size):
+                yield piece[start:start + chunk_size]
+
+    @staticmethod
+    def _copy(view, data):
+        view[:len(data)] = data
+        return len(data)
+
+    def _put_chunk(self, flags, stream, size, offset, capacity, timeout, write):
+        """
+        Puts one chunk of `put_stream()` within a transaction.
+
+        :param capacity: Maximum number of bytes `write` writes
+        :param write: Function writing the chunk's data into the `memoryview` passed and returning its length
+        :return: Length of the chunk's data
+        """
+        avail_size, data = self.begin(chunked.HEADER_SIZE + capacity, timeout)
+        view = memoryview(data)
+        length = 0
+        try:
+            if avail_size < chunked.HEADER_SIZE + capacity:
+                raise RuntimeError("Not enough shared memory for a chunk of " + str(capacity) + " bytes, reduce the "
+                                   "chunk size.")
+            length = write(view[chunked.HEADER_SIZE:chunked.HEADER_SIZE + capacity])
+            if length < capacity and not flags & chunked.ABORTED:
+                flags |= chunked.LAST
+        except BaseException:
+            flags = chunked.ABORTED | chunked.LAST
+            length = 0
+            raise
+        finally:
+            if avail_size >= chunked.HEADER_SIZE:
+                chunked.pack_header_into(view, flags, stream, size or 0, offset, length)
+            self.end()
+        return length
+
 
 class ScopedProducer(object):
     """
     Allows to use an object of ProducerIPC in combination with Python's "with" statement conveniently.
+
+    If the producer has a codec, the item is written to local memory and encoded and put at the end of the "with"
+    statement (see `ProducerIPC.put_frame()`), so `size()` is always the desired size then.
     """
-    def __init__(self, producer_ipc, desired_memory_size):
+    def __init__(self, producer_ipc, desired_memory_size, timeout=None):
         assert isinstance(producer_ipc, ProducerIPC)
         self.__prod_ipc = producer_ipc
         self.__size = desired_memory_size
+        self.__timeout = timeout
         self.__success = False
         self.__data = None
         self.__avail_size = -1
 
     def __enter__(self):
+        if self.__prod_ipc._encoder is not None:
+            self.__data = self.__prod_ipc._frame_buffer(self.__size)
+            self.__avail_size = self.__size
+            self.__success = True
+            return self
         try:
-            self.__avail_size, self.__data = self.__prod_ipc.begin(self.__size)
+            self.__avail_size, self.__data = self.__prod_ipc.begin(self.__size, self.__timeout)
             self.__success = True
         except RuntimeError:
             self.__success = False
@@ -131,6 +955,40 @@ class ScopedProducer(object):
         """
         return self.__avail_size if self.__success else None
 
+    def view(self):
+        """
+        Returns a writable view of the available shared memory to write data in place (without copying it into an
+        intermediate bytes object first).
+
+        :return: `memoryview` of `size()` bytes
+        """
+        if not self.__success:
+            return None
+        return memoryview(self.__data)[:self.__avail_size]
+
+    def ndarray(self, shape, dtype, strides=None):
+        """
+        Returns a writable NumPy array located in the shared memory (the consumer gets it via
+        `ScopedConsumer.ndarray()`). Shape, dtype and strides are stored in a small header in front of the array data,
+        so pass `array_view.required_size(shape, dtype)` as `desired_memory_size` to the constructor.
+
+        :param shape: Shape of the array (tuple of ints)
+        :param dtype: Anything `numpy.dtype()` accepts
+        :param strides: Strides in bytes, `None` for C-contiguous
+        :return: `numpy.ndarray` viewing the shared memory (requires NumPy)
+        :except: `ValueError` if the shared memory is too small
+        """
+        if not self.__success:
+            return None
+        return array_view.write(self.view(), shape, dtype, strides)
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.__success:
-            self.__prod_ipc.end()
+        if not self.__success:
+            return
+        if self.__prod_ipc._encoder is None:
+            if exc_type is None:
+                self.__prod_ipc.end()
+            else:
+                self.__prod_ipc.abort()  # don't publish an item which was not written completely
+        elif exc_type is None:
+            self.__prod_ipc.put_frame(self.__data, self.__timeout)
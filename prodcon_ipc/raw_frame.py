@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import ctypes
+import struct
+
+from PyQt5.QtGui import QImage
+try:
+    from PyQt5 import sip
+except ImportError:  # PyQt5 < 5.11
+    import sip
+
+# Layout of an uncompressed image stored in shared memory (must match `src/prodcon_ipc/raw_frame.h`):
+#
+#   [header (HEADER_SIZE bytes)][scanlines (height * bytes_per_line bytes)]
+#
+# All header values are stored in little endian order, `format` is the value of `QImage.Format`. Storing the pixels as
+# they are avoids encoding the image (as done by `QDataStream << image`, which uses PNG) and decoding it again.
+MAGIC = b"PCFR"
+HEADER_FORMAT = "<4sIIII4xQ"  # magic, width, height, bytes per line, QImage.Format, (padding), sequence number
+HEADER_SIZE = 64  # scanlines start at a cache line boundary
+
+_HEADER = struct.Struct(HEADER_FORMAT)
+
+
+def frame_size(image):
+    """
+    Returns the number of bytes needed to store an image, i.e., what to pass to `ScopedProducer` (or
+    `ProducerIPC.begin()`).
+
+    :param image: `QImage`
+    :return: Size in bytes
+    """
+    return HEADER_SIZE + image.bytesPerLine() * image.height()
+
+
+def required_size(width, height, format):
+    """
+    Returns the number of bytes needed to store an image of the given geometry, e.g. to reserve the memory rendered
+    into by `image()`.
+
+    :param width: Width in pixels
+    :param height: Height in pixels
+    :param format: `QImage.Format`
+    :return: Size in bytes
+    """
+    return HEADER_SIZE + _bytes_per_line(width, format) * height
+
+
+def _bytes_per_line(width, format):
+    # Scanlines are padded to 32 bits like those of images allocated by `QImage`:
+    return (width * QImage.toPixelFormat(format).bitsPerPixel() + 31) // 32 * 4
+
+
+def image(buf, width, height, format, sequence=0):
+    """
+    Writes the header of a frame into `buf` and returns an image over its scanlines, so the frame can be rendered in
+    place (e.g. using `QPainter`) instead of being copied by `write()` once finished. The pixels are not initialized
+    and the image is only valid as long as `buf` is, i.e., finish painting before the transaction ends.
+
+    :param buf: Writable buffer (e.g. `memoryview` of the slot returned by `ProducerIPC.begin()`) of at least
+    `required_size(width, height, format)` bytes
+    :param width: Width in pixels
+    :param height: Height in pixels
+    :param format: `QImage.Format`
+    :param sequence: Sequence number of the frame
+    :return: Writable `QImage` viewing `buf`
+    :except: `ValueError` if `buf` is too small
+    """
+    buf = memoryview(buf)
+    bytes_per_line = _bytes_per_line(width, format)
+    if len(buf) < HEADER_SIZE + bytes_per_line * height:
+        raise ValueError("Shared memory is too small for the frame.")
+    _HEADER.pack_into(buf, 0, MAGIC, width, height, bytes_per_line, int(format), sequence)
+    # An address (unlike a `sip.voidptr`) selects the constructor taking non-const data, so painting does not detach
+    # the image from the shared memory:
+    address = ctypes.addressof(ctypes.c_char.from_buffer(buf, HEADER_SIZE))
+    return QImage(address, width, height, bytes_per_line, QImage.Format(format))
+
+
+def write(buf, image, sequence=0):
+    """
+    Copies the header and the scanlines of an image into `buf` (a single copy, no encoding).
+
+    :param buf: Writable buffer (e.g. `memoryview`) of at least `frame_size(image)` bytes
+    :param image: `QImage` to store
+    :param sequence: Sequence number of the frame (e.g. a counter maintained by the producer)
+    :except: `ValueError` if `buf` is too small
+    """
+    buf = memoryview(buf)
+    size = image.bytesPerLine() * image.height()
+    if len(buf) < HEADER_SIZE + size:
+        raise ValueError("Shared memory is too small for the frame.")
+    _HEADER.pack_into(buf, 0, MAGIC, image.width(), image.height(), image.bytesPerLine(), int(image.format()),
+                      sequence)
+    bits = image.constBits()
+    bits.setsize(size)
+    buf[HEADER_SIZE:HEADER_SIZE + size] = memoryview(bits)
+
+
+def read(buf):
+    """
+    Returns an image viewing the scanlines in `buf` (no copy, no decoding). The image is only valid as long as `buf` is,
+    i.e., call `QImage.copy()` if it is needed after the transaction has ended.
+
+    :param buf: Buffer (e.g. `memoryview`) of the frame, as written by `write()`
+    :return: Tuple (image, sequence) whereby `image` is a `QImage` and `sequence` the sequence number of the frame
+    :except: `ValueError` if `buf` does not contain a frame
+    """
+    buf = memoryview(buf)
+    if len(buf) < HEADER_SIZE:
+        raise ValueError("Shared memory is too small to contain a frame.")
+    magic, width, height, bytes_per_line, fmt, sequence = _HEADER.unpack_from(buf, 0)
+    if magic != MAGIC or len(buf) < HEADER_SIZE + bytes_per_line * height:
+        raise ValueError("Shared memory does not contain a valid frame.")
+    pixels = sip.voidptr(buf[HEADER_SIZE:HEADER_SIZE + bytes_per_line * height])
+    return QImage(pixels, width, height, bytes_per_line, QImage.Format(fmt)), sequence
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import tempfile
+
+import abstract_ipc
+import ring_buffer
+import sysv_semaphore
+import sysv_shared_memory
+
+# Finds the System V shared memory segments and semaphores created by `QSharedMemory`/`QSystemSemaphore` (or the
+# Qt-free backend) via their key files in the temp directory and removes the ones left behind by crashed processes
+# (Linux only), see `python -m prodcon_ipc reap --help`. An object is stale if
+#
+# - its key file exists but the object doesn't ("orphaned key file"),
+# - it is a segment no process is attached to (Qt removes a segment when the last process detaches, so it was left
+#   behind by a crash), or
+# - it is a semaphore whose last user has exited, nobody waits for it and no segment in use belongs to it.
+#
+# The key of an object cannot be recovered from its key file (it contains a hash of it), so a semaphore belongs to a
+# segment if its name (the letters of its key) is the one of the segment followed by one of the suffixes this package
+# appends to the key (`_SEMAPHORE_SUFFIXES`), e.g. "MySharedMemoryDefaultsemfull" for the segment
+# "MySharedMemoryDefault". Prefix matching would also keep the semaphores of "MySharedMemoryDefaultOld" alive.
+SHARED_MEMORY = "shared memory"
+SEMAPHORE = "semaphore"
+
+_HASH_LENGTH = 40  # hex digits of the SHA-1 at the end of a key file name
+_SHM_RDONLY = 0o10000
+# Letters appended to the key of a segment by its semaphores: the lock of the segment itself, `_sem_full` (also
+# `_sem_full_<index>` of a broadcast ring), `_sem_empty` and the ones of `shared_arena`:
+_SEMAPHORE_SUFFIXES = ("", "semfull", "semempty", "ready", "space")
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.ftok.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        _libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        _libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        _libc.shmat.restype = ctypes.c_void_p
+        _libc.shmdt.argtypes = [ctypes.c_void_p]
+        _libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+        _libc.semget.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int]
+        _libc.semctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    return _libc
+
+
+def _key_files(prefix):
+    """
+    Yields (path, name) of the key files with a prefix, `name` being the letters of the key.
+    """
+    directory = tempfile.gettempdir()
+    for file_name in sorted(os.listdir(directory)):
+        if file_name.startswith(prefix) and len(file_name) > len(prefix) + _HASH_LENGTH:
+            yield os.path.join(directory, file_name), file_name[len(prefix):-_HASH_LENGTH]
+
+
+def _ring_status(id):
+    """
+    Reads the owners and indices of a ring buffer (see `ring_buffer`) by attaching to the segment read-only.
+
+    :return: `dict` or `None` if the segment does not contain a ring buffer
+    """
+    libc = _load_libc()
+    address = libc.shmat(id, None, _SHM_RDONLY)
+    if address is None or address == ctypes.c_void_p(-1).value:
+        return None
+    try:
+        ring = ring_buffer.RingHeader(memoryview(bytearray(ctypes.string_at(address, ring_buffer.HEADER_SIZE))))
+        if not ring.is_valid():
+            return None
+        status = {"slots": ring.slot_count, "head": ring.head, "tail": ring.tail}
+        for role in ("producer", "consumer"):
+            pid = ring.pid(role)
+            status[role] = {"pid": pid, "alive": abstract_ipc.process_alive(pid) if pid else None}
+        return status
+    finally:
+        libc.shmdt(address)
+
+
+def _segments():
+    libc = _load_libc()
+    for path, name in _key_files(sysv_shared_memory.KEY_FILE_PREFIX):
+        entry = {"kind": SHARED_MEMORY, "name": name, "file": path, "id": -1}
+        unix_key = libc.ftok(path.encode("utf-8"), ord("Q"))
+        id = libc.shmget(unix_key, 0, 0) if unix_key != -1 else -1
+        status = sysv_shared_memory.status(id) if id != -1 else None
+        if status is None:
+            entry.update(stale=True, reason="orphaned key file")
+        else:
+            entry.update(status, id=id, stale=not status["attached"],
+                         reason="no process attached" if not status["attached"] else "")
+            entry["ring"] = _ring_status(id)
+        yield entry
+
+
+def _semaphores(segments):
+    libc = _load_libc()
+    in_use = set(segment["name"] + suffix for segment in segments if not segment["stale"]
+                 for suffix in _SEMAPHORE_SUFFIXES)
+    for path, name in _key_files(sysv_semaphore.KEY_FILE_PREFIX):
+        entry = {"kind": SEMAPHORE, "name": name, "file": path, "id": -1}
+        unix_key = libc.ftok(path.encode("utf-8"), ord("Q"))
+        id = libc.semget(unix_key, 1, 0) if unix_key != -1 else -1
+        if id == -1:
+            entry.update(stale=True, reason="orphaned key file")
+            yield entry
+            continue
+        last = libc.semctl(id, 0, sysv_semaphore.GETPID)
+        waiting = libc.semctl(id, 0, sysv_semaphore.GETNCNT)
+        entry.update(id=id, value=libc.semctl(id, 0, sysv_semaphore.GETVAL), last=last, waiting=waiting)
+        if waiting > 0:
+            entry.update(stale=False, reason="")
+        elif last > 0 and abstract_ipc.process_alive(last):
+            entry.update(stale=False, reason="")
+        elif name in in_use:
+            entry.update(stale=False, reason="")
+        else:
+            entry.update(stale=True, reason="last user has exited")
+        yield entry
+
+
+def scan():
+    """
+    Finds the shared memory segments and semaphores created by Qt or this package.
+
+    :return: List of `dict`s with the keys "kind" (`SHARED_MEMORY` or `SEMAPHORE`), "name" (the letters of the key),
+    "file" (path of the key file), "id" (System V ID, -1 if the object doesn't exist), "stale" (`True` if it can be
+    removed) and "reason" (why it is stale); segments additionally have the keys of `sysv_shared_memory.status()` and
+    "ring" (owners and indices if it holds a ring buffer, otherwise `None`), semaphores "value", "last" (ID of the
+    process which operated on it last) and "waiting" (number of processes waiting for it)
+    :except: `RuntimeError` if System V IPC is not supported on this platform
+    """
+    if not sysv_shared_memory.is_supported():
+        raise RuntimeError("Finding stale shared memory requires System V IPC on 64 bit Linux.")
+    segments = list(_segments())
+    return segments + list(_semaphores(segments))
+
+
+def clean(entries):
+    """
+    Removes the stale objects (and their key files) found by `scan()`.
+
+    :param entries: Result of `scan()`
+    :return: List of the entries removed
+    """
+    libc = _load_libc()
+    removed = []
+    for entry in entries:
+        if not entry["stale"]:
+            continue
+        if entry["id"] != -1:
+            if entry["kind"] == SHARED_MEMORY:
+                result = libc.shmctl(entry["id"], sysv_semaphore.IPC_RMID, None)
+            else:
+                result = libc.semctl(entry["id"], 0, sysv_semaphore.IPC_RMID)
+            if result == -1 and ctypes.get_errno() not in (errno.EINVAL, errno.EIDRM):  # removed meanwhile
+                continue
+        sysv_semaphore.remove_key_file(entry["file"])
+        removed.append(entry)
+    return removed
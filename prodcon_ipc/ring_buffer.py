@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import ctypes
+import struct
+
+# Layout of a shared memory segment in ring buffer mode (must match `src/prodcon_ipc/ring_header.h`):
+#
+#   [header (HEADER_SIZE bytes)][slot length table (slot_count * uint64)][slot timestamp table (slot_count * uint64)]
+#   [slot 0][slot 1]...[slot N-1]
+#
+# All values are stored in little endian order. The tables and every slot start at a multiple of `ALIGNMENT` bytes.
+# The timestamp of a slot is the time the producer has started writing its item (see `ipc_stats.now()`), 0 if the
+# producer doesn't collect statistics.
+# `head` and `tail` are monotonically increasing sequence numbers, the slot of an item is `sequence % slot_count`.
+# `reading` is 1 while the consumer reads the item at `tail` (so the producer must not overwrite it, see
+# `ProducerIPC`'s overflow policy `OVERWRITE_OLDEST`).
+#
+# Each side records its process ID and a heartbeat (seconds of `CLOCK_MONOTONIC`, see `abstract_ipc.heartbeat()`) in
+# the header, so the other side detects if it has died (see `AbstractIPC`); 0 means unknown (e.g. written by an older
+# version, these fields used to be padding).
+#
+# If the producer needs larger slots, it allocates them in a separate segment named `slot_key(key, generation)` and
+# increments `generation` in the header (which always stays in the first segment). The slots of generation 0 are the
+# ones following the header.
+MAGIC = b"PCRB"
+VERSION = 2
+ALIGNMENT = 64  # typical cache line size
+# magic, version, header size, slot count, slot size, generation, head, tail, reading, producer PID, consumer PID,
+# producer heartbeat, consumer heartbeat, (reserved)
+HEADER_FORMAT = "<4sHHIIQQQIIIII4x"
+HEADER_SIZE = ALIGNMENT
+LENGTH_FORMAT = "<Q"
+
+_HEADER = struct.Struct(HEADER_FORMAT)
+_LENGTH = struct.Struct(LENGTH_FORMAT)
+_U32 = struct.Struct("<I")
+_U64 = struct.Struct("<Q")
+# The fields accessed for every transaction are read and written through ctypes, which is much cheaper than struct:
+_C_U32 = ctypes.c_uint32.__ctype_le__
+_C_U64 = ctypes.c_uint64.__ctype_le__
+
+_SLOT_SIZE_OFFSET = 12
+_GENERATION_OFFSET = 16
+_HEAD_OFFSET = 24
+_TAIL_OFFSET = 32
+_READING_OFFSET = 40
+_PID_OFFSETS = {"producer": 44, "consumer": 48}
+_HEARTBEAT_OFFSETS = {"producer": 52, "consumer": 56}
+
+
+def align(size):
+    """
+    Rounds `size` up to the next multiple of `ALIGNMENT`.
+
+    :param size: Size in bytes
+    :return: Aligned size in bytes
+    """
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def timestamps_offset(slot_count):
+    """
+    Returns the offset of the slot timestamp table.
+
+    :param slot_count: Number of slots
+    :return: Offset in bytes
+    """
+    return HEADER_SIZE + align(slot_count * _LENGTH.size)
+
+
+def data_offset(slot_count):
+    """
+    Returns the offset of the first slot, i.e., the size of the header including the slot length and timestamp tables.
+
+    :param slot_count: Number of slots
+    :return: Offset in bytes
+    """
+    return timestamps_offset(slot_count) + align(slot_count * _U64.size)
+
+
+def slot_key(key, generation):
+    """
+    Returns the name of the shared memory segment holding the slots of a generation > 0.
+
+    :param key: Name of the shared memory segment holding the header
+    :param generation: Generation of the slots
+    :return: Name of the segment
+    """
+    return key + "_gen" + str(generation)
+
+
+def slots_size(slot_count, slot_size):
+    """
+    Returns the number of bytes needed for the slots only (generation > 0).
+
+    :param slot_count: Number of slots
+    :param slot_size: Maximum number of bytes per slot
+    :return: Size in bytes
+    """
+    return slot_count * align(slot_size)
+
+
+def segment_size(slot_count, slot_size):
+    """
+    Returns the number of bytes a shared memory segment needs to hold the header and all slots.
+
+    :param slot_count: Number of slots
+    :param slot_size: Maximum number of bytes per slot
+    :return: Size in bytes
+    """
+    return data_offset(slot_count) + slots_size(slot_count, slot_size)
+
+
+class RingHeader(object):
+    """
+    Provides access to the header of a ring buffer located at the beginning of a shared memory segment.
+
+    This class does not synchronize anything, lock the shared memory before reading or writing the indices.
+    """
+    def __init__(self, buf):
+        """
+        Wraps the given memory.
+
+        :param buf: Writable `memoryview` of the whole shared memory segment
+        """
+        self._buf = buf
+        self._slot_count = 0
+        self._timestamps_offset = 0
+        self._data_offset = 0
+        if len(buf) >= HEADER_SIZE:
+            self._slot_size = _C_U32.from_buffer(buf, _SLOT_SIZE_OFFSET)
+            self._generation = _C_U64.from_buffer(buf, _GENERATION_OFFSET)
+            self._head = _C_U64.from_buffer(buf, _HEAD_OFFSET)
+            self._tail = _C_U64.from_buffer(buf, _TAIL_OFFSET)
+            self._reading = _C_U32.from_buffer(buf, _READING_OFFSET)
+        if self.is_valid():
+            self._cache_layout()
+
+    def initialize(self, slot_count, slot_size):
+        """
+        Writes a fresh header (an empty ring buffer).
+
+        :param slot_count: Number of slots
+        :param slot_size: Maximum number of bytes per slot
+        """
+        _HEADER.pack_into(self._buf, 0, MAGIC, VERSION, HEADER_SIZE, slot_count, slot_size, 0, 0, 0, 0, 0, 0, 0, 0)
+        self._cache_layout()
+        for i in range(slot_count):
+            self.set_length(i, 0)
+            self.set_timestamp(i, 0)
+
+    def _cache_layout(self):
+        self._slot_count = _U32.unpack_from(self._buf, 8)[0]
+        self._timestamps_offset = timestamps_offset(self._slot_count)
+        self._data_offset = data_offset(self._slot_count)
+
+    def is_valid(self):
+        """
+        Checks whether the memory contains a ring buffer header of a supported version.
+
+        :return: `True` if so, `False` otherwise
+        """
+        if len(self._buf) < HEADER_SIZE:
+            return False
+        magic, version = struct.unpack_from("<4sH", self._buf, 0)
+        return magic == MAGIC and version == VERSION
+
+    @property
+    def slot_count(self):
+        return self._slot_count
+
+    @property
+    def slot_size(self):
+        return self._slot_size.value
+
+    @slot_size.setter
+    def slot_size(self, value):
+        self._slot_size.value = value
+
+    @property
+    def generation(self):
+        """Incremented whenever the producer reallocates the slots (see `slot_key()`)."""
+        return self._generation.value
+
+    @generation.setter
+    def generation(self, value):
+        self._generation.value = value
+
+    @property
+    def head(self):
+        """Sequence number of the next slot to be written by the producer."""
+        return self._head.value
+
+    @head.setter
+    def head(self, value):
+        self._head.value = value
+
+    @property
+    def tail(self):
+        """Sequence number of the next slot to be read by the consumer."""
+        return self._tail.value
+
+    @tail.setter
+    def tail(self, value):
+        self._tail.value = value
+
+    @property
+    def reading(self):
+        """`True` while the consumer reads the item at `tail`."""
+        return self._reading.value != 0
+
+    @reading.setter
+    def reading(self, value):
+        self._reading.value = 1 if value else 0
+
+    def pid(self, role):
+        """
+        Returns the process ID of the producer or consumer.
+
+        :param role: "producer" or "consumer"
+        :return: Process ID, 0 if unknown
+        """
+        return _U32.unpack_from(self._buf, _PID_OFFSETS[role])[0]
+
+    def heartbeat(self, role):
+        """
+        Returns the last heartbeat of the producer or consumer (see `abstract_ipc.heartbeat()`).
+
+        :param role: "producer" or "consumer"
+        :return: Heartbeat, 0 if unknown
+        """
+        return _U32.unpack_from(self._buf, _HEARTBEAT_OFFSETS[role])[0]
+
+    def set_owner(self, role, pid, beat):
+        """
+        Records the process ID and heartbeat of the producer or consumer.
+
+        :param role: "producer" or "consumer"
+        :param pid: Process ID, 0 if there is none (anymore)
+        :param beat: Heartbeat, see `abstract_ipc.heartbeat()`
+        """
+        _U32.pack_into(self._buf, _PID_OFFSETS[role], pid)
+        _U32.pack_into(self._buf, _HEARTBEAT_OFFSETS[role], beat)
+
+    def length(self, index):
+        """
+        Returns the number of bytes stored in a slot.
+
+        :param index: Slot index (not the sequence number)
+        :return: Size in bytes
+        """
+        return _LENGTH.unpack_from(self._buf, HEADER_SIZE + index * _LENGTH.size)[0]
+
+    def set_length(self, index, length):
+        _LENGTH.pack_into(self._buf, HEADER_SIZE + index * _LENGTH.size, length)
+
+    def timestamp(self, index):
+        """
+        Returns the time the producer has started writing the item stored in a slot.
+
+        :param index: Slot index (not the sequence number)
+        :return: Time in nanoseconds (see `ipc_stats.now()`), 0 if unknown
+        """
+        return _U64.unpack_from(self._buf, self._timestamps_offset + index * _U64.size)[0]
+
+    def set_timestamp(self, index, timestamp):
+        _U64.pack_into(self._buf, self._timestamps_offset + index * _U64.size, timestamp)
+
+    def slot_offset(self, index):
+        """
+        Returns the offset of a slot relative to the beginning of the segment holding the slots of the current
+        generation (this one for generation 0, see `slot_key()` otherwise).
+
+        :param index: Slot index (not the sequence number)
+        :return: Offset in bytes
+        """
+        return (0 if self.generation else self._data_offset) + index * align(self.slot_size)
@@ -0,0 +1,465 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import ctypes
+import os
+import struct
+import time
+
+import abstract_ipc
+import ipc_backend
+import logzero
+import ring_buffer
+import spsc_ring
+import sysv_semaphore
+
+# Layout of a shared memory segment hosting many channels (e.g. one per camera or telemetry source), so they share one
+# segment and two semaphores instead of a segment and two semaphores each:
+#
+#   [header (HEADER_SIZE bytes)][directory (max channels * ENTRY_SIZE bytes)][channel 0][channel 1]...
+#
+#   offset   0: magic, version, header size, max channels, channel count, arena size, offset of the free space
+#   offset  64: consumer waiting flag (uint32)
+#   offset 128: directory, one entry per channel: name (UTF-8, zero padded), offset, slot count, slot size, producer
+#               process ID
+#
+# Each channel is a lock-free single-producer/single-consumer ring (see `spsc_ring`) with a fixed number of slots, so
+# every channel has exactly one producer and all channels are read by the single consumer of the arena. Producers add
+# their channel to the directory under the lock of the shared memory, which is not used otherwise. Channels are never
+# removed: a restarted producer continues with its channel of the same name.
+#
+# Instead of one semaphore per channel, the consumer waits for "any channel ready" on the semaphore `$id + "_ready"`:
+# it sets its waiting flag, checks the heads of all channels once more and sleeps; a producer releases the semaphore
+# after publishing an item if the flag is set. Producers waiting for a free slot share the semaphore `$id + "_space"`,
+# which the consumer releases after freeing a slot of a channel whose producer waits. If several producers wait at once,
+# one of them may take the wake-up meant for another, so producers sleep at most `SPACE_POLL_INTERVAL` seconds before
+# checking their channel again.
+MAGIC = b"PCSA"
+VERSION = 1
+ALIGNMENT = ring_buffer.ALIGNMENT
+HEADER_FORMAT = "<4sHHIIQQ"  # magic, version, header size, max channels, channel count, arena size, free offset
+HEADER_SIZE = 2 * ALIGNMENT
+ENTRY_FORMAT = "<40sQIII"  # name, offset, slot count, slot size, producer process ID
+ENTRY_SIZE = ALIGNMENT
+MAX_NAME_LENGTH = 40  # bytes (UTF-8)
+DEFAULT_MAX_CHANNELS = 64
+SPACE_POLL_INTERVAL = 0.05  # seconds
+
+_HEADER = struct.Struct(HEADER_FORMAT)
+_ENTRY = struct.Struct(ENTRY_FORMAT)
+_CHANNEL_COUNT_OFFSET = 12
+_WAITING_OFFSET = ALIGNMENT
+
+
+def segment_size(channels, max_channels=DEFAULT_MAX_CHANNELS):
+    """
+    Returns the number of bytes an arena needs to hold the given channels.
+
+    :param channels: List of (slot count, slot size) of the channels
+    :param max_channels: Number of entries of the directory
+    :return: Size in bytes
+    """
+    return HEADER_SIZE + max_channels * ENTRY_SIZE + sum(
+        ring_buffer.align(spsc_ring.segment_size(slot_count, slot_size)) for slot_count, slot_size in channels)
+
+
+class SharedArena(object):
+    """
+    Hosts many named channels in one shared memory segment (see the layout description above). Producers add a channel
+    each by `create_channel()`, a single consumer services all channels from one thread:
+
+        arena = SharedArena("cameras", size=64 * 1024 * 1024)   # creates the arena
+        while True:
+            for channel in arena.wait():
+                data = channel.get()
+
+    and in the producer processes:
+
+        channel = SharedArena("cameras").create_channel("front", slot_count=4, slot_size=1024 * 1024)
+        channel.put(data)
+
+    Waiting requires System V semaphores (Linux), both backends are supported.
+    """
+    def __init__(self, id, size=None, max_channels=DEFAULT_MAX_CHANNELS, key_file_path=None, log=True, backend=None):
+        """
+        Creates or attaches to the arena and opens its semaphores.
+
+        :param id: Unique system-wide unique name (str) of shared memory; this name is also used to create the unique
+        names of the semaphores `$id + "_ready"` and `$id + "_space"`
+        :param size: Number of bytes of the arena (see `segment_size()`) to create it (typically by the consumer),
+        `None` (the default) to attach to an existing one
+        :param max_channels: Maximum number of channels if the arena is created
+        :param key_file_path: Optional file path to a file typically named "shared_memory.key" whose first line is used
+        as the unique ID/name of the shared memory IF this file exists (see `ProducerIPC`)
+        :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+        :param backend: Backend providing shared memory and semaphores (see `ipc_backend`), `None` for the default
+        :except: `RuntimeError` if the arena cannot be created or doesn't exist, `ValueError` if `size` is too small
+        """
+        if not sysv_semaphore.is_supported():
+            raise RuntimeError("A shared arena requires System V semaphores, which are not supported on this platform.")
+        self._log = log
+        file_key = abstract_ipc.load_key(key_file_path, log)
+        self._backend = ipc_backend.get(backend)
+        self._shared_memory = self._backend.SharedMemory(file_key if file_key else str(id))
+        created = size is not None
+        if created:
+            if size < segment_size((), max_channels):
+                raise ValueError("An arena with " + str(max_channels) + " channels requires at least " +
+                                 str(segment_size((), max_channels)) + " bytes.")
+            self._create(size, max_channels)
+        elif not self._shared_memory.attach():
+            if self._shared_memory.error() == self._backend.SharedMemory.NotFound:
+                raise RuntimeError("Shared arena " + self._shared_memory.key() + " does not exist, start the process "
+                                   "creating it first.")
+            raise RuntimeError("Unable to attach to shared memory segment: " + self._shared_memory.errorString())
+        self._buf = memoryview(self._shared_memory.data())
+        magic, version, _, self._max_channels, _, self._size, _ = _HEADER.unpack_from(self._buf, 0)
+        if magic != MAGIC or version != VERSION:
+            self._shared_memory.detach()
+            raise RuntimeError("Shared memory segment does not contain a shared arena.")
+        self._channel_count = ctypes.c_uint32.from_buffer(self._buf, _CHANNEL_COUNT_OFFSET)
+        self._waiting = ctypes.c_uint32.from_buffer(self._buf, _WAITING_OFFSET)
+        # The creator resets the semaphores. Like in `AbstractIPC`, they are operated on without SEM_UNDO since they
+        # count wake-ups handed over between processes; the objects of the backend own them.
+        mode = self._backend.SystemSemaphore.Create if created else self._backend.SystemSemaphore.Open
+        self._owned_semaphores = (self._backend.SystemSemaphore(str(id) + "_ready", 0, mode),
+                                  self._backend.SystemSemaphore(str(id) + "_space", 0, mode))
+        self._sem_ready, self._sem_space = (
+            sysv_semaphore.SysVSemaphore(semaphore.key(), 0, sysv_semaphore.SysVSemaphore.Open, undo=False)
+            for semaphore in self._owned_semaphores)
+        self._channels = []  # ChannelConsumer per directory entry, in the order of the directory
+        self._next = 0  # index of the channel to check first by `wait()` (round robin)
+
+    def _create(self, size, max_channels):
+        if not self._shared_memory.create(size):
+            # Try to recover from a previous crash (see ProducerIPC):
+            self._shared_memory.attach()
+            self._shared_memory.detach()
+            if not self._shared_memory.create(size):
+                raise RuntimeError("Unable to create or recover shared memory segment: " +
+                                   self._shared_memory.errorString() + ". Another process is still attached to it.")
+        buf = memoryview(self._shared_memory.data())
+        abstract_ipc.lock(self._shared_memory)
+        directory_end = HEADER_SIZE + max_channels * ENTRY_SIZE
+        buf[:directory_end] = b"\0" * directory_end
+        _HEADER.pack_into(buf, 0, MAGIC, VERSION, HEADER_SIZE, max_channels, 0, size, directory_end)
+        self._shared_memory.unlock()
+        if self._log:
+            logzero.logger.debug("Created shared arena " + self._shared_memory.key() + " with " + str(size) +
+                                 " bytes for up to " + str(max_channels) + " channels.")
+
+    def __del__(self):
+        if hasattr(self, "_shared_memory"):
+            self._channels = []
+            self._shared_memory.detach()
+
+    @property
+    def max_channels(self):
+        return self._max_channels
+
+    @property
+    def size(self):
+        return self._size
+
+    def free_space(self):
+        """
+        Returns the number of bytes left for new channels.
+        """
+        return self._size - _HEADER.unpack_from(self._buf, 0)[6]
+
+    def _entry(self, index):
+        name, offset, slot_count, slot_size, pid = _ENTRY.unpack_from(self._buf, HEADER_SIZE + index * ENTRY_SIZE)
+        return name.rstrip(b"\0").decode("utf-8"), offset, slot_count, slot_size, pid
+
+    def _ring(self, offset, slot_count, slot_size):
+        return spsc_ring.SpscRing(self._buf[offset:offset + spsc_ring.segment_size(slot_count, slot_size)])
+
+    def create_channel(self, name, slot_count, slot_size):
+        """
+        Adds a channel to the arena to produce items for the consumer. If a channel of this name exists already and its
+        producer has exited, this process takes it over (keeping the unread items).
+
+        :param name: Name of the channel (at most `MAX_NAME_LENGTH` bytes as UTF-8)
+        :param slot_count: Number of slots, i.e., items the producer may write ahead of the consumer
+        :param slot_size: Maximum number of bytes per item
+        :return: `ChannelProducer`
+        :except: `ValueError` if the name is invalid, `RuntimeError` if the arena is full, the channel exists with
+        another geometry or its producer is still running
+        """
+        encoded = name.encode("utf-8")
+        if not encoded or len(encoded) > MAX_NAME_LENGTH or b"\0" in encoded:
+            raise ValueError("Channel names must have 1 to " + str(MAX_NAME_LENGTH) + " bytes (UTF-8).")
+        if slot_count <= 0 or slot_size <= 0:
+            raise ValueError("slot_count and slot_size must be positive.")
+        abstract_ipc.lock(self._shared_memory)
+        try:
+            count = self._channel_count.value
+            for index in range(count):
+                existing, offset, existing_count, existing_size, pid = self._entry(index)
+                if existing != name:
+                    continue
+                if (existing_count, existing_size) != (slot_count, slot_size):
+                    raise RuntimeError("Channel " + name + " exists with " + str(existing_count) + " slots of " +
+                                       str(existing_size) + " bytes.")
+                if pid and pid != os.getpid() and abstract_ipc.process_alive(pid):
+                    raise RuntimeError("Channel " + name + " is still used by process " + str(pid) + ".")
+                self._set_producer(index, os.getpid())
+                if self._log:
+                    logzero.logger.info("Took over channel " + name + " of shared arena " + self._shared_memory.key() +
+                                        ".")
+                return ChannelProducer(self, name, self._ring(offset, slot_count, slot_size), offset)
+            if count == self._max_channels:
+                raise RuntimeError("Shared arena " + self._shared_memory.key() + " has no room for more than " +
+                                   str(self._max_channels) + " channels.")
+            offset = _HEADER.unpack_from(self._buf, 0)[6]
+            size = ring_buffer.align(spsc_ring.segment_size(slot_count, slot_size))
+            if offset + size > self._size:
+                raise RuntimeError("Shared arena " + self._shared_memory.key() + " has only " +
+                                   str(self._size - offset) + " bytes left, channel " + name + " requires " +
+                                   str(size) + " bytes.")
+            ring = self._ring(offset, slot_count, slot_size)
+            ring.initialize(slot_count, slot_size)
+            _ENTRY.pack_into(self._buf, HEADER_SIZE + count * ENTRY_SIZE, encoded, offset, slot_count, slot_size,
+                             os.getpid())
+            struct.pack_into("<Q", self._buf, 24, offset + size)
+            spsc_ring.fence()  # the entry is complete before it is counted
+            self._channel_count.value = count + 1
+        finally:
+            self._shared_memory.unlock()
+        if self._log:
+            logzero.logger.debug("Created channel " + name + " with " + str(slot_count) + " slots of " +
+                                 str(slot_size) + " bytes in shared arena " + self._shared_memory.key() + ".")
+        return ChannelProducer(self, name, ring, offset)
+
+    def _set_producer(self, index, pid):
+        struct.pack_into("<I", self._buf, HEADER_SIZE + index * ENTRY_SIZE + _ENTRY.size - 4, pid)
+
+    def channels(self):
+        """
+        Returns the channels added by the producers so far (consumer only).
+
+        :return: List of `ChannelConsumer`s in the order they were added
+        """
+        count = self._channel_count.value
+        if count > len(self._channels):
+            spsc_ring.fence()  # pairs with the fence in create_channel()
+            for index in range(len(self._channels), count):
+                name, offset, slot_count, slot_size, _ = self._entry(index)
+                self._channels.append(ChannelConsumer(self, name, self._ring(offset, slot_count, slot_size), offset))
+        return list(self._channels)
+
+    def channel(self, name):
+        """
+        Returns a channel by its name (consumer only).
+
+        :param name: Name passed to `create_channel()`
+        :return: `ChannelConsumer` or `None` if no producer has added it yet
+        """
+        for channel in self.channels():
+            if channel.name == name:
+                return channel
+        return None
+
+    def _ready(self):
+        channels = self.channels()
+        start = self._next % len(channels) if channels else 0
+        ready = [channel for channel in channels[start:] + channels[:start] if channel.pending()]
+        if ready:
+            self._next = start + 1
+        return ready
+
+    def wait(self, timeout=None):
+        """
+        Waits until any channel has an item (consumer only). There must be only one consumer per arena.
+
+        :param timeout: Maximum time to wait in seconds, `None` to wait forever
+        :return: List of the `ChannelConsumer`s having items (rotated on every call so all channels are served fairly),
+        empty if the timeout expired
+        :except: `RuntimeError` if the semaphore cannot be acquired
+        """
+        ready = self._ready()
+        if ready:
+            return ready
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            self._waiting.value = 1
+            spsc_ring.fence()  # the flag is written before the heads are read again
+            ready = self._ready()
+            remaining = None if deadline is None else max(0.0, deadline - time.time())
+            if ready or not self._sem_ready.acquire(remaining):
+                self._waiting.value = 0
+                spsc_ring.fence()
+                if not ready and self._sem_ready.errorString():
+                    raise RuntimeError("Unable to acquire system semaphore (" + self._sem_ready.key() + "): " +
+                                       self._sem_ready.errorString())
+                return ready or self._ready()
+
+    def _notify(self):
+        """
+        Wakes up the consumer if it sleeps in `wait()` (called by producers after publishing).
+        """
+        if self._waiting.value:
+            self._waiting.value = 0
+            self._sem_ready.release()
+
+
+class ChannelProducer(object):
+    """
+    Writes the items of one channel of a `SharedArena`, returned by `SharedArena.create_channel()`.
+    """
+    def __init__(self, arena, name, ring, offset):
+        self._arena = arena
+        self._ring = ring
+        self._offset = offset  # of the ring within the arena
+        self.name = name
+        self._head = ring.head
+        self._transaction_started = False
+
+    @property
+    def slot_count(self):
+        return self._ring.slot_count
+
+    @property
+    def slot_size(self):
+        return self._ring.slot_size
+
+    def begin(self, size, timeout=None):
+        """
+        Starts writing an item in place, waiting for a free slot if the consumer is behind.
+
+        :param size: Number of bytes of the item
+        :param timeout: Maximum time to wait in seconds, `None` to wait forever
+        :return: Writable `memoryview` of `size` bytes
+        :except: `ValueError` if `size` exceeds the slot size, `abstract_ipc.TimeoutExpired` if no slot became free
+        within the timeout, `RuntimeError` if a transaction has been started already
+        """
+        if self._transaction_started:
+            raise RuntimeError("begin() has been called already without calling end().")
+        if size > self._ring.slot_size:
+            raise ValueError("Item of " + str(size) + " bytes exceeds the slot size of " + str(self._ring.slot_size) +
+                             " bytes of channel " + self.name + ".")
+        ring, head = self._ring, self._head
+        ready = lambda: head - ring.tail < ring.slot_count
+        deadline = None if timeout is None else time.time() + timeout
+        while not ready():
+            remaining = None if deadline is None else deadline - time.time()
+            if remaining is not None and remaining <= 0:
+                raise abstract_ipc.TimeoutExpired("No slot of channel " + self.name + " became free within the "
+                                                  "timeout.")
+            interval = SPACE_POLL_INTERVAL if remaining is None else min(remaining, SPACE_POLL_INTERVAL)
+            ring.wait_for_space(ready, self._arena._sem_space.acquire, interval)
+        self._transaction_started = True
+        index = head % ring.slot_count
+        ring.set_length(index, size)
+        offset = self._offset + ring.slot_offset(index)
+        return self._arena._buf[offset:offset + size]
+
+    def end(self):
+        """
+        Publishes the item started by `begin()` to the consumer.
+        """
+        if not self._transaction_started:
+            return
+        self._transaction_started = False
+        self._head += 1
+        self._ring.publish(self._head)  # includes the fence ordering the head before reading the waiting flag
+        self._arena._notify()
+
+    def abort(self):
+        """
+        Gives the slot of the item started by `begin()` back without publishing it, e.g. if writing it has failed.
+        """
+        self._transaction_started = False  # nothing is visible to the consumer before end() advanced the head
+
+    def put(self, data, timeout=None):
+        """
+        Copies an item into the channel.
+
+        :param data: Bytes-like object of at most `slot_size` bytes
+        :param timeout: Maximum time to wait for a free slot in seconds, `None` to wait forever
+        :except: see `begin()`
+        """
+        data = memoryview(data)
+        if hasattr(data, "cast"):
+            data = data.cast("B")
+        buf = self.begin(len(data), timeout)
+        try:
+            buf[:] = data
+        except BaseException:
+            self.abort()  # never publish a half-written item
+            raise
+        self.end()
+
+
+class ChannelConsumer(object):
+    """
+    Reads the items of one channel of a `SharedArena`, see `SharedArena.wait()` and `SharedArena.channels()`.
+    """
+    def __init__(self, arena, name, ring, offset):
+        self._arena = arena
+        self._ring = ring
+        self._offset = offset  # of the ring within the arena
+        self.name = name
+        self._transaction_started = False
+
+    @property
+    def slot_count(self):
+        return self._ring.slot_count
+
+    @property
+    def slot_size(self):
+        return self._ring.slot_size
+
+    def pending(self):
+        """
+        Returns the number of unread items.
+        """
+        return self._ring.head - self._ring.tail
+
+    def begin(self):
+        """
+        Starts reading the next item in place without waiting (use `SharedArena.wait()` for that).
+
+        :return: Read-only `memoryview` of the item or `None` if the channel is empty
+        :except: `RuntimeError` if a transaction has been started already
+        """
+        if self._transaction_started:
+            raise RuntimeError("begin() has been called already without calling end().")
+        ring = self._ring
+        tail = ring.tail
+        if ring.head == tail:
+            return None
+        spsc_ring.fence()  # acquire: the slot is read after the head
+        index = tail % ring.slot_count
+        offset = self._offset + ring.slot_offset(index)
+        view = self._arena._buf[offset:offset + ring.length(index)]
+        if hasattr(view, "toreadonly"):  # Python >= 3.8
+            view = view.toreadonly()
+        self._transaction_started = True
+        return view
+
+    def end(self):
+        """
+        Hands the slot of the item started by `begin()` back to the producer of the channel.
+        """
+        if not self._transaction_started:
+            return
+        self._transaction_started = False
+        if self._ring.release(self._ring.tail + 1):
+            self._arena._sem_space.release()
+
+    def get(self):
+        """
+        Copies the next item out of the channel without waiting.
+
+        :return: `bytes` or `None` if the channel is empty
+        """
+        view = self.begin()
+        if view is None:
+            return None
+        try:
+            return view.tobytes()
+        finally:
+            self.end()
@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import re
+import struct
+import sys
+
+import ipc_backend
+import logzero
+
+_BYTE_ORDERS = "@=<>!"
+_TOKEN = re.compile(r"\s*(\d*)([xcbB?hHiIlLqQnNefdspP])")
+_INTEGER_CODES = "bBhHiIlLqQnN"
+
+_libatomic = None
+
+
+def _fetch_add(size):
+    """
+    Returns libatomic's `__atomic_fetch_add_<size>()` (as ctypes function) or `None` if not available.
+    """
+    global _libatomic
+    if _libatomic is None:
+        _libatomic = False
+        path = ctypes.util.find_library("atomic")
+        if path is not None:
+            try:
+                _libatomic = ctypes.CDLL(path)
+            except OSError:
+                pass
+    function = getattr(_libatomic, "__atomic_fetch_add_" + str(size), None) if _libatomic else None
+    if function is not None:
+        value_type = {1: ctypes.c_uint8, 2: ctypes.c_uint16, 4: ctypes.c_uint32, 8: ctypes.c_uint64}[size]
+        function.argtypes = [ctypes.c_void_p, value_type, ctypes.c_int]
+        function.restype = value_type
+    return function
+
+
+class Field(collections.namedtuple("Field", ["name", "offset", "format", "code"])):
+    """
+    A single field of a `SharedStruct`: its name, its offset in bytes, its precompiled `struct.Struct` (`format`) and
+    its format character (`code`).
+    """
+    __slots__ = ()
+
+    @property
+    def size(self):
+        return self.format.size
+
+
+def parse(format, names):
+    """
+    Computes the offsets of the fields of a struct format.
+
+    :param format: Format string of the `struct` module, e.g. "<I?30s"
+    :param names: Names of the fields (padding bytes "x" don't have a name), e.g. ("counter", "stop_flag", "file_name")
+    :return: `collections.OrderedDict` mapping the names to `Field`s
+    :except: `ValueError` if the format is invalid or doesn't match the names
+    """
+    byte_order = format[0] if format and format[0] in _BYTE_ORDERS else "@"
+    body = format[1:] if format and format[0] in _BYTE_ORDERS else format
+    names = list(names)
+    fields = collections.OrderedDict()
+    prefix = ""
+    position = 0
+    while position < len(body.rstrip()):
+        match = _TOKEN.match(body, position)
+        if match is None:
+            raise ValueError("Invalid struct format: " + format)
+        position = match.end()
+        count, code = match.groups()
+        token = count + code
+        if code != "x":
+            if not names:
+                raise ValueError("Struct format " + format + " has more fields than names.")
+            field_format = struct.Struct(byte_order + token)
+            # Offset incl. the padding inserted (for native alignment) before the field:
+            offset = struct.calcsize(byte_order + prefix + token) - field_format.size
+            name = names.pop(0)
+            fields[name] = Field(name, offset, field_format, code)
+        prefix += token
+    if names:
+        raise ValueError("Struct format " + format + " has less fields than names.")
+    return fields
+
+
+class SharedStruct(object):
+    """
+    Maps a struct with named fields (see `parse()`) onto a shared memory segment which stays attached until this
+    object is deleted.
+
+    Every field has a precompiled `struct.Struct` and a cached offset, so reading or writing a single field only
+    touches its own bytes (`unpack_from()`/`pack_into()` directly on the shared memory) without locking it. Use
+    `read()`/`write()` (or `locked()`) to access several fields consistently and `increment()` to update counters
+    (atomically if libatomic is available).
+    """
+    def __init__(self, key, format, names, create=False, log=True, backend=None):
+        """
+        Attaches to (or creates) the shared memory segment.
+
+        :param key: Unique system-wide name (str) of the shared memory
+        :param format: Format string of the `struct` module, e.g. "<I?30s"
+        :param names: Names of the fields, e.g. ("counter", "stop_flag", "file_name")
+        :param create: `True` to create the segment (zero-initialized) if it doesn't exist yet, `False` to only attach
+        :param log: `True` to enable logging using `logzero.logger`, `False` otherwise
+        :param backend: Backend providing the shared memory (see `ipc_backend`), `None` for the default
+        :except: `RuntimeError` if the segment cannot be attached or created or is too small, `ValueError` if the
+        format doesn't match the names
+        """
+        self._log = log
+        self._fields = parse(format, names)
+        self._size = struct.calcsize(format)
+        self._shared_memory = ipc_backend.get(backend).SharedMemory(key)
+        if not (create and self._shared_memory.create(self._size)) and not self._shared_memory.attach():
+            raise RuntimeError("Unable to attach to shared memory segment: " + self._shared_memory.errorString())
+        if self._shared_memory.size() < self._size:
+            self._shared_memory.detach()
+            raise RuntimeError("Shared memory segment " + key + " is smaller than the struct " + format + ".")
+        self._buf = memoryview(self._shared_memory.data())[:self._size]
+        self._byte_order = format[0] if format and format[0] in _BYTE_ORDERS else "@"
+        self._atomics = {}  # field name -> (fetch_add function, address), cached by increment()
+        if self._log:
+            logzero.logger.debug("Attached to shared struct " + key + " (" + format + ").")
+
+    def __del__(self):
+        if hasattr(self, "_shared_memory"):
+            self._shared_memory.detach()
+
+    @property
+    def fields(self):
+        """`collections.OrderedDict` mapping the field names to `Field`s."""
+        return self._fields
+
+    def __getitem__(self, name):
+        field = self._fields[name]
+        value = field.format.unpack_from(self._buf, field.offset)
+        return value[0] if len(value) == 1 else value
+
+    def __setitem__(self, name, value):
+        field = self._fields[name]
+        if isinstance(value, tuple):
+            field.format.pack_into(self._buf, field.offset, *value)
+        else:
+            field.format.pack_into(self._buf, field.offset, value)
+
+    @contextlib.contextmanager
+    def locked(self):
+        """
+        Locks the shared memory (system-wide) while in the "with" statement, e.g., to update several fields.
+        """
+        if not self._shared_memory.lock():
+            raise RuntimeError("Unable to lock shared memory segment: " + self._shared_memory.errorString())
+        try:
+            yield self
+        finally:
+            self._shared_memory.unlock()
+
+    def read(self):
+        """
+        Reads all fields at once (while locking the shared memory).
+
+        :return: `collections.OrderedDict` mapping the field names to their values
+        """
+        with self.locked():
+            return collections.OrderedDict((name, self[name]) for name in self._fields)
+
+    def write(self, **values):
+        """
+        Writes the given fields (while locking the shared memory), e.g. `write(counter=0, stop_flag=False)`.
+        """
+        with self.locked():
+            for name, value in values.items():
+                self[name] = value
+
+    def increment(self, name, delta=1):
+        """
+        Adds `delta` to an integer field (wrapping around on overflow). The update is atomic without locking the
+        shared memory if libatomic is available and the field is naturally aligned and stored in native byte order;
+        otherwise, the shared memory is locked.
+
+        :param name: Name of the field
+        :param delta: Value to add (may be negative)
+        :return: New value of the field
+        :except: `ValueError` if the field is not a single integer
+        """
+        field = self._fields[name]
+        if field.code not in _INTEGER_CODES or len(field.format.unpack_from(self._buf, field.offset)) != 1:
+            raise ValueError("Field " + name + " is not a single integer.")
+        bits = 8 * field.size
+        unsigned = struct.Struct(self._byte_order + {1: "B", 2: "H", 4: "I", 8: "Q"}[field.size])
+        atomic = self._atomics.get(name)
+        if atomic is None:
+            atomic = self._atomic(field)
+            self._atomics[name] = atomic
+        if atomic:
+            fetch_add, address = atomic
+            old = fetch_add(address, delta % (1 << bits), 5)  # __ATOMIC_SEQ_CST
+            # Convert the (unsigned) result to the field's type:
+            return field.format.unpack(unsigned.pack((old + delta) % (1 << bits)))[0]
+        with self.locked():
+            value = unsigned.unpack_from(self._buf, field.offset)[0]
+            unsigned.pack_into(self._buf, field.offset, (value + delta) % (1 << bits))
+            return field.format.unpack_from(self._buf, field.offset)[0]
+
+    def _atomic(self, field):
+        """
+        Returns (fetch_add function, address) to update `field` atomically or `False` if that's not possible.
+        """
+        native = self._byte_order in "@=" or (self._byte_order == "<") == (sys.byteorder == "little")
+        function = _fetch_add(field.size) if native else None
+        if function is None:
+            return False
+        address = ctypes.addressof(ctypes.c_char.from_buffer(self._buf, field.offset))
+        if address % field.size:
+            return False
+        return function, address
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import ctypes
+import struct
+import threading
+import time
+
+import ring_buffer
+
+# Layout of a shared memory segment in lock-free mode (must match `src/prodcon_ipc/spsc_header.h`):
+#
+#   [header (HEADER_SIZE bytes)][slot length table (slot_count * uint64)][slot 0][slot 1]...[slot N-1]
+#
+#   offset   0: magic, version, header size, slot count, slot size
+#   offset  64: head (uint64), producer waiting flag (uint32)  -- written by the producer
+#   offset 128: tail (uint64), consumer waiting flag (uint32)  -- written by the consumer
+#
+# Unlike `ring_buffer`, there is exactly one producer and one consumer and the shared memory is never locked: each side
+# only writes its own counter (head resp. tail, each on a separate cache line) with release semantics and reads the
+# other one with acquire semantics. The semaphores are only used to sleep if the ring is empty (consumer) or full
+# (producer): the waiting side sets its flag, re-checks the counter and acquires the semaphore; the other side releases
+# the semaphore after updating its counter only if the flag is set. Slots have a fixed size, they are not reallocated.
+MAGIC = b"PCSP"
+VERSION = 1
+ALIGNMENT = ring_buffer.ALIGNMENT
+HEADER_FORMAT = "<4sHHII"  # magic, version, header size, slot count, slot size
+HEADER_SIZE = 3 * ALIGNMENT
+LENGTH_FORMAT = "<Q"
+SPIN = 200  # number of times to poll the counter before going to sleep on the semaphore
+
+_HEADER = struct.Struct(HEADER_FORMAT)
+_LENGTH = struct.Struct(LENGTH_FORMAT)
+
+_HEAD_OFFSET = ALIGNMENT
+_PRODUCER_WAITING_OFFSET = ALIGNMENT + 8
+_TAIL_OFFSET = 2 * ALIGNMENT
+_CONSUMER_WAITING_OFFSET = 2 * ALIGNMENT + 8
+
+# Python has no atomics, but aligned 8-byte loads and stores done by ctypes are single instructions (i.e., not torn).
+# An uncontended lock is acquired and released by atomic read-modify-write instructions which act as a full memory
+# barrier, so it is used to order the accesses to the counters and flags:
+_fence_lock = threading.Lock()
+
+
+def fence():
+    """
+    Issues a full memory barrier.
+    """
+    with _fence_lock:
+        pass
+
+
+def data_offset(slot_count):
+    """
+    Returns the offset of the first slot, i.e., the size of the header including the slot length table.
+
+    :param slot_count: Number of slots
+    :return: Offset in bytes
+    """
+    return HEADER_SIZE + ring_buffer.align(slot_count * _LENGTH.size)
+
+
+def segment_size(slot_count, slot_size):
+    """
+    Returns the number of bytes a shared memory segment needs to hold the header and all slots.
+
+    :param slot_count: Number of slots
+    :param slot_size: Maximum number of bytes per slot
+    :return: Size in bytes
+    """
+    return data_offset(slot_count) + slot_count * ring_buffer.align(slot_size)
+
+
+class SpscRing(object):
+    """
+    Provides access to a lock-free single-producer/single-consumer ring located at the beginning of a shared memory
+    segment.
+    """
+    def __init__(self, buf):
+        """
+        Wraps the given memory.
+
+        :param buf: Writable `memoryview` of the whole shared memory segment
+        """
+        self._buf = buf
+        self._head = ctypes.c_uint64.from_buffer(buf, _HEAD_OFFSET)
+        self._producer_waiting = ctypes.c_uint32.from_buffer(buf, _PRODUCER_WAITING_OFFSET)
+        self._tail = ctypes.c_uint64.from_buffer(buf, _TAIL_OFFSET)
+        self._consumer_waiting = ctypes.c_uint32.from_buffer(buf, _CONSUMER_WAITING_OFFSET)
+        self._slot_count = 0
+        self._slot_size = 0
+        if self.is_valid():
+            self._cache_layout()
+
+    def initialize(self, slot_count, slot_size):
+        """
+        Writes a fresh header (an empty ring).
+
+        :param slot_count: Number of slots
+        :param slot_size: Maximum number of bytes per slot
+        """
+        self._buf[:data_offset(slot_count)] = b"\0" * data_offset(slot_count)
+        _HEADER.pack_into(self._buf, 0, MAGIC, VERSION, HEADER_SIZE, slot_count, slot_size)
+        self._cache_layout()
+
+    def _cache_layout(self):
+        _, _, _, self._slot_count, self._slot_size = _HEADER.unpack_from(self._buf, 0)
+        self._stride = ring_buffer.align(self._slot_size)
+        self._data_offset = data_offset(self._slot_count)
+
+    def is_valid(self):
+        """
+        Checks whether the memory contains a lock-free ring header of a supported version.
+
+        :return: `True` if so, `False` otherwise
+        """
+        if len(self._buf) < HEADER_SIZE:
+            return False
+        magic, version = struct.unpack_from("<4sH", self._buf, 0)
+        return magic == MAGIC and version == VERSION
+
+    @property
+    def slot_count(self):
+        return self._slot_count
+
+    @property
+    def slot_size(self):
+        return self._slot_size
+
+    @property
+    def head(self):
+        """Sequence number of the next slot to be written by the producer."""
+        return self._head.value
+
+    @property
+    def tail(self):
+        """Sequence number of the next slot to be read by the consumer."""
+        return self._tail.value
+
+    def length(self, index):
+        """
+        Returns the number of bytes stored in a slot.
+
+        :param index: Slot index (not the sequence number)
+        :return: Size in bytes
+        """
+        return _LENGTH.unpack_from(self._buf, HEADER_SIZE + index * _LENGTH.size)[0]
+
+    def set_length(self, index, length):
+        _LENGTH.pack_into(self._buf, HEADER_SIZE + index * _LENGTH.size, length)
+
+    def slot_offset(self, index):
+        """
+        Returns the offset of a slot relative to the beginning of the segment.
+
+        :param index: Slot index (not the sequence number)
+        :return: Offset in bytes
+        """
+        return self._data_offset + index * self._stride
+
+    def publish(self, head):
+        """
+        Publishes all items before `head` to the consumer (producer only).
+
+        :param head: New value of the head
+        :return: `True` if the consumer sleeps and needs to be woken up by releasing `_sem_full`, `False` otherwise
+        """
+        return self._store(self._head, head, self._consumer_waiting)
+
+    def release(self, tail):
+        """
+        Hands all slots before `tail` back to the producer (consumer only).
+
+        :param tail: New value of the tail
+        :return: `True` if the producer sleeps and needs to be woken up by releasing `_sem_empty`, `False` otherwise
+        """
+        return self._store(self._tail, tail, self._producer_waiting)
+
+    def wait_for_data(self, ready, acquire, timeout=None):
+        """
+        Waits until `ready()` returns `True`, typically if the head has passed a certain sequence number (consumer
+        only).
+
+        :param ready: Callable checking the condition
+        :param acquire: Callable acquiring `_sem_full` with a timeout in seconds (or `None`), returns `False` if the
+        timeout expired
+        :param timeout: Maximum time to wait in seconds, `None` to wait forever
+        :return: `True` if the condition is met, `False` if the timeout expired
+        """
+        return self._wait(self._consumer_waiting, ready, acquire, timeout)
+
+    def wait_for_space(self, ready, acquire, timeout=None):
+        """
+        Waits until `ready()` returns `True`, typically if the tail has passed a certain sequence number (producer
+        only). See `wait_for_data()` for the parameters, `acquire` acquires `_sem_empty`.
+        """
+        return self._wait(self._producer_waiting, ready, acquire, timeout)
+
+    @staticmethod
+    def _store(counter, value, waiting):
+        fence()  # release: the slot (length) is written before the counter
+        counter.value = value
+        fence()  # the counter is written before the flag is read (pairs with the fence in _wait())
+        if waiting.value:
+            waiting.value = 0
+            return True
+        return False
+
+    @staticmethod
+    def _wait(waiting, ready, acquire, timeout):
+        for _ in range(SPIN):
+            if ready():
+                fence()  # acquire: the slot is read after the counter
+                return True
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            waiting.value = 1
+            fence()  # the flag is written before the counter is read again
+            if ready():
+                waiting.value = 0
+                fence()
+                return True
+            remaining = None if deadline is None else max(0.0, deadline - time.time())
+            if not acquire(remaining):
+                waiting.value = 0
+                fence()
+                return ready()
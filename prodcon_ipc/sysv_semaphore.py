@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import ctypes
+import ctypes.util
+import errno
+import hashlib
+import os
+import tempfile
+
+# PyQt does not release the GIL while `QSystemSemaphore.acquire()` blocks, so waiting in a Python thread would block
+# all other threads as well. On Unix (without QT_POSIX_IPC), Qt implements `QSystemSemaphore` by a System V semaphore
+# whose key is derived from a file in the temp directory. This module operates on the very same semaphore using
+# ctypes, which releases the GIL during the call. It can also create semaphores the same way Qt does, so it replaces
+# `QSystemSemaphore` in the Qt-free backend (see `ipc_backend`).
+
+SEM_UNDO = 0x1000  # Qt uses this flag for all operations, so do we by default
+IPC_CREAT = 0o1000
+IPC_EXCL = 0o2000
+IPC_NOWAIT = 0o4000
+IPC_RMID = 0
+IPC_STAT = 2
+GETPID = 11
+GETVAL = 12
+GETNCNT = 14
+SETVAL = 16
+KEY_FILE_PREFIX = "qipc_systemsem_"
+_ONE = ctypes.c_size_t(1)
+
+
+class _SemBuf(ctypes.Structure):
+    _fields_ = [("sem_num", ctypes.c_ushort), ("sem_op", ctypes.c_short), ("sem_flg", ctypes.c_short)]
+
+
+class _TimeSpec(ctypes.Structure):
+    _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.ftok.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        _libc.semget.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int]
+    return _libc
+
+
+def key_file_path(key, prefix=KEY_FILE_PREFIX):
+    """
+    Returns the path of the file Qt derives the System V key of a `QSystemSemaphore` from (see
+    `QSharedMemoryPrivate::makePlatformSafeKey()`).
+
+    :param key: Key (name) of the `QSystemSemaphore`
+    :param prefix: Prefix of the file name, Qt uses another one for `QSharedMemory`
+    :return: Path of the key file
+    """
+    name = prefix + "".join(c for c in key if ("a" <= c <= "z") or ("A" <= c <= "Z"))
+    return os.path.join(tempfile.gettempdir(), name + hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+
+def create_key_file(path):
+    """
+    Creates the file a System V key is derived from (see `QSharedMemoryPrivate::createUnixKeyFile()`).
+
+    :param path: Path of the key file, see `key_file_path()`
+    :return: `True` if the file has been created, `False` if it existed already
+    :except: `OSError` if the file cannot be created
+    """
+    try:
+        os.close(os.open(path, os.O_EXCL | os.O_CREAT | os.O_RDWR, 0o640))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+        return False
+    return True
+
+
+def remove_key_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def is_supported():
+    """
+    Checks whether System V semaphores can be used on this platform.
+
+    :return: `True` if so, `False` otherwise
+    """
+    if not hasattr(os, "fork") or ctypes.util.find_library("c") is None:
+        return False
+    try:
+        return hasattr(_load_libc(), "semtimedop")
+    except OSError:
+        return False
+
+
+class SysVSemaphore(object):
+    """
+    Provides access to the System V semaphore backing a `QSystemSemaphore` (Linux only).
+    """
+    Open = 0  # same values as `QSystemSemaphore.AccessMode`
+    Create = 1
+
+    def __init__(self, key, initial_value=0, mode=None, undo=True):
+        """
+        Opens or creates the semaphore.
+
+        :param key: Key (name) of the `QSystemSemaphore`
+        :param initial_value: Value of the semaphore if it is created
+        :param mode: `None` (the default) to open an existing semaphore only (created by Qt or this class in any
+        process); like `QSystemSemaphore`, `Open` creates it if it doesn't exist yet and `Create` additionally resets it
+        to `initial_value`. Semaphores created by `Open` or `Create` are removed by `close()` (or when this object is
+        deleted), just like Qt does.
+        :param undo: `True` (the default) to let the kernel undo the operations of this process when it exits
+        (`SEM_UNDO`, like Qt), `False` for semaphores counting resources handed over between processes: the kernel
+        limits the undo value per process to 32767, so such a semaphore fails with `ERANGE` after as many operations in
+        one direction
+        :except: `RuntimeError` if the semaphore cannot be opened or created
+        """
+        self._libc = _load_libc()
+        self._key = key
+        self._id = -1
+        self._flags = SEM_UNDO if undo else 0
+        # Preallocated operations of acquire() and release(), they are called for every transaction:
+        self._decrement = ctypes.byref(_SemBuf(0, -1, self._flags))
+        self._increment = ctypes.byref(_SemBuf(0, 1, self._flags))
+        self._try_decrement = ctypes.byref(_SemBuf(0, -1, self._flags | IPC_NOWAIT))
+        self._owner = False  # whether we remove the semaphore and its key file
+        self._file = key_file_path(key)
+        self._initial_value = initial_value
+        self._mode = mode
+        self._open(mode)
+        self._error = ""
+
+    def _open(self, mode):
+        """
+        Implements opening or creating the semaphore, see `__init__()`.
+        """
+        key = self._key
+        created_file = False
+        if mode is not None:
+            try:
+                created_file = create_key_file(self._file)
+            except OSError as e:
+                raise RuntimeError("Unable to create system semaphore " + key + ": " + os.strerror(e.errno))
+        unix_key = self._libc.ftok(self._file.encode("utf-8"), ord("Q"))
+        if unix_key == -1:
+            raise RuntimeError("Unable to open system semaphore " + key + ": " + os.strerror(ctypes.get_errno()))
+        if mode is None:
+            self._id = self._libc.semget(unix_key, 1, 0o600)
+        else:
+            self._id = self._libc.semget(unix_key, 1, 0o600 | IPC_CREAT | IPC_EXCL)
+            self._owner = self._id != -1 or mode == self.Create
+            if self._id == -1 and ctypes.get_errno() == errno.EEXIST:
+                self._id = self._libc.semget(unix_key, 1, 0o600 | IPC_CREAT)
+        if self._id == -1:
+            error = ctypes.get_errno()
+            if created_file:
+                remove_key_file(self._file)
+            raise RuntimeError("Unable to open system semaphore " + key + ": " + os.strerror(error))
+        if self._owner and self._libc.semctl(ctypes.c_int(self._id), ctypes.c_int(0), ctypes.c_int(SETVAL),
+                                             ctypes.c_int(self._initial_value)) == -1:
+            error = ctypes.get_errno()
+            self.close()
+            raise RuntimeError("Unable to initialize system semaphore " + key + ": " + os.strerror(error))
+
+    def _reopen(self):
+        """
+        Opens the semaphore again after it has been removed (e.g. by the process owning it, which has exited), creating
+        it unless it was opened with mode `None`. Qt does the same in `QSystemSemaphore`.
+
+        :return: `True` on success, `False` otherwise
+        """
+        try:
+            self._open(None if self._mode is None else self.Open)
+        except RuntimeError:
+            return False
+        return True
+
+    def __del__(self):
+        if getattr(self, "_owner", False):
+            self.close()
+
+    def close(self):
+        """
+        Removes the semaphore (and its key file) if we created it.
+        """
+        if self._owner:
+            self._libc.semctl(ctypes.c_int(self._id), ctypes.c_int(0), ctypes.c_int(IPC_RMID))
+            remove_key_file(self._file)
+            self._owner = False
+
+    def key(self):
+        return self._key
+
+    def errorString(self):
+        return self._error
+
+    def _modify(self, operation, timeout):
+        # semtimedop() has no argtypes since converting the arguments would double the cost of the call, so they are
+        # passed as ctypes objects (or int for the semaphore ID):
+        spec = None
+        if timeout is not None:
+            spec = ctypes.byref(_TimeSpec(int(timeout), int((timeout - int(timeout)) * 1e9)))
+        reopened = False
+        while True:
+            if self._libc.semtimedop(self._id, operation, _ONE, spec) == 0:
+                return True
+            error = ctypes.get_errno()
+            if error == errno.EINTR:
+                continue  # retry (the remaining timeout is not adjusted)
+            if error in (errno.EIDRM, errno.EINVAL) and not reopened and self._reopen():
+                reopened = True
+                continue  # dito
+            if error != errno.EAGAIN:
+                self._error = os.strerror(error)
+            return False
+
+    def acquire(self, timeout=None):
+        """
+        Decrements the semaphore, blocks (without holding the GIL) while it is 0.
+
+        :param timeout: Maximum time to wait in seconds, `None` to wait forever
+        :return: `True` on success, `False` on errors or if the timeout expired
+        """
+        self._error = ""
+        return self._modify(self._decrement, timeout)
+
+    def try_acquire(self):
+        """
+        Decrements the semaphore if it is not 0, without blocking (cheaper than `acquire(0)`).
+
+        :return: `True` on success, `False` on errors or if it is 0
+        """
+        self._error = ""
+        return self._modify(self._try_decrement, None)
+
+    def release(self, n=1):
+        """
+        Increments the semaphore by `n`.
+
+        :param n: Number of resources to release
+        :return: `True` on success, `False` otherwise
+        """
+        self._error = ""
+        return self._modify(self._increment if n == 1 else ctypes.byref(_SemBuf(0, n, self._flags)), None)
+
+    def value(self):
+        """
+        Returns the current value of the semaphore.
+
+        :return: Value, -1 on errors
+        """
+        return self._libc.semctl(ctypes.c_int(self._id), ctypes.c_int(0), ctypes.c_int(GETVAL))
+
+    def set_value(self, value):
+        """
+        Sets the value of the semaphore, e.g. to resynchronize it with the state it counts. This also clears the undo
+        values of all processes (see `undo` of `__init__()`).
+
+        :param value: New value
+        :return: `True` on success, `False` otherwise
+        """
+        self._error = ""
+        if self._libc.semctl(ctypes.c_int(self._id), ctypes.c_int(0), ctypes.c_int(SETVAL), ctypes.c_int(value)) == -1:
+            self._error = os.strerror(ctypes.get_errno())
+            return False
+        return True
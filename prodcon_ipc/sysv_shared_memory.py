@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import ctypes
+import ctypes.util
+import errno
+import os
+
+import segment_memory
+import sysv_semaphore
+
+# Replacement of `QSharedMemory` for the Qt-free backend (see `ipc_backend`). On Unix (without QT_POSIX_IPC), Qt
+# implements `QSharedMemory` by a System V shared memory segment whose key is derived from a file in the temp directory
+# and locks it using a `QSystemSemaphore` of the same name. This class does the very same using ctypes, so it is
+# interoperable with `QSharedMemory` (Linux only, 64 bit).
+
+KEY_FILE_PREFIX = "qipc_sharedmemory_"
+_NATTCH_OFFSET = 88  # of `shm_nattch` in `struct shmid_ds` (64 bit Linux)
+_SEGSZ_OFFSET = 48  # of `shm_segsz`
+_CPID_OFFSET = 80  # of `shm_cpid`
+_LPID_OFFSET = 84  # of `shm_lpid`
+_SHMID_DS_SIZE = 256  # more than `sizeof(struct shmid_ds)`
+
+_libc = None
+
+
+def _load_libc():
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.ftok.argtypes = [ctypes.c_char_p, ctypes.c_int]
+        _libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        _libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        _libc.shmat.restype = ctypes.c_void_p
+        _libc.shmdt.argtypes = [ctypes.c_void_p]
+        _libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+    return _libc
+
+
+def is_supported():
+    """
+    Checks whether System V shared memory can be used on this platform.
+
+    :return: `True` if so, `False` otherwise
+    """
+    if not sysv_semaphore.is_supported() or not os.uname()[0] == "Linux" or ctypes.sizeof(ctypes.c_void_p) != 8:
+        return False
+    return hasattr(_load_libc(), "shmget")
+
+
+def status(id):
+    """
+    Returns the status of a System V shared memory segment (see `shmctl(IPC_STAT)`).
+
+    :param id: System V ID of the segment
+    :return: `dict` with the keys "size" (bytes), "attached" (number of attached processes), "creator" and "last" (IDs
+    of the creating process and the one which attached or detached last); `None` if the segment doesn't exist
+    """
+    info = ctypes.create_string_buffer(_SHMID_DS_SIZE)
+    if _load_libc().shmctl(id, sysv_semaphore.IPC_STAT, info) == -1:
+        return None
+    return {"size": ctypes.c_size_t.from_buffer(info, _SEGSZ_OFFSET).value,
+            "attached": ctypes.c_ulong.from_buffer(info, _NATTCH_OFFSET).value,
+            "creator": ctypes.c_int.from_buffer(info, _CPID_OFFSET).value,
+            "last": ctypes.c_int.from_buffer(info, _LPID_OFFSET).value}
+
+
+class SysVSharedMemory(object):
+    """
+    Implements the part of the `QSharedMemory` interface used by this package.
+    """
+    # Same values as `QSharedMemory.SharedMemoryError`:
+    NoError = 0
+    PermissionDenied = 1
+    InvalidSize = 2
+    KeyError = 3
+    AlreadyExists = 4
+    NotFound = 5
+    LockError = 6
+    OutOfResources = 7
+    UnknownError = 8
+
+    def __init__(self, key):
+        """
+        :param key: Key (name) of the shared memory, see `QSharedMemory`
+        """
+        self._libc = _load_libc()
+        self._key = key
+        self._file = sysv_semaphore.key_file_path(key, KEY_FILE_PREFIX)
+        self._address = None
+        self._size = 0
+        self._buffer = None
+        self._semaphore = None  # SysVSemaphore used by lock()
+        self._locked = False
+        self._error = self.NoError
+        self._error_string = ""
+
+    def __del__(self):
+        if getattr(self, "_address", None) is not None:
+            self.detach()
+        if getattr(self, "_semaphore", None) is not None:
+            self._semaphore.close()
+
+    def key(self):
+        return self._key
+
+    def error(self):
+        return self._error
+
+    def errorString(self):
+        return self._error_string
+
+    def _set_error(self, function, error=None):
+        """
+        Sets the error (like `QSharedMemoryPrivate::setErrorString()`) and returns `False`.
+        """
+        error = ctypes.get_errno() if error is None else error
+        codes = {errno.EACCES: self.PermissionDenied, errno.EEXIST: self.AlreadyExists, errno.ENOENT: self.NotFound,
+                 errno.EMFILE: self.OutOfResources, errno.ENOMEM: self.OutOfResources,
+                 errno.ENOSPC: self.OutOfResources, errno.EINVAL: self.InvalidSize}
+        self._error = codes.get(error, self.UnknownError)
+        messages = {self.AlreadyExists: "already exists", self.NotFound: "doesn't exist",
+                    self.InvalidSize: "system-imposed size restrictions"}
+        self._error_string = "QSharedMemory::" + function + ": " + messages.get(self._error, os.strerror(error))
+        return False
+
+    def _open_semaphore(self, mode):
+        if self._semaphore is None:
+            self._semaphore = sysv_semaphore.SysVSemaphore(self._key, 1, mode)
+
+    def _unix_key(self, function):
+        if not os.path.exists(self._file):
+            self._error = self.NotFound
+            self._error_string = "QSharedMemory::" + function + ": UNIX key file doesn't exist"
+            return -1
+        unix_key = self._libc.ftok(self._file.encode("utf-8"), ord("Q"))
+        if unix_key == -1:
+            self._set_error(function)
+            self._error = self.KeyError
+        return unix_key
+
+    def create(self, size, huge_pages=False):
+        """
+        Creates the segment and attaches to it. Like `QSharedMemory`, this process then owns the lock.
+
+        :param size: Size in bytes
+        :param huge_pages: `True` to allocate the segment from the pool of huge pages (`SHM_HUGETLB`, see
+        `segment_memory`), which fails if the pool (`vm.nr_hugepages`) is too small
+        :return: `True` on success, `False` otherwise (see `error()`)
+        """
+        if self._address is not None:
+            return self._set_error("create", errno.EEXIST)
+        try:
+            if self._semaphore is not None:
+                self._semaphore.close()
+                self._semaphore = None
+            self._open_semaphore(sysv_semaphore.SysVSemaphore.Create)
+            created_file = sysv_semaphore.create_key_file(self._file)
+        except (RuntimeError, OSError) as e:
+            self._error = self.KeyError
+            self._error_string = "QSharedMemory::create: " + str(e)
+            return False
+        if not self.lock():
+            return False
+        try:
+            unix_key = self._unix_key("create")
+            if unix_key == -1:
+                return False
+            flags = 0o600 | sysv_semaphore.IPC_CREAT | sysv_semaphore.IPC_EXCL
+            if huge_pages:
+                flags |= segment_memory.SHM_HUGETLB
+            if self._libc.shmget(unix_key, size, flags) == -1:
+                self._set_error("create")
+                if created_file and self._error != self.AlreadyExists:
+                    sysv_semaphore.remove_key_file(self._file)
+                return False
+            return self._attach(unix_key)
+        finally:
+            self.unlock()
+
+    def attach(self):
+        """
+        Attaches to an existing segment.
+
+        :return: `True` on success, `False` otherwise (see `error()`)
+        """
+        if self._address is not None:
+            return False
+        try:
+            self._open_semaphore(sysv_semaphore.SysVSemaphore.Open)
+        except RuntimeError as e:
+            self._error = self.KeyError
+            self._error_string = "QSharedMemory::attach: " + str(e)
+            return False
+        if not self.lock():
+            return False
+        try:
+            unix_key = self._unix_key("attach")
+            return unix_key != -1 and self._attach(unix_key)
+        finally:
+            self.unlock()
+
+    def _attach(self, unix_key):
+        id = self._libc.shmget(unix_key, 0, 0o600)
+        if id == -1:
+            return self._set_error("attach")
+        address = self._libc.shmat(id, None, 0)
+        if address is None or address == ctypes.c_void_p(-1).value:
+            return self._set_error("attach")
+        info = ctypes.create_string_buffer(_SHMID_DS_SIZE)
+        if self._libc.shmctl(id, sysv_semaphore.IPC_STAT, info) == -1:
+            self._set_error("attach")
+            self._libc.shmdt(address)
+            return False
+        self._address = address
+        self._size = ctypes.c_size_t.from_buffer(info, _SEGSZ_OFFSET).value
+        self._buffer = (ctypes.c_char * self._size).from_address(address)
+        return True
+
+    def isAttached(self):
+        return self._address is not None
+
+    def detach(self):
+        """
+        Detaches from the segment and removes it if no process is attached anymore (like `QSharedMemory`). Views
+        returned by `data()` must not be used afterwards.
+
+        :return: `True` on success, `False` otherwise
+        """
+        if self._address is None:
+            return False
+        locked = self._semaphore is not None and self.lock()
+        try:
+            self._buffer = None
+            if self._libc.shmdt(self._address) == -1:
+                return self._set_error("detach")
+            self._address = None
+            self._size = 0
+            unix_key = self._unix_key("detach")
+            id = self._libc.shmget(unix_key, 0, 0o400) if unix_key != -1 else -1
+            info = ctypes.create_string_buffer(_SHMID_DS_SIZE)
+            if id == -1 or self._libc.shmctl(id, sysv_semaphore.IPC_STAT, info) == -1:
+                return self._set_error("detach")
+            if not ctypes.c_ulong.from_buffer(info, _NATTCH_OFFSET).value:
+                if self._libc.shmctl(id, sysv_semaphore.IPC_RMID, None) == -1:
+                    return self._set_error("detach")
+                sysv_semaphore.remove_key_file(self._file)
+            return True
+        finally:
+            if locked:
+                self.unlock()
+
+    def size(self):
+        return self._size
+
+    def data(self):
+        """
+        :return: Writable `memoryview` of the whole segment, `None` if not attached
+        """
+        return memoryview(self._buffer).cast("B") if self._buffer is not None else None
+
+    def constData(self):
+        """
+        :return: Read-only `memoryview` of the whole segment, `None` if not attached
+        """
+        return self.data().toreadonly() if self._buffer is not None else None
+
+    def lock(self):
+        """
+        Locks the segment system-wide (like `QSharedMemory.lock()`).
+
+        :return: `True` on success, `False` otherwise
+        """
+        if self._locked:
+            return True
+        if self._semaphore is None or not self._semaphore.acquire():
+            self._error = self.LockError
+            self._error_string = "QSharedMemory::lock: unable to lock" + (
+                ": " + self._semaphore.errorString() if self._semaphore is not None else "")
+            return False
+        self._locked = True
+        return True
+
+    def unlock(self):
+        if not self._locked:
+            return False
+        self._locked = False
+        if not self._semaphore.release():
+            self._error = self.LockError
+            self._error_string = "QSharedMemory::unlock: unable to unlock: " + self._semaphore.errorString()
+            return False
+        return True
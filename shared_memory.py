@@ -56,28 +56,47 @@ CONSUMER = 0
 
 UNIQUE_SHARED_MEMORY_NAME = "MySharedMemoryDefault"
 SHARED_MEMORY_KEY_FILE = "shared_memory.key"
+RING_SLOTS = 0  # number of images the producer may put ahead of the consumer (0: single image, no ring buffer)
+RING_SLOT_SIZE = 16 * 1024 * 1024  # initial number of bytes per image in ring buffer mode (grows if required)
+RING_LOCK_FREE = False  # lock-free single-producer/single-consumer ring (requires RING_SLOTS > 0, slots don't grow)
+DELTA_FRAMES = 0  # 1: send only the tiles changed since the previous image (Python consumer only, requires NumPy)
+DECODE_THREADS = 0  # >0: decode images in a thread pool after releasing the slot (Python consumer, not with DELTA_FRAMES)
+PIPELINED_PRODUCER = 0  # 1: load the next image while painting one straight into its slot (test producer, RING_SLOTS > 1)
 
 # See https://github.com/karkason/cppystruct and https://docs.python.org/2/library/struct.html
 SHARED_STRUCT = 1  # cppystruct/struct Python/C++ communication only enabled if 1 (0: disabled)
 STRUCT_FORMAT = "<I?30s"  # format of struct data, see https://docs.python.org/2/library/struct.html#format-characters
+STRUCT_FIELDS = ("counter", "stop_flag", "file_name")  # names of the fields in STRUCT_FORMAT (see SharedStruct)
 
-from PyQt5.QtCore import QBuffer, QDataStream, QSharedMemory
+from PyQt5.QtCore import pyqtSignal
 from PyQt5.QtGui import QImage, QPixmap
 from PyQt5.QtWidgets import QApplication, QDialog, QFileDialog
 from dialog import Ui_Dialog
 import logzero
 import sys
 import os.path
-if SHARED_STRUCT == 1:
-    import struct
+
+
+def decode_frame(data):  # runs in the thread pool of the consumer (DECODE_THREADS)
+    from prodcon_ipc import raw_frame
+    return raw_frame.read(data)[0].copy()  # the image views `data`, so copy it
 
 
 class ProducerDialog(QDialog):
+    decoded = pyqtSignal(int, object, object)  # sequence, QImage, error (emitted by the thread pool, see DECODE_THREADS)
+
     def __init__(self, parent=None):
         super(ProducerDialog, self).__init__(parent)
 
         self.ui = Ui_Dialog()
         self.ui.setupUi(self)
+        self.sequence = 0  # number of images produced so far
+        self.delta_encoder = None  # DeltaEncoder of the producer (if DELTA_FRAMES)
+        self.delta_decoder = None  # DeltaDecoder of the consumer (if DELTA_FRAMES), retains the last image
+        if DELTA_FRAMES == 1:
+            from prodcon_ipc.delta_frame import DeltaEncoder, DeltaDecoder
+            self.delta_encoder = DeltaEncoder()
+            self.delta_decoder = DeltaDecoder()
 
         # We only allow one image to be put into the shared memory (otherwise we would need to
         # create a dedicated data structure within the SHARED memory and access it from Python and
@@ -90,28 +109,45 @@ class ProducerDialog(QDialog):
             self.ui.loadFromSharedMemoryButton.setEnabled(False)
             self.setWindowTitle("Shared Memory Producer: Python Example")
             from prodcon_ipc.producer_ipc import ProducerIPC
-            self.producer_ipc = ProducerIPC(UNIQUE_SHARED_MEMORY_NAME, SHARED_MEMORY_KEY_FILE)
+            self.producer_ipc = ProducerIPC(UNIQUE_SHARED_MEMORY_NAME, SHARED_MEMORY_KEY_FILE, slots=RING_SLOTS,
+                                            slot_size=RING_SLOT_SIZE, lock_free=RING_LOCK_FREE)
         else:
-            self.ui.loadFromSharedMemoryButton.clicked.connect(self.load_from_memory)
+            self.ui.loadFromSharedMemoryButton.clicked.connect(
+                lambda: self.ui.label.setText("Please wait until an image was produced from the C++ app (load an "
+                                              "image therefrom); it will be shown here automatically."))
             self.ui.loadFromFileButton.setEnabled(False)
             self.setWindowTitle("Shared Memory Consumer: Python Example")
-            from prodcon_ipc.consumer_ipc import ConsumerIPC
-            self.consumer_ipc = ConsumerIPC(UNIQUE_SHARED_MEMORY_NAME, SHARED_MEMORY_KEY_FILE)
-
-        if SHARED_STRUCT == 1:
-            self.shmem_config = QSharedMemory('shared_struct_test')
-            if self.shmem_config.isAttached() or self.shmem_config.attach():
-                if self.shmem_config.lock():
-                    counter, stop_flag, file_name = struct.unpack(STRUCT_FORMAT, self.shmem_config.constData())
-                    logzero.logger.debug("Shared memory struct read: counter=" + str(counter) + ", stop_flag=" + str(stop_flag) + ", file_name=" + file_name)
-                    self.shmem_config.unlock()
-                else:
-                    logzero.logger.error("unable to lock " + self.shmem_config.key())
-                # Note: if both processes detach from the memory, it gets deleted so that attach() fails. That's why we
-                #       simply never detach (HERE). Depending on the app design, there may be a better solution.
-                #self.shmem_config.detach()
-            else:
-                logzero.logger.error("unable to attach " + self.shmem_config.key())
+            # Waits in a background thread (like the C++ consumer) and emits available() once an image was produced:
+            from prodcon_ipc.async_consumer import AsyncConsumerIPC
+            self.consumer_ipc = AsyncConsumerIPC(UNIQUE_SHARED_MEMORY_NAME, SHARED_MEMORY_KEY_FILE, slots=RING_SLOTS,
+                                                 lock_free=RING_LOCK_FREE)
+            self.consumer_ipc.available.connect(self.load_from_memory)
+            self.pipeline = None
+            if DECODE_THREADS > 0 and DELTA_FRAMES == 0:
+                # Only copy the image out of the shared memory in load_from_memory() and decode it in a thread pool,
+                # the images arrive in order through the (queued) signal decoded:
+                from prodcon_ipc.consumer_pipeline import ConsumerPipeline
+                self.pipeline = ConsumerPipeline(self.consumer_ipc, decode=decode_frame, workers=DECODE_THREADS,
+                                                 callback=self.decoded.emit)
+                self.decoded.connect(self.show_decoded)
+
+        self.shared_struct = None
+        if SHARED_STRUCT == 1 and self.attach_shared_struct():
+            config = self.shared_struct.read()
+            logzero.logger.debug("Shared memory struct read: counter=" + str(config["counter"]) + ", stop_flag=" +
+                                 str(config["stop_flag"]) + ", file_name=" + str(config["file_name"].rstrip(b"\0")))
+
+    def attach_shared_struct(self):
+        # Note: if both processes detach from the memory, it gets deleted so that attaching fails. That's why we
+        #       simply never detach (HERE), SharedStruct stays attached. Depending on the app design, there may be a
+        #       better solution.
+        if self.shared_struct is None:
+            from prodcon_ipc.shared_struct import SharedStruct
+            try:
+                self.shared_struct = SharedStruct('shared_struct_test', STRUCT_FORMAT, STRUCT_FIELDS)
+            except RuntimeError as err:
+                logzero.logger.error(str(err))
+        return self.shared_struct is not None
 
     def load_from_file(self):  # producer slot
         self.ui.label.setText("Select an image file")
@@ -126,51 +162,52 @@ class ProducerDialog(QDialog):
 
         self.ui.label.setPixmap(QPixmap.fromImage(image))
 
-        # Get the image data:
-        buf = QBuffer()
-        buf.open(QBuffer.ReadWrite)
-        out = QDataStream(buf)
-        out << image
-
         try:
+            from prodcon_ipc import raw_frame
             from prodcon_ipc.producer_ipc import ScopedProducer
-            with ScopedProducer(self.producer_ipc, buf.size()) as sp:
-                # Copy image data from buf into shared memory area:
-                sp.data()[:sp.size()] = buf.data().data()[:sp.size()]
+            if self.delta_encoder is not None:
+                # Only copy the tiles which changed since the previous image:
+                with ScopedProducer(self.producer_ipc, self.delta_encoder.update(image)) as sp:
+                    self.delta_encoder.write(sp.view())
+            else:
+                with ScopedProducer(self.producer_ipc, raw_frame.frame_size(image)) as sp:
+                    # Copy the scanlines of the image into shared memory area (without encoding it):
+                    raw_frame.write(sp.view(), image, self.sequence)
+            self.sequence += 1
         except Exception as err:
+            if self.delta_encoder is not None:
+                self.delta_encoder.request_keyframe()  # the consumer has not got this image
             self.ui.label.setText(str(err))
 
-        if SHARED_STRUCT == 1:
-            # Read from shared memory, increase value and write it back:
-            if self.shmem_config.isAttached() or self.shmem_config.attach():
-                if self.shmem_config.lock():
-                    counter, stop_flag, _ = struct.unpack(STRUCT_FORMAT, self.shmem_config.constData())
-                    data = struct.pack(STRUCT_FORMAT, counter + 1, stop_flag, str(os.path.basename(file_name)[:30]))
-                    size = min(struct.calcsize(STRUCT_FORMAT), self.shmem_config.size())
-
-                    self.shmem_config.data()[:size] = data[:size]
-                    self.shmem_config.unlock()
-                    if stop_flag:  # stop producing?
-                        logzero.logger.info("Consumer requested to stop the production.")
-                        sys.exit(0)
-                else:
-                    logzero.logger.error("unable to lock " + self.shmem_config.key())
-                #self.shmem_config.detach()
-            else:
-                logzero.logger.error("unable to attach " + self.shmem_config.key())
+        if SHARED_STRUCT == 1 and self.attach_shared_struct():
+            # Update the fields in place (the counter atomically) instead of repacking the whole struct:
+            self.shared_struct.increment("counter")
+            self.shared_struct["file_name"] = os.path.basename(file_name)[:30].encode("utf-8")
+            if self.shared_struct["stop_flag"]:  # stop producing?
+                logzero.logger.info("Consumer requested to stop the production.")
+                sys.exit(0)
 
     def load_from_memory(self):  # consumer slot
-        buf = QBuffer()
-        ins = QDataStream(buf)
+        from prodcon_ipc import raw_frame
         image = QImage()
 
+        if self.pipeline is not None:
+            try:
+                self.pipeline.submit()  # the result is shown by show_decoded()
+            except RuntimeError as err:
+                self.ui.label.setText(str(err))
+            return
+
         if True:  # first variant (much simpler / shorter, more robust)
             try:
                 from prodcon_ipc.consumer_ipc import ScopedConsumer
                 with ScopedConsumer(self.consumer_ipc) as sc:
-                    buf.setData(sc.data())
-                    buf.open(QBuffer.ReadOnly)
-                    ins >> image
+                    if self.delta_decoder is not None:
+                        # Patches the retained image, which is changed by the next frame:
+                        image = self.delta_decoder.read(sc.view())[0].copy()
+                    else:
+                        # The image views the shared memory, so copy it before the transaction ends:
+                        image = raw_frame.read(sc.view())[0].copy()
             except Exception as err:
                 self.ui.label.setText(str(err))
 
@@ -183,9 +220,7 @@ class ProducerDialog(QDialog):
 
             # Read from the shared memory:
             try:
-                buf.setData(data)
-                buf.open(QBuffer.ReadOnly)
-                ins >> image
+                image = raw_frame.read(data)[0].copy()
             except Exception as err:
                 logzero.logger.error(str(err))
 
@@ -201,17 +236,57 @@ class ProducerDialog(QDialog):
             logzero.logger.error("Image data was corrupted.")
 
 
+    def show_decoded(self, sequence, image, error):  # consumer slot (DECODE_THREADS)
+        if error is not None:
+            self.ui.label.setText(str(error))
+        elif not image.isNull():
+            self.ui.label.setPixmap(QPixmap.fromImage(image))
+        else:
+            logzero.logger.error("Image data was corrupted.")
+
+
 def producer_repetitive_scope_test(path, repetitions=1, delay=0):  # producer with repetitive writes to shared memory
     import time
     from PyQt5.QtGui import QPainter, QPixmap, QColor, QFont, QPen
     from PyQt5.QtCore import Qt
     from prodcon_ipc.producer_ipc import ProducerIPC
+    from prodcon_ipc import raw_frame
+
+    producer_ipc = ProducerIPC(UNIQUE_SHARED_MEMORY_NAME, SHARED_MEMORY_KEY_FILE, slots=RING_SLOTS,
+                               slot_size=RING_SLOT_SIZE, lock_free=RING_LOCK_FREE)
+    delta_encoder = None
+    if DELTA_FRAMES == 1:
+        from prodcon_ipc.delta_frame import DeltaEncoder
+        delta_encoder = DeltaEncoder()  # only the overlay changes between the images
+    elif PIPELINED_PRODUCER == 1:
+        from prodcon_ipc.pipelined_producer import PipelinedProducer
+
+        def load(path):  # runs in the thread pool while the previous image is painted
+            image = QImage()
+            if not image.load(path):
+                raise RuntimeError("Unable to load image " + path)
+            return image
+
+        def render(image, data, sequence):  # paints the image and the overlay straight into the slot
+            frame = raw_frame.image(data, image.width(), image.height(), QImage.Format_RGB32, sequence)
+            p = QPainter(frame)
+            p.drawImage(0, 0, image)
+            p.setPen(QPen(Qt.yellow))
+            p.setFont(QFont("Times", 20, QFont.Bold))
+            p.drawText(frame.rect(), Qt.AlignCenter, str(sequence + 1) + " of " + str(repetitions))
+            p.end()
 
-    # FIXME: this is still buggy because when the images are not read sufficiently fast from the consumer (which
-    #       only (?) happens in the non-async Python consumer), image data gets corrupted (may be overwritten by the
-    #       producer?! but this SHOULD be prevented by the system semaphores and the producer/consumer sync...)
-
-    producer_ipc = ProducerIPC(UNIQUE_SHARED_MEMORY_NAME, SHARED_MEMORY_KEY_FILE)
+        try:
+            with PipelinedProducer(producer_ipc, render, lambda image: raw_frame.required_size(
+                    image.width(), image.height(), QImage.Format_RGB32), prepare=load) as pipeline:
+                for i in range(repetitions):
+                    pipeline.put(path)
+                    if delay > 0:
+                        time.sleep(delay)
+        except RuntimeError as err:
+            logzero.logger.error(str(err))
+            sys.exit(2)
+        repetitions = 0  # all put
     for i in range(repetitions):
         image = QImage()
         if not image.load(path):
@@ -228,33 +303,39 @@ def producer_repetitive_scope_test(path, repetitions=1, delay=0):  # producer wi
             p.end()
 
             image = pm.toImage()
-
-            # Load the image:
-            buf = QBuffer()
-            buf.open(QBuffer.ReadWrite)
-            out = QDataStream(buf)
-            out << image
+            frame_size = delta_encoder.update(image) if delta_encoder is not None else raw_frame.frame_size(image)
 
             try:
-                avail_size, mem_data = producer_ipc.begin(buf.size())
-                if avail_size < buf.size():
-                    logzero.logger.warn("Couldn't get enough memory!")
+                avail_size, mem_data = producer_ipc.begin(frame_size)
             except RuntimeError as err:
                 logzero.logger.error(str(err))
                 sys.exit(2)
 
-            # Copy image data from buf into shared memory area:
-            error_str = None
+            # Copy the scanlines of the image into shared memory area (without encoding it):
             try:
-                mem_data[:avail_size] = buf.data().data()[:avail_size]
+                if avail_size < frame_size:
+                    # Never publish a truncated frame; larger payloads need ProducerIPC.put_stream() (chunked) instead
+                    raise RuntimeError("The frame exceeds the slot size of " + str(avail_size) + " bytes, increase "
+                                       "RING_SLOT_SIZE.")
+                if delta_encoder is not None:
+                    delta_encoder.write(memoryview(mem_data)[:avail_size])
+                else:
+                    raw_frame.write(memoryview(mem_data)[:avail_size], image, i)
             except Exception as err:
                 logzero.logger.error(str(err))
-
-            try:
-                producer_ipc.end()
-            except RuntimeError as err:
-                logzero.logger.error(str(err))
-                sys.exit(3)
+                if delta_encoder is not None:
+                    delta_encoder.request_keyframe()  # the consumer does not get this frame
+                try:
+                    producer_ipc.abort()  # give the slot back without publishing it
+                except RuntimeError as err:
+                    logzero.logger.error(str(err))
+                    sys.exit(3)
+            else:
+                try:
+                    producer_ipc.end()
+                except RuntimeError as err:
+                    logzero.logger.error(str(err))
+                    sys.exit(3)
             if delay > 0:
                 time.sleep(delay)
         logzero.logger.debug("Iteration " + str(i + 1) + " of " + str(repetitions) + " completed.")
@@ -10,10 +10,15 @@
 #include <QTextStream>
 #include <QDebug>
 
-AbstractIPC::AbstractIPC(const QString &id, const QString &key_file_path, bool log_debug) : log(log_debug),
+AbstractIPC::AbstractIPC(const QString &id, const QString &key_file_path, bool log_debug,
+                         int slot_count, bool lock_free) : log(log_debug), slot_count(slot_count),
+  lock_free(lock_free && slot_count > 0),
   shared_memory(id),
-  sem_empty(id + "_sem_empty", 1, QSystemSemaphore::AccessMode::Create),
-  sem_full(id + "_sem_full", 0, QSystemSemaphore::AccessMode::Create)
+  // In lock-free mode, the semaphores only wake up a sleeping side, they don't count the slots:
+  sem_empty_owner(id + "_sem_empty", lock_free ? 0 : (slot_count > 0 ? slot_count : 1),
+                  QSystemSemaphore::AccessMode::Create),
+  sem_full_owner(id + "_sem_full", 0, QSystemSemaphore::AccessMode::Create),
+  sem_empty(sem_empty_owner), sem_full(sem_full_owner)
 {
   // Set unique name (key) of shared memory handle, use file if exiting and otherwise hardcoded
   // name:
@@ -8,6 +8,8 @@
 #include <QSystemSemaphore>
 #include <QString>
 
+#include "counting_semaphore.h"
+
 /**
  * \interface AbstractIPC
  * \brief Abstract base class for the \c ConsumerIPC and \c ProducerIPC classes
@@ -29,8 +31,14 @@ protected:
    *             whose first line is used as the unique ID/name of the shared memory IF this file
    *             exists, can be empty (the default) which then uses \c id (first parameter)
    * \param [in] log_debug \c true to enable logging to \c qDebug() (default), \c false otherwise
+   * \param [in] slot_count Number of slots of the ring buffer inside the shared memory (see
+   *             \c RingHeader), 0 (the default) stores exactly one item without any header (the
+   *             original layout); must be equal in all processes
+   * \param [in] lock_free \c true to use the lock-free single-producer/single-consumer ring instead
+   *             (see \c SpscHeader, requires \c slot_count > 0); must be equal in all processes
    */
-  AbstractIPC(const QString &id, const QString &key_file_path = QString(), bool log_debug = true);
+  AbstractIPC(const QString &id, const QString &key_file_path = QString(), bool log_debug = true,
+              int slot_count = 0, bool lock_free = false);
   /// Does nothing yet (but required due to a pure virtual function above).
   virtual ~AbstractIPC();
   /**
@@ -44,9 +52,16 @@ protected:
   void detach();
 
   bool log; //!< \c true to show log output using \c qDebug() (useful for debugging)
+  int slot_count; //!< Number of slots of the ring buffer, 0 if the ring buffer mode is not used
+  bool lock_free; //!< \c true if the lock-free single-producer/single-consumer ring is used
   QSharedMemory shared_memory; //!< Instance of the shared memory reference
-  QSystemSemaphore sem_empty; //!< System-wide semaphore to indicate the #(free slots)
-  QSystemSemaphore sem_full; //!< System-wide semaphore to indicate the #(full slots)
+  QSystemSemaphore sem_empty_owner; //!< Creates and owns the semaphore of \c sem_empty
+  QSystemSemaphore sem_full_owner; //!< Creates and owns the semaphore of \c sem_full
+  /// System-wide semaphore to indicate the #(free slots); like \c sem_full, it is operated on
+  /// without \c SEM_UNDO (see \c CountingSemaphore) since it counts slots handed over between
+  /// the processes
+  CountingSemaphore sem_empty;
+  CountingSemaphore sem_full; //!< System-wide semaphore to indicate the #(full slots)
   QString file_key; //!< Unique name of shared memory loaded from file (may be empty)
   bool transaction_started = false; //!< \c true if \c begin() has been called, \c false otherwise
 };
@@ -3,11 +3,13 @@
 
 #include "consumer_ipc.h"
 
+#include <QCoreApplication>
 #include <QtConcurrent>
 #include <QDebug>
 
-ConsumerIPC::ConsumerIPC(const QString &id, const QString &key_file_path, bool log_debug)
-  : AbstractIPC(id, key_file_path, log_debug), data_acquired(false)
+ConsumerIPC::ConsumerIPC(const QString &id, const QString &key_file_path, bool log_debug,
+                         int slot_count, bool lock_free)
+  : AbstractIPC(id, key_file_path, log_debug, slot_count, lock_free), data_acquired(0)
 {
   if (log) {
     qDebug() << (QString("Compiled with Qt v") + QT_VERSION_STR).toStdString().c_str();
@@ -35,6 +37,10 @@ ConsumerIPC::~ConsumerIPC()
 
 void ConsumerIPC::updateThread()
 {
+  if (lock_free) {
+    updateThreadLockFree();
+    return;
+  }
   while (!terminate) {
     // Passively wait until a data is ready:
     if (log) {
@@ -45,7 +51,7 @@ void ConsumerIPC::updateThread()
         qDebug() << "Unable to acquire system semaphore (sem_full): " << sem_full.errorString();
       }
     }
-    data_acquired = true;
+    ++data_acquired;
 
     if (!terminate) {
       if (log) {
@@ -65,7 +71,7 @@ int ConsumerIPC::begin(const char **data)
   // Check to ensure that its allowed to call this since the thread was really signaled...this way,
   // it could happen that sem_empty.release() is called in end() although sem_full.acquire() in
   // updateThread() was never triggered:
-  if (!data_acquired) {
+  if (data_acquired <= 0) {
     if (log) {
       qDebug() << "Data was not acquired yet. Wait until the signal ConsumerIPC::available() is "
                   "emitted and call this method in a slot upon being notified.";
@@ -84,6 +90,12 @@ int ConsumerIPC::begin(const char **data)
     }
     return -1;
   }
+  if (lock_free) {
+    return beginLockFree(data);
+  }
+  if (slot_count > 0) {
+    return beginRing(data);
+  }
 
   // Now, consume it:
   if (!shared_memory.attach()) {
@@ -115,7 +127,15 @@ void ConsumerIPC::end()
     }
     return;
   }
-  data_acquired = false;
+  if (lock_free) {
+    endLockFree();
+    return;
+  }
+  if (slot_count > 0) {
+    endRing();
+    return;
+  }
+  --data_acquired;
   shared_memory.unlock();
   shared_memory.detach();
 
@@ -129,3 +149,164 @@ void ConsumerIPC::end()
   }
   transaction_started = false;
 }
+
+int ConsumerIPC::beginRing(const char **data)
+{
+  // The segment is created once by the producer and we stay attached until destruction:
+  if (!shared_memory.isAttached() && !shared_memory.attach()) {
+    if (log) {
+      qDebug() << "Unable to attach to shared memory segment: " << shared_memory.errorString();
+    }
+    return -1; // keep the item, begin() may be called again
+  }
+  if (!shared_memory.lock()) {
+    if (log) {
+      qDebug() << "Unable to lock shared memory segment: " << shared_memory.errorString();
+    }
+    return -1;
+  }
+  auto header = static_cast<RingHeader*>(shared_memory.data());
+  if (!ringIsValid(header) || int(header->slot_count) != slot_count) {
+    shared_memory.unlock();
+    if (log) {
+      qDebug() << "Shared memory segment does not contain a ring buffer with" << slot_count
+               << "slots.";
+    }
+    return -1;
+  }
+  if (header->generation != generation) { // producer has reallocated the slots
+    if (slot_memory.isAttached()) {
+      slot_memory.detach();
+    }
+    if (header->generation) {
+      slot_memory.setKey(ringSlotKey(shared_memory.key(), header->generation));
+      if (!slot_memory.attach()) {
+        shared_memory.unlock();
+        if (log) {
+          qDebug() << "Unable to attach to shared memory segment: " << slot_memory.errorString();
+        }
+        return -1;
+      }
+    }
+    generation = header->generation;
+  }
+  const quint64 index = header->tail % header->slot_count;
+  const quint64 length = ringLengths(header)[index];
+  const qint64 offset = ringSlotOffset(header, index);
+  header->reading = 1; // the producer must not overwrite this item now
+  header->consumer_pid = quint32(QCoreApplication::applicationPid());
+  header->consumer_heartbeat = ringHeartbeat();
+  shared_memory.unlock();
+
+  auto slots_base = generation ? slot_memory.constData() : shared_memory.constData();
+  *data = static_cast<const char*>(slots_base) + offset;
+  transaction_started = true;
+  return int(length);
+}
+
+void ConsumerIPC::endRing()
+{
+  --data_acquired;
+  if (shared_memory.lock()) {
+    auto header = static_cast<RingHeader*>(shared_memory.data());
+    ++header->tail;
+    header->reading = 0;
+    // Released while holding the lock, so the semaphore always matches the indices:
+    if (!sem_empty.release() && log) {
+      qDebug() << "Unable to release system semaphore (sem_empty): " << sem_empty.errorString();
+    }
+    shared_memory.unlock();
+  } else {
+    if (log) {
+      qDebug() << "Unable to lock shared memory segment: " << shared_memory.errorString();
+    }
+    if (!sem_empty.release() && log) {
+      qDebug() << "Unable to release system semaphore (sem_empty): " << sem_empty.errorString();
+    }
+  }
+  transaction_started = false;
+}
+
+void ConsumerIPC::updateThreadLockFree()
+{
+  quint64 announced = 0; // sequence number of the next item to announce
+  while (!terminate) {
+    if (!spsc) {
+      // The producer releases sem_full once the segment has been created:
+      if (!attachSpsc()) {
+        sem_full.acquire();
+        continue;
+      }
+      announced = spsc->tail.load(std::memory_order_acquire);
+    }
+    const bool ready = spscWait(spsc->consumer_waiting, sem_full, [this, announced] {
+      return terminate || spsc->head.load(std::memory_order_acquire) > announced;
+    });
+    if (!ready) {
+      if (log) {
+        qDebug() << "Unable to acquire system semaphore (sem_full): " << sem_full.errorString();
+      }
+      continue;
+    }
+    if (terminate) {
+      break;
+    }
+    // Announce all items published meanwhile:
+    const quint64 head = spsc->head.load(std::memory_order_acquire);
+    for (; announced < head; ++announced) {
+      ++data_acquired;
+      emit available();
+    }
+  }
+}
+
+bool ConsumerIPC::attachSpsc()
+{
+  if (!shared_memory.isAttached() && !shared_memory.attach()) {
+    if (log && shared_memory.error() != QSharedMemory::NotFound) {
+      qDebug() << "Unable to attach to shared memory segment: " << shared_memory.errorString();
+    }
+    return false;
+  }
+  // The producer initializes the header while holding the lock:
+  if (!shared_memory.lock()) {
+    if (log) {
+      qDebug() << "Unable to lock shared memory segment: " << shared_memory.errorString();
+    }
+    return false;
+  }
+  auto header = static_cast<SpscHeader*>(shared_memory.data());
+  const bool valid = spscIsValid(header) && int(header->slot_count) == slot_count;
+  shared_memory.unlock();
+  if (!valid) {
+    if (log) {
+      qDebug() << "Shared memory segment does not contain a lock-free ring with" << slot_count
+               << "slots.";
+    }
+    shared_memory.detach();
+    return false;
+  }
+  spsc = header;
+  return true;
+}
+
+int ConsumerIPC::beginLockFree(const char **data)
+{
+  // updateThread() has seen the head passing this item (acquire), no lock required:
+  const quint64 index = spsc->tail.load(std::memory_order_relaxed) % spsc->slot_count;
+  *data = static_cast<const char*>(shared_memory.constData()) + spscSlotOffset(spsc, index);
+  transaction_started = true;
+  return int(spscLengths(spsc)[index]);
+}
+
+void ConsumerIPC::endLockFree()
+{
+  --data_acquired;
+  const quint64 tail = spsc->tail.load(std::memory_order_relaxed) + 1;
+  if (spscStore(spsc->tail, tail, spsc->producer_waiting) && !sem_empty.release()) {
+    if (log) {
+      qDebug() << "Unable to release system semaphore (sem_empty): " << sem_empty.errorString();
+    }
+  }
+  transaction_started = false;
+}
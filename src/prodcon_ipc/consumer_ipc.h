@@ -8,6 +8,8 @@
 #include <QFuture>
 
 #include "abstract_ipc.h"
+#include "ring_header.h"
+#include "spsc_header.h"
 /**
  * \class ConsumerIPC
  * \brief Provides simplified access to shared memory as a "consumer"
@@ -18,13 +20,21 @@
  *
  * Basically, the signal \c available() is emitted once data was produced and put into the shared
  * memory. Once triggered, use \c begin() ... \c end() to access the data.
+ *
+ * In ring buffer mode (\c slot_count > 0), the consumer stays attached to the shared memory and
+ * reads the items in the order they were produced (see \c RingHeader). It only re-attaches if the
+ * producer has reallocated the slots.
+ *
+ * In lock-free mode (\c lock_free, with exactly one producer), the shared memory is never locked and
+ * the update thread only sleeps on the semaphore if the ring is empty (see \c SpscHeader).
  */
 class ConsumerIPC : public AbstractIPC {
   Q_OBJECT
 
 public:
   /// \copydoc AbstractIPC::AbstractIPC()
-  ConsumerIPC(const QString &id, const QString &key_file_path = QString(), bool log_debug = true);
+  ConsumerIPC(const QString &id, const QString &key_file_path = QString(), bool log_debug = true,
+              int slot_count = 0, bool lock_free = false);
   /// Terminates the updater thread.
   ~ConsumerIPC();
 
@@ -52,9 +62,25 @@ private:
 
   /// Thread function to wait for an updated shared memory block
   void updateThread();
+  /// Implements \c begin() in ring buffer mode.
+  int beginRing(const char **data);
+  /// Implements \c end() in ring buffer mode.
+  void endRing();
+  /// Implements \c updateThread() in lock-free mode.
+  void updateThreadLockFree();
+  /// Attaches to the segment holding the lock-free ring, \c false if it doesn't exist (yet).
+  bool attachSpsc();
+  /// Implements \c begin() in lock-free mode.
+  int beginLockFree(const char **data);
+  /// Implements \c end() in lock-free mode.
+  void endLockFree();
   std::atomic_bool terminate; //!< \c to indicate \c updateThread() to terminate
   QFuture<void> future; //!< Instance used to spawn the update thread
-  std::atomic_bool data_acquired; //!< Indicates if data was received (set in \c updateThread())
+  /// Number of items received but not consumed yet (incremented in \c updateThread())
+  std::atomic_int data_acquired;
+  QSharedMemory slot_memory; //!< Slots of a generation > 0 (ring buffer mode only)
+  quint64 generation = 0; //!< Generation of the slots we are attached to (ring buffer mode only)
+  SpscHeader *spsc = nullptr; //!< Header of the attached segment (lock-free mode only)
 };
 
 /**
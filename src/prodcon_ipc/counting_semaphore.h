@@ -0,0 +1,113 @@
+// Copyright (C) 2020 Adrian Böckenkamp
+// This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+#ifndef COUNTING_SEMAPHORE_H
+#define COUNTING_SEMAPHORE_H
+
+#include <QString>
+#include <QSystemSemaphore>
+#include <QtGlobal>
+
+#if defined(Q_OS_LINUX) && !defined(QT_POSIX_IPC)
+#define PRODCON_IPC_SYSV_SEMAPHORE
+#include <cerrno>
+#include <cstring>
+#include <sys/ipc.h>
+#include <sys/sem.h>
+#include <QCryptographicHash>
+#include <QDir>
+#include <QFile>
+#endif
+
+/**
+ * \class CountingSemaphore
+ * \brief Operates on the semaphore of a \c QSystemSemaphore without \c SEM_UNDO
+ *
+ * Qt applies \c SEM_UNDO to every operation of a \c QSystemSemaphore. The kernel limits the undo
+ * value per process and semaphore to 32767, so a semaphore counting slots handed over between two
+ * processes fails with \c ERANGE after as many items in one direction, and the kernel reverts all
+ * operations of a process when it exits (e.g. the slots a consumer has given back). On Linux, this
+ * class opens the very same System V semaphore (the key is derived like Qt does) and operates on it
+ * without \c SEM_UNDO, just like `prodcon_ipc/sysv_semaphore.py` with `undo=False`. The
+ * \c QSystemSemaphore passed keeps creating and owning the semaphore. Elsewhere (or with
+ * \c QT_POSIX_IPC), the operations are forwarded to it.
+ */
+class CountingSemaphore {
+public:
+  /// Opens the semaphore of \c owner (which must have been created already).
+  explicit CountingSemaphore(QSystemSemaphore &owner) : owner(owner) { open(); }
+
+  /// Decrements the semaphore, blocks while it is 0 (like \c QSystemSemaphore::acquire()).
+  bool acquire() { return modify(-1); }
+
+  /// Increments the semaphore by \c n (like \c QSystemSemaphore::release()).
+  bool release(int n = 1) { return modify(n); }
+
+  /// Returns the description of the last error.
+  QString errorString() const { return id == -1 ? owner.errorString() : error; }
+
+  QString key() const { return owner.key(); }
+
+private:
+#ifdef PRODCON_IPC_SYSV_SEMAPHORE
+  /// Opens the semaphore by the key Qt derives from its name, see
+  /// \c QSharedMemoryPrivate::makePlatformSafeKey().
+  void open()
+  {
+    const QString key = owner.key();
+    QString name = QStringLiteral("qipc_systemsem_");
+    for (const QChar c : key) {
+      if ((c >= QLatin1Char('a') && c <= QLatin1Char('z')) ||
+          (c >= QLatin1Char('A') && c <= QLatin1Char('Z'))) {
+        name += c;
+      }
+    }
+    name += QString::fromLatin1(QCryptographicHash::hash(key.toUtf8(),
+                                                         QCryptographicHash::Sha1).toHex());
+    const key_t unix_key = ftok(QFile::encodeName(QDir::tempPath() + QLatin1Char('/') + name)
+                                .constData(), 'Q');
+    id = unix_key == -1 ? -1 : semget(unix_key, 1, 0600);
+  }
+
+  bool modify(int count)
+  {
+    if (id == -1) {
+      return count < 0 ? owner.acquire() : owner.release(count);
+    }
+    error.clear();
+    sembuf operation = {0, static_cast<short>(count), 0};
+    bool reopened = false;
+    while (semop(id, &operation, 1) == -1) {
+      const int code = errno;
+      if (code == EINTR) {
+        continue;
+      }
+      if ((code == EIDRM || code == EINVAL) && !reopened) {
+        // Removed by another process owning it (which has exited), so let the owner recreate it
+        // like Qt does (without resetting it if yet another process has done so already):
+        reopened = true;
+        const QString key = owner.key();
+        owner.setKey(QString(), 0, QSystemSemaphore::Open);
+        owner.setKey(key, 0, QSystemSemaphore::Open);
+        open();
+        if (id != -1) {
+          continue;
+        }
+      }
+      error = QString::fromLocal8Bit(std::strerror(code));
+      return false;
+    }
+    return true;
+  }
+#else
+  void open() { }
+
+  bool modify(int count) { return count < 0 ? owner.acquire() : owner.release(count); }
+#endif
+
+  QSystemSemaphore &owner; //!< Creates and owns the semaphore
+  int id = -1; //!< ID of the System V semaphore, -1 to forward to \c owner
+  QString error; //!< Description of the last error
+};
+
+#endif // COUNTING_SEMAPHORE_H
@@ -0,0 +1,138 @@
+// Copyright (C) 2020 Adrian Böckenkamp
+// This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+#ifndef LATEST_VALUE_H
+#define LATEST_VALUE_H
+
+#include <atomic>
+#include <cstring>
+#include <thread>
+#include <QByteArray>
+#include <QDebug>
+#include <QSharedMemory>
+#include <QString>
+#include <QtGlobal>
+
+#include "ring_header.h"
+
+/**
+ * \struct LatestValueHeader
+ * \brief Header of a shared memory segment holding the latest value only
+ *
+ * Layout of the segment (must match `prodcon_ipc/latest_value.py`):
+ *
+ *     [header (LATEST_VALUE_HEADER_SIZE bytes)][value (at most capacity bytes)]
+ *
+ * The producer overwrites the value under a sequence lock: it increments \c sequence (odd: write in
+ * progress), writes \c length and the value and increments \c sequence again (even: complete). A
+ * reader copies the value and retries if \c sequence was odd or has changed meanwhile, i.e.,
+ * readers never block the producer and any number of readers can read the same value. If writing a
+ * value fails, the producer sets \c length to \c LATEST_VALUE_INVALID_LENGTH, so readers get no
+ * value until the next one is published.
+ */
+struct LatestValueHeader {
+  char magic[4];        //!< Always \c LATEST_VALUE_MAGIC
+  quint16 version;      //!< Layout version, \c LATEST_VALUE_VERSION
+  quint16 header_size;  //!< Size of this header, \c LATEST_VALUE_HEADER_SIZE
+  quint32 capacity;     //!< Maximum number of bytes of a value
+  /// Odd while the producer writes, incremented by 2 per value (0: nothing published yet)
+  alignas(RING_ALIGNMENT) std::atomic<quint64> sequence;
+  std::atomic<quint64> length; //!< Number of bytes of the value
+};
+
+constexpr char LATEST_VALUE_MAGIC[] = "PCLV";
+constexpr quint16 LATEST_VALUE_VERSION = 1;
+constexpr int LATEST_VALUE_HEADER_SIZE = 2 * RING_ALIGNMENT;
+constexpr quint64 LATEST_VALUE_INVALID_LENGTH = ~quint64(0); //!< Length of a value whose write has failed
+
+static_assert(sizeof(LatestValueHeader) == LATEST_VALUE_HEADER_SIZE,
+              "LatestValueHeader must match HEADER_SIZE in latest_value.py");
+
+/// Returns \c true if \c header is a latest value header of a supported version.
+inline bool latestValueIsValid(const LatestValueHeader *header)
+{
+  return std::memcmp(header->magic, LATEST_VALUE_MAGIC, 4) == 0 &&
+      header->version == LATEST_VALUE_VERSION;
+}
+
+/**
+ * Copies the latest value (retrying on torn reads).
+ * \param [in] header Header at the beginning of the segment
+ * \param [out] data Receives the value
+ * \param [in] newer_than Only copy a value with a sequence number greater than this, 0 for any
+ * \return Sequence number of the value copied, 0 if there was no (newer) valid value
+ */
+inline quint64 latestValueRead(const LatestValueHeader *header, QByteArray &data,
+                               quint64 newer_than = 0)
+{
+  const char *value = reinterpret_cast<const char*>(header) + LATEST_VALUE_HEADER_SIZE;
+  while (true) {
+    const quint64 sequence = header->sequence.load(std::memory_order_acquire);
+    if (sequence & 1) {
+      std::this_thread::yield(); // write in progress
+      continue;
+    }
+    if (sequence == 0 || sequence <= newer_than) {
+      return 0;
+    }
+    quint64 length = header->length.load(std::memory_order_relaxed);
+    if (length == LATEST_VALUE_INVALID_LENGTH) {
+      return 0; // writing the latest value has failed
+    }
+    length = qMin(length, quint64(header->capacity));
+    data.resize(int(length));
+    std::memcpy(data.data(), value, size_t(length));
+    std::atomic_thread_fence(std::memory_order_acquire);
+    if (header->sequence.load(std::memory_order_relaxed) == sequence) {
+      return sequence;
+    }
+  }
+}
+
+/**
+ * \class LatestValueConsumer
+ * \brief Reads the latest value published by a Python \c LatestValueProducer
+ *
+ * Poll \c read() (e.g. using a \c QTimer), it never blocks the producer.
+ */
+class LatestValueConsumer {
+public:
+  /**
+   * Creates the shared memory reference, it is attached by the first \c read().
+   * \param [in] id Unique system-wide unique name of shared memory
+   * \param [in] log_debug \c true to enable logging to \c qDebug() (default), \c false otherwise
+   */
+  explicit LatestValueConsumer(const QString &id, bool log_debug = true)
+    : log(log_debug), shared_memory(id) { }
+
+  /**
+   * Copies the latest value.
+   * \param [out] data Receives the value
+   * \param [in] newer_than Only copy a value with a sequence number greater than this (e.g. the one
+   *        returned by the previous call), 0 for any
+   * \return Sequence number of the value copied, 0 if there was no (newer) value
+   */
+  quint64 read(QByteArray &data, quint64 newer_than = 0)
+  {
+    if (!shared_memory.isAttached()) {
+      if (!shared_memory.attach(QSharedMemory::ReadOnly)) {
+        return 0; // not created yet
+      }
+      if (!latestValueIsValid(static_cast<const LatestValueHeader*>(shared_memory.constData()))) {
+        if (log) {
+          qDebug() << "Shared memory segment does not contain a latest value channel.";
+        }
+        shared_memory.detach();
+        return 0;
+      }
+    }
+    return latestValueRead(static_cast<const LatestValueHeader*>(shared_memory.constData()), data,
+                           newer_than);
+  }
+
+private:
+  bool log; //!< \c true to show log output using \c qDebug()
+  QSharedMemory shared_memory; //!< Instance of the shared memory reference
+};
+
+#endif // LATEST_VALUE_H
@@ -32,6 +32,14 @@ int ProducerIPC::begin(int desired_size, char **data)
     return -1;
   }
 
+  // Wait for a free slot first, detaching deletes the segment of the previous item if the consumer
+  // has not attached to it yet:
+  if (!sem_empty.acquire()) {
+    if (log) {
+      qDebug() << "Unable to acquire system semaphore (sem_empty): " << sem_empty.errorString();
+    }
+    return -1;
+  }
   if (shared_memory.isAttached()) {
     detach();
   }
@@ -43,22 +51,19 @@ int ProducerIPC::begin(int desired_size, char **data)
     shared_memory.attach();
     shared_memory.detach();
     if (!shared_memory.create(int(desired_size))) { // we really still failed
+      sem_empty.release(); // undo acquire
       if (log) {
         qDebug() << "Unable to create or recover shared memory segment: "
-                 << shared_memory.errorString() << "\n\nYou probably need to reboot to fix this.";
+                 << shared_memory.errorString() << "\n\nAnother process is still attached to it. "
+                    "List stale segments by \"python -m prodcon_ipc reap\" (and remove them by adding "
+                    "--clean).";
       }
       return -1;
     }
   }
 
-  if (!sem_empty.acquire()) {
-    if (log) {
-      qDebug() << "Unable to acquire system semaphore (sem_empty): " << sem_empty.errorString();
-    }
-    return -1;
-  }
   if (!shared_memory.lock()) {
-    sem_full.release(); // undo acquire
+    sem_empty.release(); // undo acquire
     if (log) {
       qDebug() << "Unable to lock shared memory: " << shared_memory.errorString();
     }
@@ -0,0 +1,97 @@
+// Copyright (C) 2020 Adrian Böckenkamp
+// This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+#ifndef RAW_FRAME_H
+#define RAW_FRAME_H
+
+#include <cstring>
+#include <QImage>
+#include <QtGlobal>
+
+/**
+ * \struct FrameHeader
+ * \brief Header of an uncompressed image stored in shared memory
+ *
+ * Layout (must match `prodcon_ipc/raw_frame.py`):
+ *
+ *     [header (FRAME_HEADER_SIZE bytes)][scanlines (height * bytes_per_line bytes)]
+ *
+ * All values are stored in little endian order (the native order on all supported platforms).
+ * Storing the pixels as they are avoids encoding the image (as done by `QDataStream << image`,
+ * which uses PNG) and decoding it again.
+ */
+struct FrameHeader {
+  char magic[4];          //!< Always \c FRAME_MAGIC
+  quint32 width;          //!< Width of the image in pixels
+  quint32 height;         //!< Height of the image in pixels
+  quint32 bytes_per_line; //!< Number of bytes per scanline (incl. padding)
+  quint32 format;         //!< Value of \c QImage::Format
+  quint32 padding;        //!< Unused, aligns \c sequence
+  quint64 sequence;       //!< Sequence number of the frame
+};
+
+static_assert(sizeof(FrameHeader) == 32, "FrameHeader must match HEADER_FORMAT in raw_frame.py");
+
+constexpr char FRAME_MAGIC[] = "PCFR";
+constexpr int FRAME_HEADER_SIZE = 64; //!< Scanlines start at a cache line boundary
+
+/// Returns the number of bytes needed to store \c image, i.e., what to pass to \c ScopedProducer.
+inline int frameSize(const QImage &image)
+{
+  return FRAME_HEADER_SIZE + image.bytesPerLine() * image.height();
+}
+
+/**
+ * Copies the header and the scanlines of \c image into \c data (a single copy, no encoding).
+ * \param [out] data Shared memory to write to
+ * \param [in] size Number of bytes \c data addresses
+ * \param [in] image Image to store
+ * \param [in] sequence Sequence number of the frame
+ * \return \c false if \c size is too small, \c true otherwise
+ */
+inline bool writeFrame(char *data, int size, const QImage &image, quint64 sequence = 0)
+{
+  if (size < frameSize(image)) {
+    return false;
+  }
+  FrameHeader header;
+  std::memcpy(header.magic, FRAME_MAGIC, 4);
+  header.width = quint32(image.width());
+  header.height = quint32(image.height());
+  header.bytes_per_line = quint32(image.bytesPerLine());
+  header.format = quint32(image.format());
+  header.padding = 0;
+  header.sequence = sequence;
+  std::memcpy(data, &header, sizeof(header));
+  std::memcpy(data + FRAME_HEADER_SIZE, image.constBits(),
+              size_t(image.bytesPerLine()) * size_t(image.height()));
+  return true;
+}
+
+/**
+ * Returns an image viewing the scanlines in \c data (no copy, no decoding). The image is only valid
+ * as long as \c data is, i.e., call \c QImage::copy() if it is needed after the transaction ended.
+ * \param [in] data Shared memory to read from
+ * \param [in] size Number of bytes \c data addresses
+ * \param [out] sequence Optional pointer to store the sequence number of the frame
+ * \return The image, a null image if \c data does not contain a valid frame
+ */
+inline QImage readFrame(const char *data, int size, quint64 *sequence = nullptr)
+{
+  if (size < FRAME_HEADER_SIZE) {
+    return QImage();
+  }
+  FrameHeader header;
+  std::memcpy(&header, data, sizeof(header));
+  if (std::memcmp(header.magic, FRAME_MAGIC, 4) != 0 ||
+      qint64(size) < FRAME_HEADER_SIZE + qint64(header.bytes_per_line) * header.height) {
+    return QImage();
+  }
+  if (sequence) {
+    *sequence = header.sequence;
+  }
+  return QImage(reinterpret_cast<const uchar*>(data + FRAME_HEADER_SIZE), int(header.width),
+                int(header.height), int(header.bytes_per_line), QImage::Format(header.format));
+}
+
+#endif // RAW_FRAME_H
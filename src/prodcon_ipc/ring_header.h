@@ -0,0 +1,108 @@
+// Copyright (C) 2020 Adrian Böckenkamp
+// This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+#ifndef RING_HEADER_H
+#define RING_HEADER_H
+
+#include <cstddef>
+#include <cstring>
+#include <QDeadlineTimer>
+#include <QString>
+#include <QtGlobal>
+
+/**
+ * \struct RingHeader
+ * \brief Header of a shared memory segment in ring buffer mode
+ *
+ * Layout of the segment (must match `prodcon_ipc/ring_buffer.py`):
+ *
+ *     [header (RING_HEADER_SIZE bytes)][slot length table (slot_count * quint64)]
+ *     [slot timestamp table (slot_count * quint64)][slot 0]...[slot N-1]
+ *
+ * All values are stored in little endian order (the native order on all supported platforms). The
+ * tables and every slot start at a multiple of \c RING_ALIGNMENT bytes. The timestamp of a slot is
+ * the time (\c CLOCK_MONOTONIC in nanoseconds) the producer has started writing its item, 0 if the
+ * producer doesn't collect statistics. \c head and \c tail are
+ * monotonically increasing sequence numbers, the slot of an item is `sequence % slot_count`.
+ * \c reading is 1 while the consumer reads the item at \c tail, so a producer overwriting the
+ * oldest item (if all slots are full) knows that it must not touch that one.
+ *
+ * Each side records its process ID and a heartbeat (seconds of \c CLOCK_MONOTONIC, see
+ * \c ringHeartbeat()) so the other side detects if it has died; 0 means unknown.
+ *
+ * If the producer needs larger slots, it allocates them in a separate segment named
+ * \c ringSlotKey() and increments \c generation (the header always stays in the first segment).
+ * The slots of generation 0 are the ones following the header.
+ */
+struct RingHeader {
+  char magic[4];        //!< Always \c RING_MAGIC
+  quint16 version;      //!< Layout version, \c RING_VERSION
+  quint16 header_size;  //!< Size of this header incl. padding, \c RING_HEADER_SIZE
+  quint32 slot_count;   //!< Number of slots
+  quint32 slot_size;    //!< Maximum number of bytes per slot
+  quint64 generation;   //!< Incremented whenever the slots are reallocated
+  quint64 head;         //!< Sequence number of the next slot to be written by the producer
+  quint64 tail;         //!< Sequence number of the next slot to be read by the consumer
+  quint32 reading;      //!< 1 while the consumer reads the item at \c tail, 0 otherwise
+  quint32 producer_pid;        //!< Process ID of the producer, 0 if unknown
+  quint32 consumer_pid;        //!< Process ID of the consumer, 0 if unknown
+  quint32 producer_heartbeat;  //!< Last heartbeat of the producer, 0 if unknown
+  quint32 consumer_heartbeat;  //!< Last heartbeat of the consumer, 0 if unknown
+  quint32 reserved;
+};
+
+static_assert(offsetof(RingHeader, reading) == 40 && offsetof(RingHeader, consumer_heartbeat) == 56 &&
+              sizeof(RingHeader) == 64, "RingHeader must match HEADER_FORMAT in ring_buffer.py");
+
+constexpr char RING_MAGIC[] = "PCRB";
+constexpr quint16 RING_VERSION = 2;
+constexpr int RING_ALIGNMENT = 64;
+constexpr int RING_HEADER_SIZE = RING_ALIGNMENT;
+
+/// Rounds \c size up to the next multiple of \c RING_ALIGNMENT.
+constexpr qint64 ringAlign(qint64 size)
+{
+  return (size + RING_ALIGNMENT - 1) / RING_ALIGNMENT * RING_ALIGNMENT;
+}
+
+/// Returns \c true if \c header is a ring buffer header of a supported version.
+inline bool ringIsValid(const RingHeader *header)
+{
+  return std::memcmp(header->magic, RING_MAGIC, 4) == 0 && header->version == RING_VERSION;
+}
+
+/// Returns the current heartbeat value: the seconds of the monotonic clock truncated to 32 bit.
+inline quint32 ringHeartbeat()
+{
+  return quint32(QDeadlineTimer::current().deadlineNSecs() / 1000000000);
+}
+
+/// Returns a pointer to the slot length table following the header.
+inline quint64 *ringLengths(RingHeader *header)
+{
+  return reinterpret_cast<quint64*>(reinterpret_cast<char*>(header) + RING_HEADER_SIZE);
+}
+
+/// Returns a pointer to the slot timestamp table following the slot length table.
+inline quint64 *ringTimestamps(RingHeader *header)
+{
+  return reinterpret_cast<quint64*>(reinterpret_cast<char*>(header) + RING_HEADER_SIZE +
+                                    ringAlign(qint64(header->slot_count) * qint64(sizeof(quint64))));
+}
+
+/// Returns the name of the shared memory segment holding the slots of a \c generation > 0.
+inline QString ringSlotKey(const QString &key, quint64 generation)
+{
+  return key + "_gen" + QString::number(generation);
+}
+
+/// Returns the offset of slot \c index relative to the beginning of the segment holding the slots
+/// of the current generation (the header's one for generation 0, see \c ringSlotKey() otherwise).
+inline qint64 ringSlotOffset(const RingHeader *header, quint64 index)
+{
+  const qint64 base = header->generation ? 0 : RING_HEADER_SIZE +
+      2 * ringAlign(qint64(header->slot_count) * qint64(sizeof(quint64)));
+  return base + qint64(index) * ringAlign(header->slot_size);
+}
+
+#endif // RING_HEADER_H
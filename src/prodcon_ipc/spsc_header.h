@@ -0,0 +1,118 @@
+// Copyright (C) 2020 Adrian Böckenkamp
+// This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+#ifndef SPSC_HEADER_H
+#define SPSC_HEADER_H
+
+#include <atomic>
+#include <cstring>
+#include <QtGlobal>
+
+#include "ring_header.h"
+
+/**
+ * \struct SpscHeader
+ * \brief Header of a shared memory segment in lock-free (single-producer/single-consumer) mode
+ *
+ * Layout of the segment (must match `prodcon_ipc/spsc_ring.py`):
+ *
+ *     [header (SPSC_HEADER_SIZE bytes)][slot length table (slot_count * quint64)][slot 0]...[slot N-1]
+ *
+ * Unlike \c RingHeader, the shared memory is never locked: each side only writes its own counter
+ * (\c head resp. \c tail, each on a separate cache line) with release semantics and reads the
+ * other one with acquire semantics. The semaphores are only used to sleep if the ring is empty
+ * (consumer) or full (producer), see \c spscWait() and \c spscStore(). Slots have a fixed size.
+ */
+struct SpscHeader {
+  char magic[4];        //!< Always \c SPSC_MAGIC
+  quint16 version;      //!< Layout version, \c SPSC_VERSION
+  quint16 header_size;  //!< Size of this header, \c SPSC_HEADER_SIZE
+  quint32 slot_count;   //!< Number of slots
+  quint32 slot_size;    //!< Maximum number of bytes per slot
+  /// Sequence number of the next slot to be written by the producer
+  alignas(RING_ALIGNMENT) std::atomic<quint64> head;
+  std::atomic<quint32> producer_waiting; //!< Set while the producer sleeps on \c sem_empty
+  /// Sequence number of the next slot to be read by the consumer
+  alignas(RING_ALIGNMENT) std::atomic<quint64> tail;
+  std::atomic<quint32> consumer_waiting; //!< Set while the consumer sleeps on \c sem_full
+};
+
+constexpr char SPSC_MAGIC[] = "PCSP";
+constexpr quint16 SPSC_VERSION = 1;
+constexpr int SPSC_HEADER_SIZE = 3 * RING_ALIGNMENT;
+constexpr int SPSC_SPIN = 1000; //!< Number of times to poll a counter before going to sleep
+
+static_assert(sizeof(SpscHeader) == SPSC_HEADER_SIZE,
+              "SpscHeader must match HEADER_SIZE in spsc_ring.py");
+static_assert(ATOMIC_LLONG_LOCK_FREE == 2, "The lock-free mode requires lock-free 64 bit atomics");
+
+/// Returns \c true if \c header is a lock-free ring header of a supported version.
+inline bool spscIsValid(const SpscHeader *header)
+{
+  return std::memcmp(header->magic, SPSC_MAGIC, 4) == 0 && header->version == SPSC_VERSION;
+}
+
+/// Returns a pointer to the slot length table following the header.
+inline quint64 *spscLengths(SpscHeader *header)
+{
+  return reinterpret_cast<quint64*>(reinterpret_cast<char*>(header) + SPSC_HEADER_SIZE);
+}
+
+/// Returns the offset of slot \c index relative to the beginning of the segment.
+inline qint64 spscSlotOffset(const SpscHeader *header, quint64 index)
+{
+  return SPSC_HEADER_SIZE + ringAlign(qint64(header->slot_count) * qint64(sizeof(quint64))) +
+      qint64(index) * ringAlign(header->slot_size);
+}
+
+/**
+ * Stores a new value of the own counter (\c head or \c tail) and checks whether the other side
+ * sleeps.
+ * \param [out] counter Counter to update
+ * \param [in] value New value
+ * \param [in,out] waiting Flag of the other side, reset if set
+ * \return \c true if the other side has to be woken up by releasing its semaphore
+ */
+inline bool spscStore(std::atomic<quint64> &counter, quint64 value, std::atomic<quint32> &waiting)
+{
+  counter.store(value, std::memory_order_release);
+  // The counter must be visible before the flag is read (pairs with the fence in spscWait()):
+  std::atomic_thread_fence(std::memory_order_seq_cst);
+  if (waiting.load(std::memory_order_relaxed)) {
+    waiting.store(0, std::memory_order_relaxed);
+    return true;
+  }
+  return false;
+}
+
+/**
+ * Waits until \c ready() returns \c true: polls it \c SPSC_SPIN times and then sleeps on
+ * \c semaphore with \c waiting set (the other side releases it in \c spscStore()).
+ * \param [in,out] waiting Own flag (\c consumer_waiting or \c producer_waiting)
+ * \param [in] semaphore Semaphore released by the other side (e.g. \c CountingSemaphore)
+ * \param [in] ready Predicate, typically comparing the counters using acquire loads
+ * \return \c true if the condition is met, \c false if the semaphore cannot be acquired
+ */
+template <typename Semaphore, typename Ready>
+bool spscWait(std::atomic<quint32> &waiting, Semaphore &semaphore, Ready ready)
+{
+  for (int i = 0; i < SPSC_SPIN; ++i) {
+    if (ready()) {
+      return true;
+    }
+  }
+  while (true) {
+    waiting.store(1, std::memory_order_relaxed);
+    std::atomic_thread_fence(std::memory_order_seq_cst);
+    if (ready()) {
+      waiting.store(0, std::memory_order_relaxed);
+      return true;
+    }
+    if (!semaphore.acquire()) {
+      waiting.store(0, std::memory_order_relaxed);
+      return false;
+    }
+  }
+}
+
+#endif // SPSC_HEADER_H
@@ -52,12 +52,13 @@
 #include "dialog.h"
 
 #include <QFileDialog>
-#include <QBuffer>
 #include <QDebug>
 #include <QFile>
 #include <QTextStream>
 #include <QThread>
 
+#include <prodcon_ipc/raw_frame.h>
+
 #ifdef SHARED_STRUCT
 #include <cppystruct.h>
 #endif
@@ -67,7 +68,7 @@ ConsumerDialog::ConsumerDialog(QWidget *parent) : QDialog(parent),
    #ifdef SHARED_STRUCT
     shmem_config("shared_struct_test"),
    #endif
-    cipc(UNIQUE_SHARED_MEMORY_NAME, SHARED_MEMORY_KEY_FILE)
+    cipc(UNIQUE_SHARED_MEMORY_NAME, SHARED_MEMORY_KEY_FILE, true, RING_SLOTS, RING_LOCK_FREE)
   #else
     pipc(UNIQUE_SHARED_MEMORY_NAME, SHARED_MEMORY_KEY_FILE)
   #endif
@@ -157,15 +158,12 @@ void ConsumerDialog::loadFromFile() // producer logic (not active on default, se
   }
   ui.label->setPixmap(QPixmap::fromImage(image));
 
-  // Load into shared memory
-  QBuffer buffer;
-  buffer.open(QBuffer::ReadWrite);
-  QDataStream out(&buffer);
-  out << image;
-
+  // Copy the scanlines into shared memory (without encoding the image):
   try {
-    ScopedProducer sp(pipc, int(buffer.size()));
-    memcpy(sp.data(), buffer.data().data(), size_t(sp.size()));
+    ScopedProducer sp(pipc, frameSize(image));
+    if (!writeFrame(sp.data(), sp.size(), image, sequence++)) {
+      ui.label->setText(tr("Couldn't get enough memory!"));
+    }
   } catch (std::runtime_error &e) {
     ui.label->setText(e.what());
   }
@@ -175,8 +173,6 @@ void ConsumerDialog::loadFromFile() // producer logic (not active on default, se
 void ConsumerDialog::loadFromMemory() // consumer logic, active on default
 {
 #if CONSUMER == 1
-  QBuffer buffer;
-  QDataStream in(&buffer);
   QImage image;
 
   {
@@ -186,9 +182,8 @@ void ConsumerDialog::loadFromMemory() // consumer logic, active on default
       return;
     }
 
-    buffer.setData(sc.data(), sc.size());
-    buffer.open(QBuffer::ReadOnly);
-    in >> image;
+    // The image views the shared memory, so copy it before the transaction ends:
+    image = readFrame(sc.data(), sc.size()).copy();
   }
 
   if (image.isNull()) {
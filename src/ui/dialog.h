@@ -65,6 +65,12 @@
 // Hardcoded file name of file to be used for specifying an alternative name of the shared memory.
 // If that file exists, its first line is ALWAYS used as the shared memory's name:
 #define SHARED_MEMORY_KEY_FILE     "shared_memory.key"
+// Number of images the producer may put ahead of the consumer (ring buffer mode, see RingHeader),
+// 0 to store a single image only; must be equal in all apps (see RING_SLOTS in shared_memory.py):
+#define RING_SLOTS                 0
+// true to use the lock-free single-producer/single-consumer ring (see SpscHeader, requires
+// RING_SLOTS > 0 and the Python producer); must be equal in all apps (see RING_LOCK_FREE):
+#define RING_LOCK_FREE             false
 
 // Enable or disable sharing a format-specified struct between Python and C++, see
 //  - https://github.com/karkason/cppystruct
@@ -108,6 +114,7 @@ private:
   ConsumerIPC cipc;
 #else
   ProducerIPC pipc;
+  quint64 sequence = 0; //!< Number of images produced so far
 #endif
 };
 
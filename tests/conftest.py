@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import multiprocessing
+import os
+import sys
+
+import pytest
+
+# The modules import each other by their plain names (see prodcon_ipc/__init__.py):
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "prodcon_ipc"))
+
+# The System V backend needs no display (nor a QApplication), so the tests run headless:
+BACKEND = "sysv"
+TIMEOUT = 10.0  # seconds a test waits for the other process
+
+
+@pytest.fixture
+def key(request):
+    """
+    Returns a key unique to the test and this process, so concurrent or crashed runs don't share any resources.
+    """
+    return "pytest_" + str(os.getpid()) + "_" + request.node.name.replace("[", "_").replace("]", "")
+
+
+def _run(queue, target, args):
+    try:
+        queue.put((True, target(*args)))
+    except BaseException as e:
+        queue.put((False, repr(e)))
+
+
+class Peer(object):
+    """
+    Runs a function in a forked process and returns its result (or raises the exception it failed with). The function
+    gets an `Event` first, which it sets once it has created its side (e.g. the consumer must create the semaphores
+    before the producer in single item mode).
+    """
+    def __init__(self, target, *args):
+        context = multiprocessing.get_context("fork")
+        self._queue = context.Queue()
+        self.ready = context.Event()
+        self._process = context.Process(target=_run, args=(self._queue, target, (self.ready,) + args))
+        self._process.start()
+        if not self.ready.wait(TIMEOUT):
+            self.result()  # raises the exception the function has failed with
+            raise AssertionError("Peer did not get ready.")
+
+    def result(self, timeout=TIMEOUT):
+        try:
+            ok, value = self._queue.get(timeout=timeout)
+        finally:
+            self._process.join(timeout)
+            if self._process.is_alive():
+                self._process.terminate()
+        if not ok:
+            raise AssertionError("Peer failed: " + value)
+        return value
+
+
+@pytest.fixture
+def peer():
+    """
+    Returns `Peer` to run the other side of a round trip in a forked process.
+    """
+    return Peer
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import pytest
+
+numpy = pytest.importorskip("numpy")
+
+import array_view
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC, ScopedConsumer
+from producer_ipc import ProducerIPC, ScopedProducer
+
+ARRAYS = [
+    numpy.arange(24, dtype=numpy.uint8).reshape(2, 3, 4),
+    numpy.linspace(-1, 1, 15, dtype="<f4").reshape(5, 3),
+    numpy.arange(-5, 5, dtype=">i8"),  # non-native byte order
+    numpy.array([1 + 2j, -3j], dtype=numpy.complex128),
+    numpy.array([[True, False], [False, True]]),
+    numpy.array(7.5),  # 0 dimensions
+]
+
+
+def round_trip(producer, consumer, array, strides=None):
+    with ScopedProducer(producer, array_view.required_size(array.shape, array.dtype), TIMEOUT) as scope:
+        shared = scope.ndarray(array.shape, array.dtype, strides)
+        shared[...] = array
+    with ScopedConsumer(consumer, TIMEOUT) as scope:
+        result = scope.ndarray()
+        assert not result.flags.writeable
+        assert result.dtype == array.dtype and result.shape == array.shape
+        numpy.testing.assert_array_equal(result, array)
+        return result.strides
+
+
+@pytest.mark.parametrize("slots", [None, 2])
+def test_round_trip(key, slots):
+    consumer = ConsumerIPC(key, log=False, slots=slots, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=slots, slot_size=4096, backend=BACKEND)
+    for array in ARRAYS:
+        round_trip(producer, consumer, array)
+
+
+def test_strides(key):
+    consumer = ConsumerIPC(key, log=False, slots=2, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=2, slot_size=4096, backend=BACKEND)
+    array = numpy.arange(12, dtype=numpy.int16).reshape(3, 4)
+    assert round_trip(producer, consumer, array, strides=(2, 6)) == (2, 6)  # Fortran order
+
+
+def test_alignment():
+    buf = bytearray(array_view.required_size((3, 5), numpy.float64))
+    array = array_view.write(memoryview(buf), (3, 5), numpy.float64)
+    assert array_view.header_size(2) % array_view.ALIGNMENT == 0
+    assert array.nbytes == len(buf) - array_view.header_size(2)
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        array_view.read(memoryview(bytearray(128)))
+    with pytest.raises(ValueError):
+        array_view.read(memoryview(bytearray(4)))
+    with pytest.raises(ValueError):  # too small for the array
+        array_view.write(memoryview(bytearray(70)), (16,), numpy.uint8)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import asyncio
+import threading
+
+import pytest
+
+pytest.importorskip("PyQt5")
+
+from async_consumer import AsyncConsumerIPC
+from conftest import BACKEND, TIMEOUT
+from producer_ipc import ProducerIPC
+
+ITEMS = 50
+
+
+def produce(ready, key, slots, count):
+    producer = ProducerIPC(key, log=False, slots=slots, slot_size=64, backend=BACKEND)
+    ready.set()
+    for index in range(count):
+        item = b"item %d" % index
+        size, data = producer.begin(len(item), TIMEOUT)
+        memoryview(data)[:len(item)] = item
+        producer.end()
+    return producer.flush(TIMEOUT)  # the unslotted segment is gone once we exit
+
+
+async def collect(consumer, count):
+    items = []
+    async for item in consumer:
+        items.append(item.rstrip(b"\0"))  # the unslotted segment may be larger than the item
+        if len(items) == count:
+            break
+    return items
+
+
+@pytest.mark.parametrize("slots", [None, 4])
+def test_async_for(key, peer, slots):
+    consumer = AsyncConsumerIPC(key, log=False, slots=slots, backend=BACKEND)
+    try:
+        producer = peer(produce, key, slots, ITEMS)
+        items = asyncio.run(asyncio.wait_for(collect(consumer, ITEMS), TIMEOUT))
+        assert items == [b"item %d" % index for index in range(ITEMS)]
+        assert producer.result()
+    finally:
+        consumer.close()
+
+
+@pytest.mark.parametrize("slots", [None, 4])
+def test_close_cancels_wait(key, slots):
+    consumer = AsyncConsumerIPC(key, log=False, slots=slots, backend=BACKEND)
+    timer = threading.Timer(0.2, consumer.close)  # nothing is produced meanwhile
+    timer.start()
+    try:
+        assert asyncio.run(asyncio.wait_for(collect(consumer, 1), TIMEOUT)) == []
+    finally:
+        timer.join()
+
+
+def test_peer_timeout(key):
+    consumer = AsyncConsumerIPC(key, log=False, slots=4, peer_timeout=5, backend=BACKEND)
+    try:
+        assert consumer._peer_timeout == 5
+    finally:
+        consumer.close()
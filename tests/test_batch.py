@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import struct
+
+import pytest
+
+import batch
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from producer_ipc import ProducerIPC
+
+RECORD = struct.Struct("<Id")
+RECORDS = 100
+
+
+def consume(ready, key, slots, count):
+    consumer = ConsumerIPC(key, log=False, slots=slots, backend=BACKEND)
+    ready.set()
+    records = []
+    while len(records) < count:
+        received = consumer.get_many(7, TIMEOUT)  # fewer than a batch, the rest is returned by the next call
+        assert received
+        records.extend(RECORD.unpack(record) for record in received)
+    return records, consumer.get_many(5, 0.1)
+
+
+def test_pack_unpack():
+    records = [b"", b"a", b"record" * 100]
+    buf = bytearray(batch.packed_size(records))
+    batch.pack_into(memoryview(buf), records)
+    assert [bytes(record) for record in batch.unpack(buf)] == records
+
+
+@pytest.mark.parametrize("slots", [None, 4])
+def test_round_trip(key, peer, slots):
+    consumer = peer(consume, key, slots, RECORDS)
+    producer = ProducerIPC(key, log=False, slots=slots, slot_size=4096, backend=BACKEND)
+    for start in range(0, RECORDS, 10):
+        assert producer.put_many(RECORD.pack(index, index / 2.0) for index in range(start, start + 10)) == 10
+    assert consumer.result() == ([(index, index / 2.0) for index in range(RECORDS)], [])
+
+
+@pytest.mark.parametrize("slots", [1, 2])
+def test_oversized(key, slots):
+    consumer = ConsumerIPC(key, log=False, slots=slots, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=slots, slot_size=64, grow=False, backend=BACKEND)
+    producer.put_many([RECORD.pack(1, 0.5)])
+    assert [RECORD.unpack(record) for record in consumer.get_many(5, TIMEOUT)] == [(1, 0.5)]
+    with pytest.raises(RuntimeError):
+        producer.put_many(RECORD.pack(index, 0.0) for index in range(100))
+    assert consumer.get_many(5, 0.1) == []  # the slot was given back without publishing anything stale
+    producer.put_many([RECORD.pack(2, 1.5)])
+    assert [RECORD.unpack(record) for record in consumer.get_many(5, TIMEOUT)] == [(2, 1.5)]
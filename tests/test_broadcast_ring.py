@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import time
+
+import abstract_ipc
+import broadcast_ring
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from producer_ipc import ProducerIPC
+
+ITEMS = 1000
+END = b"end"
+
+
+def consume(ready, key, policy, delay):
+    consumer = ConsumerIPC(key, log=False, slots=4, broadcast=policy, backend=BACKEND)
+    try:
+        consumer.begin(0.1)  # registers at the current head, nothing has been published yet
+    except abstract_ipc.TimeoutExpired:
+        pass
+    ready.set()
+    items = []
+    while True:
+        data = bytes(memoryview(consumer.begin(TIMEOUT)))
+        consumer.end()
+        if data == END:
+            break
+        items.append(int(data))
+        time.sleep(delay)
+    dropped = consumer.dropped()
+    consumer.unregister()
+    return items, dropped
+
+
+def test_round_trip(key, peer):
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=16, max_consumers=4, backend=BACKEND)
+    producer.begin(1, TIMEOUT)  # creates the ring
+    producer.abort()
+    blocking = [peer(consume, key, broadcast_ring.BLOCK, 0) for _ in range(2)]
+    dropping = peer(consume, key, broadcast_ring.DROP, 0.001)
+    for index in range(ITEMS):
+        item = str(index).encode()
+        _, data = producer.begin(len(item), TIMEOUT)
+        memoryview(data)[:] = item
+        producer.end()
+    _, data = producer.begin(len(END), TIMEOUT)
+    memoryview(data)[:] = END
+    producer.end()
+    for consumer in blocking:
+        assert consumer.result() == (list(range(ITEMS)), 0)
+    items, dropped = dropping.result()
+    assert items == sorted(items) and len(set(items)) == len(items)
+    assert len(items) + dropped == ITEMS
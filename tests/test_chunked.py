@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import io
+
+import pytest
+
+import chunked
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from producer_ipc import ProducerIPC
+
+PAYLOAD = bytes(bytearray(range(256))) * 40  # spans many chunks of the small slots below
+
+
+def consume(ready, key, count):
+    consumer = ConsumerIPC(key, log=False, slots=4, backend=BACKEND)
+    ready.set()
+    payloads = []
+    for _ in range(count):
+        try:
+            payloads.append(bytes(consumer.get_large(TIMEOUT)))
+        except RuntimeError as e:
+            payloads.append(str(e))
+    return payloads
+
+
+def pieces(payload, size, fail=False):
+    for offset in range(0, len(payload), size):
+        yield payload[offset:offset + size]
+    if fail:
+        raise IOError("source failed")
+
+
+def test_pack_unpack():
+    buf = bytearray(chunked.HEADER_SIZE + 10)
+    buf[chunked.HEADER_SIZE:] = b"0123456789"
+    chunked.pack_header_into(buf, chunked.FIRST | chunked.LAST, 7, 10, 0, 10)
+    flags, stream, total_size, offset, data = chunked.unpack(buf)
+    assert (flags, stream, total_size, offset, bytes(data)) == (chunked.FIRST | chunked.LAST, 7, 10, 0, b"0123456789")
+    with pytest.raises(ValueError):
+        chunked.unpack(buf[:chunked.HEADER_SIZE - 1])
+    with pytest.raises(ValueError):
+        chunked.unpack(b"x" * len(buf))
+    with pytest.raises(ValueError):
+        chunked.unpack(buf[:-1])  # data truncated
+
+
+def test_round_trip(key, peer):
+    consumer = peer(consume, key, 4)
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=chunked.HEADER_SIZE + 100, grow=False,
+                           backend=BACKEND)
+    assert producer.put_stream(PAYLOAD, timeout=TIMEOUT) == len(PAYLOAD)
+    assert producer.put_stream(io.BytesIO(PAYLOAD), len(PAYLOAD), timeout=TIMEOUT) == len(PAYLOAD)
+    assert producer.put_stream(io.BytesIO(PAYLOAD), timeout=TIMEOUT) == len(PAYLOAD)  # size unknown
+    assert producer.put_stream(pieces(PAYLOAD, 333), timeout=TIMEOUT) == len(PAYLOAD)
+    assert consumer.result() == [PAYLOAD] * 4
+
+
+def test_abort(key, peer):
+    consumer = peer(consume, key, 3)
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=chunked.HEADER_SIZE + 100, grow=False,
+                           backend=BACKEND)
+    producer.put_stream(b"before", timeout=TIMEOUT)
+    with pytest.raises(IOError):
+        producer.put_stream(pieces(PAYLOAD, 100, True), timeout=TIMEOUT)
+    producer.put_stream(b"after", timeout=TIMEOUT)
+    before, aborted, after = consumer.result()
+    assert (before, after) == (b"before", b"after")
+    assert "aborted" in aborted
@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import threading
+import time
+
+import pytest
+
+import abstract_ipc
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from consumer_pipeline import ConsumerPipeline
+from producer_ipc import ProducerIPC
+
+ITEMS = 40
+
+
+def put(producer, item, timeout=TIMEOUT):
+    _, data = producer.begin(len(item), timeout)
+    memoryview(data)[:] = item
+    producer.end()
+
+
+def produce(ready, key, count):
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=16, backend=BACKEND)
+    ready.set()
+    for index in range(count):
+        put(producer, str(index).encode())
+    return producer.flush(TIMEOUT)
+
+
+def slow_decode(data):
+    index = int(bytes(data))
+    time.sleep(0.001 * (3 - index % 4))  # later items finish first
+    return index
+
+
+def double(index):
+    return 2 * index
+
+
+@pytest.mark.parametrize("copy", [True, False])
+def test_in_order(key, peer, copy):
+    consumer = ConsumerIPC(key, log=False, slots=4, backend=BACKEND)
+    producer = peer(produce, key, ITEMS)
+    with ConsumerPipeline(consumer, slow_decode, [double], workers=4, copy=copy, log=False) as pipeline:
+        results = [pipeline.get(TIMEOUT) for _ in range(ITEMS)]
+    assert results == [(index, 2 * index) for index in range(ITEMS)]
+    assert producer.result()
+
+
+def test_slot_released_after_decode(key):
+    consumer = ConsumerIPC(key, log=False, slots=1, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=1, slot_size=16, backend=BACKEND)
+    put(producer, b"item")
+    decoding, proceed = threading.Event(), threading.Event()
+
+    def decode(view):
+        decoding.set()
+        proceed.wait(TIMEOUT)
+        return view.tobytes()
+
+    pipeline = ConsumerPipeline(consumer, decode, copy=False, log=False)
+    pipeline.submit(TIMEOUT)
+    assert decoding.wait(TIMEOUT)
+    with pytest.raises(abstract_ipc.TimeoutExpired):
+        producer.begin(4, 0.1)  # the only slot is held while decode() reads it
+    proceed.set()
+    put(producer, b"next")  # released once decode() has returned
+    assert pipeline.get(TIMEOUT) == (0, b"item")
+    assert pipeline.get(TIMEOUT) == (1, b"next")
+    pipeline.close()
+
+
+def test_callback(key, peer):
+    consumer = ConsumerIPC(key, log=False, slots=4, backend=BACKEND)
+    producer = peer(produce, key, ITEMS)
+    results = []
+    done = threading.Event()
+
+    def fail_on_7(index):
+        if index == 7:
+            raise ValueError("item 7")
+        return index
+
+    def callback(sequence, result, error):
+        results.append((sequence, result, type(error)))
+        if len(results) == ITEMS:
+            done.set()
+
+    pipeline = ConsumerPipeline(consumer, slow_decode, [fail_on_7], workers=3, callback=callback, log=False)
+    with pytest.raises(RuntimeError):
+        pipeline.get()
+    for _ in range(ITEMS):
+        pipeline.submit(TIMEOUT)
+    assert done.wait(TIMEOUT)
+    pipeline.close()
+    assert results == [(index, None, ValueError) if index == 7 else (index, index, type(None))
+                       for index in range(ITEMS)]
+    assert producer.result()
+
+
+def test_close_with_pending_items(key):
+    consumer = ConsumerIPC(key, log=False, slots=4, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=16, backend=BACKEND)
+    processed = []
+
+    def decode(data):
+        time.sleep(0.05)
+        processed.append(bytes(data))
+        return data
+
+    pipeline = ConsumerPipeline(consumer, decode, workers=2, log=False)
+    for index in range(4):
+        put(producer, str(index).encode())
+        pipeline.submit(TIMEOUT)
+    assert pipeline.pending() == 4
+    pipeline.close()  # waits for the pending items
+    assert sorted(processed) == [b"0", b"1", b"2", b"3"]
+    assert producer.flush(0)  # all slots have been released
+
+
+def test_invalid(key):
+    consumer = ConsumerIPC(key, log=False, slots=4, backend=BACKEND)
+    with pytest.raises(ValueError):
+        ConsumerPipeline(consumer, copy=False, processes=True)
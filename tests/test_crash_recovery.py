@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import multiprocessing
+import os
+import signal
+import struct
+import time
+
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from producer_ipc import ProducerIPC
+
+
+def put(producer, index):
+    _, data = producer.begin(8, TIMEOUT)
+    struct.pack_into("<Q", data, 0, index)
+    producer.end()
+
+
+def consume(ready, key, count, stuck_at=None, stuck=None):
+    consumer = ConsumerIPC(key, log=False, slots=4, backend=BACKEND)
+    ready.set()
+    items = []
+    for _ in range(count):
+        index = struct.unpack_from("<Q", consumer.begin(TIMEOUT))[0]
+        if index == stuck_at:
+            stuck.set()
+            time.sleep(TIMEOUT * 10)  # gets killed while reading
+        items.append(index)
+        consumer.end()
+    return items
+
+
+def produce(key, start, count, done):
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=64, backend=BACKEND)
+    for index in range(start, start + count):
+        put(producer, index)
+    done.set()
+    time.sleep(TIMEOUT * 10)  # gets killed
+
+
+def kill(process):
+    os.kill(process.pid, signal.SIGKILL)
+    process.join()
+
+
+def test_consumer_dies_while_reading(key, peer):
+    context = multiprocessing.get_context("fork")
+    ready, stuck = context.Event(), context.Event()
+    first = context.Process(target=consume, args=(ready, key, 10, 2, stuck))
+    first.start()
+    assert ready.wait(TIMEOUT)
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=64, backend=BACKEND)
+    for index in range(6):
+        put(producer, index)
+    assert stuck.wait(TIMEOUT)
+    kill(first)
+    # The next consumer reads the item the dead one was reading again, and the producer gets its slot back:
+    second = peer(consume, key, 8)
+    for index in range(6, 10):
+        put(producer, index)
+    assert second.result() == list(range(2, 10))
+
+
+def test_producer_restarts(key, peer):
+    context = multiprocessing.get_context("fork")
+    consumer = peer(consume, key, 6)
+    done = context.Event()
+    first = context.Process(target=produce, args=(key, 0, 3, done))
+    first.start()
+    assert done.wait(TIMEOUT)
+    kill(first)
+    # A new producer takes over the ring (the consumer is still attached to it) and continues where it stopped:
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=64, backend=BACKEND)
+    for index in range(3, 6):
+        put(producer, index)
+    assert consumer.result() == list(range(6))
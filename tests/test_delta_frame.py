@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import pytest
+
+pytest.importorskip("numpy")
+QtGui = pytest.importorskip("PyQt5.QtGui")
+
+import delta_frame
+import frame_codec
+
+
+def image(width, height, marker):
+    """
+    Returns a gray image with a small white square at `marker` (x, y).
+    """
+    result = QtGui.QImage(width, height, QtGui.QImage.Format_RGB32)
+    result.fill(QtGui.QColor(128, 128, 128))
+    for y in range(marker[1], marker[1] + 4):
+        for x in range(marker[0], marker[0] + 4):
+            result.setPixel(x, y, 0xffffffff)
+    return result
+
+
+def encode(encoder, source):
+    buf = bytearray(encoder.update(source))
+    encoder.write(buf)
+    return buf
+
+
+def test_encode_decode():
+    encoder = delta_frame.DeltaEncoder(keyframe_interval=0)
+    decoder = delta_frame.DeltaDecoder()
+    images = [image(200, 100, (index * 10, index * 5)) for index in range(8)]
+    sizes = []
+    for number, source in enumerate(images):
+        buf = encode(encoder, source)
+        sizes.append(len(buf))
+        decoded, frame = decoder.read(buf)
+        assert frame == number
+        assert decoded == source
+    assert max(sizes[1:]) < sizes[0] / 4  # only the tiles around the old and the new square
+
+
+def test_keyframes():
+    encoder = delta_frame.DeltaEncoder(keyframe_interval=3)
+    decoder = delta_frame.DeltaDecoder()
+    frames = [encode(encoder, image(64, 64, (index, index))) for index in range(4)]
+    decoder.read(frames[0])
+    # Frame 1 was dropped, so frame 2 cannot be decoded until the keyframe (3):
+    with pytest.raises(frame_codec.MissingReference):
+        decoder.read(frames[2])
+    decoded, frame = decoder.read(frames[3])
+    assert (decoded, frame) == (image(64, 64, (3, 3)), 3)
+    # A new size (or a request) makes a keyframe:
+    decoded, _ = decoder.read(encode(encoder, image(32, 16, (0, 0))))
+    assert decoded == image(32, 16, (0, 0))
+    encoder.request_keyframe()
+    buf = encode(encoder, image(32, 16, (0, 0)))
+    assert len(buf) == delta_frame.HEADER_SIZE + 32 * 16 * 4
+
+
+def test_invalid():
+    encoder = delta_frame.DeltaEncoder()
+    size = encoder.update(image(16, 16, (0, 0)))
+    with pytest.raises(ValueError):
+        encoder.write(bytearray(size - 1))
+    with pytest.raises(ValueError):
+        delta_frame.DeltaDecoder().read(bytearray(size))
+    with pytest.raises(ValueError):
+        delta_frame.DeltaDecoder().read(b"short")
+    with pytest.raises(ValueError):
+        delta_frame.DeltaEncoder(tile_bytes=30)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import pytest
+
+import frame_codec
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from producer_ipc import ProducerIPC
+
+
+def frames(count, size=1000):
+    """
+    Returns mostly static frames, only a few bytes change per frame.
+    """
+    frame = bytearray(b"static background " * (size // 18 + 1))[:size]
+    result = []
+    for index in range(count):
+        frame[(index * 97) % size] = index % 256
+        result.append(bytes(frame))
+    return result
+
+
+def encode(encoder, payload):
+    return b"".join(bytes(piece) for piece in encoder.encode(payload))
+
+
+@pytest.mark.parametrize("codec", frame_codec.CODECS)
+def test_encode_decode(codec):
+    if codec not in frame_codec.available():
+        pytest.skip("The codec " + codec + " is not installed.")
+    encoder = frame_codec.Encoder(codec, keyframe_interval=4)
+    decoder = frame_codec.Decoder()
+    for payload in frames(10) + [b"", b"different size"]:
+        assert bytes(decoder.decode(encode(encoder, payload))) == payload
+
+
+def test_delta_missing_reference():
+    pytest.importorskip("numpy")
+    encoder = frame_codec.Encoder(frame_codec.DELTA, keyframe_interval=3)
+    decoder = frame_codec.Decoder()
+    encoded = [encode(encoder, payload) for payload in frames(7)]
+    assert len(encoded[1]) < len(encoded[0])  # only the changed blocks
+    decoder.decode(encoded[0])
+    # Frame 1 was dropped, so frame 2 cannot be decoded until the keyframe (3):
+    with pytest.raises(frame_codec.MissingReference):
+        decoder.decode(encoded[2])
+    assert bytes(decoder.decode(encoded[3])) == frames(4)[3]
+
+
+def test_invalid():
+    decoder = frame_codec.Decoder()
+    with pytest.raises(ValueError):
+        decoder.decode(b"not an encoded frame at all, but long enough for a header")
+    with pytest.raises(ValueError):
+        decoder.decode(encode(frame_codec.Encoder(), b"payload")[:-1])  # truncated
+    with pytest.raises(ValueError):
+        frame_codec.Encoder("unknown")
+
+
+def consume(ready, key, count):
+    consumer = ConsumerIPC(key, log=False, slots=4, encoded=True, backend=BACKEND)
+    ready.set()
+    return [bytes(consumer.get_frame(TIMEOUT)) for _ in range(count)]
+
+
+@pytest.mark.parametrize("codec_threads", [0, 2])
+def test_round_trip(key, peer, codec_threads):
+    payloads = frames(20, 5000)
+    consumer = peer(consume, key, len(payloads))
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=1000, codec=frame_codec.ZLIB,
+                           codec_threads=codec_threads, backend=BACKEND)
+    for payload in payloads:
+        producer.put_frame(payload, TIMEOUT)
+    producer.flush(TIMEOUT)
+    assert consumer.result() == payloads
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import logging
+
+import ipc_log
+from conftest import BACKEND
+from producer_ipc import ProducerIPC
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiting(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ipc_log.time, "time", clock)
+    events = []
+    diagnostics = ipc_log.Diagnostics("source", events.append, interval=10.0, burst=2)
+    emitted = [diagnostics.event("resync", logging.WARNING, "Resynchronized", permits=index) for index in range(5)]
+    assert emitted == [True, True, False, False, False]
+    assert diagnostics.event("peer_died", logging.WARNING, "Peer has died")  # limited per name
+    clock.now += 10.0
+    assert diagnostics.event("resync", logging.WARNING, "Resynchronized", permits=5)
+    assert [(event["name"], event.get("permits"), event.get("suppressed")) for event in events] == [
+        ("resync", 0, None), ("resync", 1, None), ("peer_died", None, None), ("resync", 5, 3)]
+    assert events[0] == dict(name="resync", level=logging.WARNING, message="Resynchronized", source="source",
+                             time=1000.0, permits=0)
+
+
+def test_logger(monkeypatch):
+    messages = []
+    monkeypatch.setattr(ipc_log.logzero.logger, "log", lambda level, message: messages.append((level, message)))
+    ipc_log.Diagnostics("key").event("recreate", logging.INFO, "Recreated", size=10, key="other")
+    assert messages == [(logging.INFO, "Recreated (key=other, size=10, source=key)")]
+
+
+def test_requested(monkeypatch):
+    for value, requested in (("", False), ("0", False), ("1", True), ("yes", True)):
+        monkeypatch.setenv(ipc_log.ENVIRONMENT_VARIABLE, value)
+        assert ipc_log.requested() == requested
+    monkeypatch.delenv(ipc_log.ENVIRONMENT_VARIABLE)
+    assert not ipc_log.requested()
+
+
+def test_hot_path(key, monkeypatch):
+    monkeypatch.delenv(ipc_log.ENVIRONMENT_VARIABLE, raising=False)
+    assert ProducerIPC(key, log=True, backend=BACKEND)._diagnostics is not None
+    producer = ProducerIPC(key, log=True, backend=BACKEND, hot_path=True)
+    assert producer._diagnostics is None
+    events = []
+    producer.enable_diagnostics(sink=events.append)
+    producer._diagnostics.event("test", logging.DEBUG, "Test")
+    assert [event["source"] for event in events] == [producer._shared_memory.key()]
+    producer.enable_diagnostics(False)
+    assert producer._diagnostics is None
+    monkeypatch.setenv(ipc_log.ENVIRONMENT_VARIABLE, "1")
+    assert ProducerIPC(key, log=True, backend=BACKEND, hot_path=True)._diagnostics is not None
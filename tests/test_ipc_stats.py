@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import pytest
+
+import ipc_stats
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from producer_ipc import ProducerIPC
+
+
+def bucket(value):
+    histogram = ipc_stats.Histogram()
+    histogram.add(value)
+    return histogram._buckets.index(1)
+
+
+def test_small_values_are_exact():
+    histogram = ipc_stats.Histogram()
+    for value in range(16):
+        histogram.add(value)
+        assert ipc_stats.Histogram._bucket_value(bucket(value)) == value
+    assert [histogram.percentile(percent) for percent in (1, 50, 100)] == [0, 7, 15]
+
+
+@pytest.mark.parametrize("value", [16, 17, 31, 32, 1000, 123456, 10 ** 9, 2 ** 62])
+def test_bucket_accuracy(value):
+    # 8 sub-buckets per power of two: a value is represented by the center of its bucket, 1/16 of its size away:
+    assert abs(ipc_stats.Histogram._bucket_value(bucket(value)) - value) <= value / 16.0 + 1
+
+
+def test_bucket_order():
+    indices = [bucket(value) for value in range(1, 1 << 14)]
+    assert indices == sorted(indices)
+    assert bucket(1 << 80) == ipc_stats._BUCKETS - 1  # clamped to the last bucket
+    assert bucket(-5) == 0  # e.g. caused by clock adjustments
+
+
+def test_summary():
+    histogram = ipc_stats.Histogram()
+    assert histogram.summary()["count"] == 0 and histogram.percentile(50) == 0
+    for value in (1000, 2000, 3000, 1000000):
+        histogram.add(value)
+    summary = histogram.summary()
+    assert summary["count"] == 4
+    assert summary["min"] == 1.0 and summary["max"] == 1000.0
+    assert summary["mean"] == pytest.approx(251.5)
+    assert summary["p50"] == pytest.approx(2.0, rel=0.07)
+    assert summary["p999"] == 1000.0
+
+
+def test_export(key):
+    stats = ipc_stats.Stats("producer", key, log=False, backend=BACKEND)
+    monitor = ipc_stats.StatsMonitor(key, backend=BACKEND)
+    assert monitor.poll() is None  # nothing exported yet
+    stats.begin(100)
+    stats.end()  # the first transaction is exported right away
+    snapshot = monitor.poll()
+    assert snapshot["role"] == "producer"
+    assert snapshot["transactions"] == 1 and snapshot["bytes"] == 100
+    assert snapshot["copy"]["count"] == 1
+    assert monitor.poll() is None  # not exported again yet
+    stats.begin(50)
+    stats.end()
+    stats.export()
+    snapshot = monitor.poll()
+    assert snapshot["transactions"] == 2 and snapshot["bytes"] == 150
+
+
+def test_transactions(key):
+    consumer = ConsumerIPC(key, log=False, slots=4, stats=True, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=64, stats=True, backend=BACKEND)
+    for _ in range(10):
+        producer.begin(64, TIMEOUT)
+        producer.end()
+        consumer.begin(TIMEOUT)
+        consumer.end()
+    produced, consumed = producer.stats(), consumer.stats()
+    assert produced["transactions"] == consumed["transactions"] == 10
+    assert produced["bytes"] == consumed["bytes"] == 640
+    assert produced["lock"]["count"] >= 10
+    assert consumed["latency"]["count"] == 10  # the producer stamps the items
+    for role in ("producer", "consumer"):
+        snapshot = ipc_stats.StatsMonitor(ipc_stats.stats_key(key, role), backend=BACKEND).poll()
+        assert snapshot["role"] == role and snapshot["transactions"] >= 1
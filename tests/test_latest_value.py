@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import threading
+import time
+
+import pytest
+
+from conftest import BACKEND, TIMEOUT
+from latest_value import LatestValueConsumer, LatestValueProducer
+
+VALUES = 200
+
+
+def read_all(ready, key, count):
+    consumer = LatestValueConsumer(key, log=False, backend=BACKEND)
+    ready.set()
+    values = []
+    sequence = 0
+    deadline = time.time() + TIMEOUT
+    while len(values) < count and time.time() < deadline:
+        data, sequence = consumer.read(sequence)
+        if data is not None:
+            values.append(int(data))
+            if int(data) == count - 1:
+                break
+    return values, sequence
+
+
+def test_round_trip(key, peer):
+    producer = LatestValueProducer(key, 16, log=False, backend=BACKEND)
+    consumer = peer(read_all, key, VALUES)
+    for index in range(VALUES):
+        assert producer.publish(str(index).encode()) == 2 * (index + 1)
+        time.sleep(0.0005)
+    values, sequence = consumer.result()
+    assert values == sorted(set(values)) and values[-1] == VALUES - 1  # maybe skips values, never goes back
+    assert sequence == 2 * VALUES
+
+
+def test_nothing_published(key):
+    consumer = LatestValueConsumer(key, log=False, backend=BACKEND)
+    assert consumer.read() == (None, 0)  # the producer has not created the segment yet
+    producer = LatestValueProducer(key, 16, log=False, backend=BACKEND)
+    assert (consumer.read(), consumer.sequence()) == ((None, 0), 0)
+    with pytest.raises(ValueError):
+        producer.publish(b"x" * 17)
+
+
+def test_torn_read(key):
+    producer = LatestValueProducer(key, 16, log=False, backend=BACKEND)
+    consumer = LatestValueConsumer(key, log=False, backend=BACKEND)
+    producer.publish(b"first")
+    view, sequence = consumer.view()
+    assert bytes(view) == b"first" and consumer.is_valid(sequence)
+    producer.publish(b"second")
+    assert not consumer.is_valid(sequence)  # the view may be torn, so read again
+    assert consumer.read(sequence) == (b"second", sequence + 2)
+    assert consumer.read(sequence + 2) == (None, sequence + 2)
+
+
+def test_read_retries_while_writing(key):
+    producer = LatestValueProducer(key, 16, log=False, backend=BACKEND)
+    consumer = LatestValueConsumer(key, log=False, backend=BACKEND)
+    producer.publish(b"old")
+    result = []
+    with producer.write(3) as buf:
+        buf[:1] = b"n"
+        reader = threading.Thread(target=lambda: result.append(consumer.read()))
+        reader.start()
+        reader.join(0.1)
+        assert reader.is_alive()  # waits for the write to complete
+        buf[1:] = b"ew"
+    reader.join(TIMEOUT)
+    assert result == [(b"new", 4)]
+
+
+def test_failed_write(key):
+    producer = LatestValueProducer(key, 16, log=False, backend=BACKEND)
+    consumer = LatestValueConsumer(key, log=False, backend=BACKEND)
+    producer.publish(b"complete")
+    with pytest.raises(ValueError):
+        with producer.write(8) as buf:
+            buf[:4] = b"torn"
+            raise ValueError("rendering failed")
+    assert consumer.read() == (None, 0)  # neither the torn value nor the overwritten one
+    assert consumer.view() == (None, 4)
+    assert producer.publish(b"next") == 6
+    assert consumer.read() == (b"next", 6)
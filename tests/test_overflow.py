@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import time
+
+import pytest
+
+import abstract_ipc
+import producer_ipc
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from producer_ipc import ProducerIPC
+
+
+def put(producer, index, timeout=None):
+    item = str(index).encode()
+    _, data = producer.begin(len(item), timeout)
+    memoryview(data)[:len(item)] = item
+    producer.end()
+
+
+def read_all(consumer, size=None):
+    items = []
+    while True:
+        try:
+            data = consumer.begin(0)
+        except abstract_ipc.TimeoutExpired:
+            return items
+        items.append(bytes(memoryview(data)[:size]))
+        consumer.end()
+
+
+def test_timeouts(key):
+    consumer = ConsumerIPC(key, log=False, slots=3, backend=BACKEND)
+    start = time.time()
+    with pytest.raises(abstract_ipc.TimeoutExpired):
+        consumer.begin(0.2)
+    assert time.time() - start >= 0.2
+    producer = ProducerIPC(key, log=False, slots=3, slot_size=16, backend=BACKEND)
+    for index in range(3):
+        put(producer, index)
+    with pytest.raises(abstract_ipc.TimeoutExpired):
+        put(producer, 3, 0.2)
+    assert read_all(consumer) == [b"0", b"1", b"2"]
+    put(producer, 3, TIMEOUT)
+    assert read_all(consumer) == [b"3"]
+
+
+def test_drop_newest(key):
+    consumer = ConsumerIPC(key, log=False, slots=2, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=2, slot_size=16, overflow=producer_ipc.DROP_NEWEST, backend=BACKEND)
+    for index in range(5):
+        put(producer, index)
+    assert (read_all(consumer), producer.dropped()) == ([b"0", b"1"], 3)
+
+
+def test_overwrite_oldest(key):
+    consumer = ConsumerIPC(key, log=False, slots=3, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=3, slot_size=16, overflow=producer_ipc.OVERWRITE_OLDEST,
+                           backend=BACKEND)
+    for index in range(7):
+        put(producer, index)
+    reading = bytes(memoryview(consumer.begin(0)))
+    with pytest.raises(abstract_ipc.TimeoutExpired):
+        put(producer, 7)  # the only item which could be overwritten is being read
+    consumer.end()
+    put(producer, 7)
+    assert ([reading] + read_all(consumer), producer.dropped()) == ([b"4", b"5", b"6", b"7"], 4)
+
+
+def test_overwrite_oldest_single_item(key):
+    consumer = ConsumerIPC(key, log=False, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, overflow=producer_ipc.OVERWRITE_OLDEST, backend=BACKEND)
+    for index in range(3):
+        put(producer, index)
+    assert (read_all(consumer, 1), producer.dropped()) == ([b"2"], 2)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import pytest
+
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from pipelined_producer import PipelinedProducer
+from producer_ipc import ProducerIPC
+
+ITEMS = 30
+
+
+def consume(ready, key, count):
+    consumer = ConsumerIPC(key, log=False, slots=4, backend=BACKEND)
+    ready.set()
+    items = []
+    for _ in range(count):
+        items.append(bytes(memoryview(consumer.begin(TIMEOUT))))
+        consumer.end()
+    return items
+
+
+def prepare(index):
+    return ("item %d" % index).encode() * (index % 3 + 1)
+
+
+def render(prepared, data, sequence):
+    data[:] = prepared
+    if prepared.startswith(b"fail"):
+        raise ValueError("render failed")
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_round_trip(key, peer, workers):
+    consumer = peer(consume, key, ITEMS)
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=64, backend=BACKEND)
+    with PipelinedProducer(producer, render, len, prepare, workers, TIMEOUT, False) as pipeline:
+        assert [pipeline.put(index) for index in range(ITEMS)] == list(range(ITEMS))
+    assert consumer.result() == [prepare(index) for index in range(ITEMS)]
+
+
+def test_failed_render(key):
+    consumer = ConsumerIPC(key, log=False, slots=2, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=2, slot_size=64, grow=False, backend=BACKEND)
+    pipeline = PipelinedProducer(producer, render, len, timeout=TIMEOUT, log=False)
+    for _ in range(3):  # the slots are given back unpublished
+        with pytest.raises(ValueError):
+            pipeline.put(b"fail")
+    with pytest.raises(RuntimeError):
+        pipeline.put(b"x" * 100)  # exceeds the slot size
+    pipeline.put(b"good")
+    assert bytes(memoryview(consumer.begin(TIMEOUT))) == b"good"
+    consumer.end()
+    pipeline.close()
+
+
+def test_codec(key):
+    with pytest.raises(ValueError):
+        PipelinedProducer(ProducerIPC(key, log=False, slots=2, slot_size=64, codec="zlib", backend=BACKEND), render,
+                          64)
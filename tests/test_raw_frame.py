@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import pytest
+
+QtGui = pytest.importorskip("PyQt5.QtGui")
+
+import raw_frame
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC, ScopedConsumer
+from producer_ipc import ProducerIPC, ScopedProducer
+
+QImage = QtGui.QImage
+
+
+def scanlines(image):
+    """
+    Returns the pixels of an image without the padding at the end of its scanlines.
+    """
+    bits = image.constBits()
+    bits.setsize(image.bytesPerLine() * image.height())
+    data = bytes(bits)
+    used = (image.width() * image.depth() + 7) // 8
+    return [data[y * image.bytesPerLine():y * image.bytesPerLine() + used] for y in range(image.height())]
+
+
+def pattern(width, height, bytes_per_line, format):
+    data = bytes(bytearray((index * 7 + 3) % 256 for index in range(bytes_per_line * height)))
+    return QImage(data, width, height, bytes_per_line, format), data  # the image does not own the data
+
+
+@pytest.mark.parametrize("width, bytes_per_line, format", [
+    (5, 16, QImage.Format_RGB888),  # 15 bytes padded to 32 bits
+    (5, 24, QImage.Format_RGB888),  # padded further than QImage would
+    (3, 8, QImage.Format_Grayscale8),
+    (4, 16, QImage.Format_ARGB32),  # no padding
+])
+@pytest.mark.parametrize("slots", [None, 2])
+def test_round_trip(key, slots, width, bytes_per_line, format):
+    consumer = ConsumerIPC(key, log=False, slots=slots, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=slots, slot_size=4096, backend=BACKEND)
+    image, data = pattern(width, 6, bytes_per_line, format)
+    with ScopedProducer(producer, raw_frame.frame_size(image), TIMEOUT) as scope:
+        raw_frame.write(scope.view(), image, sequence=42)
+    with ScopedConsumer(consumer, TIMEOUT) as scope:
+        result, sequence = raw_frame.read(scope.view())
+        assert sequence == 42
+        assert (result.width(), result.height(), result.format()) == (width, 6, format)
+        assert result.bytesPerLine() == bytes_per_line
+        assert scanlines(result) == scanlines(image)
+        assert result == image
+
+
+def test_render_in_place(key):
+    consumer = ConsumerIPC(key, log=False, slots=2, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=2, slot_size=4096, backend=BACKEND)
+    size = raw_frame.required_size(7, 5, QImage.Format_RGB888)
+    with ScopedProducer(producer, size, TIMEOUT) as scope:
+        image = raw_frame.image(scope.view(), 7, 5, QImage.Format_RGB888, sequence=3)
+        assert image.bytesPerLine() == 24  # 21 bytes padded to 32 bits
+        image.fill(QtGui.QColor(10, 20, 30))
+    with ScopedConsumer(consumer, TIMEOUT) as scope:
+        result, sequence = raw_frame.read(scope.view())
+        assert sequence == 3 and result.size() == image.size()
+        assert all(line == b"\x0a\x14\x1e" * 7 for line in scanlines(result))
+
+
+def test_invalid():
+    image, data = pattern(5, 6, 16, QImage.Format_RGB888)
+    with pytest.raises(ValueError):
+        raw_frame.write(memoryview(bytearray(raw_frame.frame_size(image) - 1)), image)
+    with pytest.raises(ValueError):
+        raw_frame.read(memoryview(bytearray(raw_frame.HEADER_SIZE + 100)))
+    buf = bytearray(raw_frame.frame_size(image))
+    raw_frame.write(memoryview(buf), image)
+    with pytest.raises(ValueError):  # truncated scanlines
+        raw_frame.read(memoryview(buf)[:-1])
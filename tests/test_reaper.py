@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import multiprocessing
+import os
+import signal
+import time
+
+import pytest
+
+import reaper
+import sysv_semaphore
+import sysv_shared_memory
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from producer_ipc import ProducerIPC
+
+pytestmark = pytest.mark.skipif(not sysv_shared_memory.is_supported(), reason="requires System V IPC on Linux")
+
+
+def put(producer, item):
+    _, data = producer.begin(len(item), TIMEOUT)
+    memoryview(data)[:] = item
+    producer.end()
+
+
+def key_files(key):
+    """
+    Returns the paths of the key files of the segment and semaphores of a ring buffer.
+    """
+    return set([sysv_semaphore.key_file_path(key, sysv_shared_memory.KEY_FILE_PREFIX),
+                sysv_semaphore.key_file_path(key)] +  # the lock of the segment
+               [sysv_semaphore.key_file_path(key + suffix) for suffix in ("_sem_full", "_sem_empty")])
+
+
+def run_pair(key, ready):
+    consumer = ConsumerIPC(key, log=False, slots=2, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=2, slot_size=16, backend=BACKEND)
+    put(producer, b"item")
+    consumer.begin(TIMEOUT)
+    ready.set()
+    time.sleep(TIMEOUT * 10)  # gets killed while reading
+
+
+def test_scan_and_clean(key):
+    # The dead pair's key starts with the one of the live pair, so its semaphores must not be kept for the live segment:
+    dead_key = key + "_dead"
+    consumer = ConsumerIPC(key, log=False, slots=2, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=2, slot_size=16, backend=BACKEND)
+    put(producer, b"first")  # creates the segment
+    assert bytes(consumer.begin(TIMEOUT)) == b"first"
+    consumer.end()
+    context = multiprocessing.get_context("fork")
+    ready = context.Event()
+    process = context.Process(target=run_pair, args=(dead_key, ready))
+    process.start()
+    assert ready.wait(TIMEOUT)
+    os.kill(process.pid, signal.SIGKILL)
+    process.join()
+
+    live, dead = key_files(key), key_files(dead_key)
+    entries = [entry for entry in reaper.scan() if entry["file"] in live | dead]
+    assert set(entry["file"] for entry in entries) == live | dead
+    assert set(entry["file"] for entry in entries if entry["stale"]) == dead
+    segment = [entry for entry in entries if entry["kind"] == reaper.SHARED_MEMORY and entry["file"] in dead][0]
+    assert segment["reason"] == "no process attached"
+    assert not segment["ring"]["producer"]["alive"] and not segment["ring"]["consumer"]["alive"]
+
+    assert set(entry["file"] for entry in reaper.clean(entries)) == dead
+    assert not any(os.path.exists(path) for path in dead)
+    assert not [entry for entry in reaper.scan() if entry["file"] in dead]
+
+    # The live pair is left alone:
+    put(producer, b"live")
+    assert bytes(consumer.begin(TIMEOUT)) == b"live"
+    consumer.end()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import time
+
+import pytest
+
+import abstract_ipc
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from producer_ipc import ProducerIPC
+
+ITEMS = 50
+
+
+def payload(index):
+    return ("item %d " % index).encode() * (index % 7 + 1)
+
+
+def consume(ready, key, slots, count):
+    consumer = ConsumerIPC(key, log=False, slots=slots, backend=BACKEND)
+    ready.set()
+    items = []
+    for _ in range(count):
+        data = consumer.begin(TIMEOUT)
+        items.append(bytes(memoryview(data)))
+        consumer.end()
+    return items
+
+
+def produce(producer, count):
+    for index in range(count):
+        item = payload(index)
+        _, data = producer.begin(len(item), TIMEOUT)
+        memoryview(data)[:] = item
+        producer.end()
+
+
+@pytest.mark.parametrize("slots", [2, 4, 16])
+def test_round_trip(key, peer, slots):
+    consumer = peer(consume, key, slots, ITEMS)
+    producer = ProducerIPC(key, log=False, slots=slots, slot_size=128, backend=BACKEND)
+    produce(producer, ITEMS)
+    assert consumer.result() == [payload(index) for index in range(ITEMS)]
+
+
+def test_single_item_round_trip(key, peer):
+    consumer = peer(consume, key, None, ITEMS)
+    producer = ProducerIPC(key, log=False, backend=BACKEND)
+    produce(producer, ITEMS)
+    assert consumer.result() == [payload(index) for index in range(ITEMS)]
+
+
+def test_grow(key, peer):
+    consumer = peer(consume, key, 4, 3)
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=16, backend=BACKEND)
+    items = [b"small", b"large" * 100, b"small again"]
+    for item in items:
+        _, data = producer.begin(len(item), TIMEOUT)
+        memoryview(data)[:] = item
+        producer.end()
+    assert consumer.result() == items
+
+
+def test_grow_timeout(key):
+    consumer = ConsumerIPC(key, log=False, slots=4, backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=16, backend=BACKEND)
+    for item in (b"unread 1", b"unread 2"):
+        _, data = producer.begin(len(item), TIMEOUT)
+        memoryview(data)[:] = item
+        producer.end()
+    # Growing needs all slots, so it times out while the consumer holds the unread items:
+    with pytest.raises(abstract_ipc.TimeoutExpired):
+        producer.begin(1000, 0.2)
+    for item in (b"unread 1", b"unread 2"):
+        assert bytes(memoryview(consumer.begin(TIMEOUT))) == item
+        consumer.end()
+    _, data = producer.begin(1000, TIMEOUT)
+    memoryview(data)[:] = b"x" * 1000
+    producer.end()
+    assert bytes(memoryview(consumer.begin(TIMEOUT))) == b"x" * 1000
+    consumer.end()
+    # No permit got lost or duplicated while growing:
+    for _ in range(4):
+        producer.begin(8, TIMEOUT)
+        producer.end()
+    with pytest.raises(abstract_ipc.TimeoutExpired):
+        producer.begin(8, 0.2)
+
+
+@pytest.mark.parametrize("options", [{}, dict(slots=4, slot_size=16), dict(slots=4, slot_size=16, lock_free=True)],
+                         ids=["single", "ring", "lock_free"])
+def test_abort(key, options):
+    consumer = ConsumerIPC(key, log=False, backend=BACKEND,
+                           **dict((name, value) for name, value in options.items() if name != "slot_size"))
+    producer = ProducerIPC(key, log=False, backend=BACKEND, **options)
+    for index in range(10):
+        for _ in range(3):  # aborted items are neither published nor do they leak a slot
+            _, data = producer.begin(8, TIMEOUT)
+            memoryview(data)[:] = b"aborted!"
+            producer.abort()
+        item = ("item %03d" % index).encode()
+        _, data = producer.begin(len(item), TIMEOUT)
+        memoryview(data)[:] = item
+        producer.end()
+        assert bytes(memoryview(consumer.begin(TIMEOUT))[:len(item)]) == item
+        consumer.end()
+    with pytest.raises(RuntimeError):
+        producer.abort()  # without begin()
+
+
+def test_flush(key, peer):
+    consumer = peer(consume, key, 4, ITEMS)
+    producer = ProducerIPC(key, log=False, slots=4, slot_size=128, backend=BACKEND)
+    produce(producer, ITEMS)
+    consumer.result()  # the consumer has exited, destroying the semaphores it has created
+    start = time.time()
+    assert producer.flush(TIMEOUT)
+    assert time.time() - start < TIMEOUT / 2
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import os
+
+import pytest
+
+import segment_memory
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from producer_ipc import ProducerIPC
+
+SLOT_SIZE = 1 << 20
+
+
+def thp_supported():
+    try:
+        with open("/sys/kernel/mm/transparent_hugepage/shmem_enabled") as fp:
+            enabled = fp.read()
+    except (IOError, OSError):
+        return False
+    return "[advise]" in enabled or "[always]" in enabled or "[within_size]" in enabled
+
+
+def hugetlb_free():
+    try:
+        with open("/proc/meminfo") as fp:
+            for line in fp:
+                if line.startswith("HugePages_Free:"):
+                    return int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+def round_trip(key, **placement):
+    consumer = ConsumerIPC(key, log=False, slots=2, prefault=placement.get("prefault", False), backend=BACKEND)
+    producer = ProducerIPC(key, log=False, slots=2, slot_size=SLOT_SIZE, backend=BACKEND, **placement)
+    item = os.urandom(SLOT_SIZE)
+    _, data = producer.begin(len(item), TIMEOUT)
+    memoryview(data)[:] = item
+    producer.end()
+    assert bytes(memoryview(consumer.begin(TIMEOUT))) == item
+    consumer.end()
+    return producer
+
+
+def test_prefault(key):
+    round_trip(key, prefault=True)
+
+
+@pytest.mark.skipif(not thp_supported(), reason="transparent huge pages for shared memory are disabled")
+def test_transparent_huge_pages(key):
+    round_trip(key, huge_pages=segment_memory.THP, prefault=True)
+
+
+@pytest.mark.skipif(hugetlb_free() < 2, reason="no huge pages reserved (vm.nr_hugepages)")
+def test_hugetlb(key):
+    producer = round_trip(key, huge_pages=segment_memory.HUGETLB)
+    assert producer._shared_memory.size() % segment_memory.huge_page_size() == 0
+
+
+@pytest.mark.skipif(not os.path.isdir("/sys/devices/system/node/node0"), reason="no NUMA support")
+def test_numa_node(key):
+    round_trip(key, numa_node=0, prefault=True)
+
+
+def test_invalid_options(key):
+    with pytest.raises(ValueError):
+        ProducerIPC(key, log=False, slots=2, huge_pages="always", backend=BACKEND)
+    pytest.importorskip("PyQt5")
+    with pytest.raises(ValueError):  # QSharedMemory cannot pass SHM_HUGETLB
+        ProducerIPC(key, log=False, slots=2, huge_pages=segment_memory.HUGETLB, backend="qt")
+
+
+@pytest.mark.skipif(not os.path.isdir("/sys/devices/system/node"), reason="no NUMA support")
+def test_missing_numa_node(key):
+    producer = ProducerIPC(key, log=False, slots=2, slot_size=4096, numa_node=1000, backend=BACKEND)
+    with pytest.raises(RuntimeError):
+        producer.begin(16, TIMEOUT)
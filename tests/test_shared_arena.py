@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import multiprocessing
+import os
+import signal
+import time
+
+import pytest
+
+import abstract_ipc
+from conftest import BACKEND, TIMEOUT
+from shared_arena import SharedArena, segment_size
+
+PRODUCERS = 4
+ITEMS = 300
+
+
+def produce(ready, key, name, count):
+    channel = SharedArena(key, log=False, backend=BACKEND).create_channel(name, 2, 64)
+    ready.set()
+    for index in range(count):
+        channel.put(("%s:%d" % (name, index)).encode(), TIMEOUT)
+    return count
+
+
+def test_channels(key, peer):
+    arena = SharedArena(key, size=segment_size([(2, 64)] * PRODUCERS), log=False, backend=BACKEND)
+    producers = [peer(produce, key, "channel %d" % index, ITEMS) for index in range(PRODUCERS)]
+    items = dict(("channel %d" % index, []) for index in range(PRODUCERS))
+    while sum(len(received) for received in items.values()) < PRODUCERS * ITEMS:
+        ready = arena.wait(TIMEOUT)
+        assert ready
+        for channel in ready:
+            data = channel.get()
+            if data is not None:
+                name, index = data.decode().split(":")
+                assert name == channel.name
+                items[name].append(int(index))
+    assert all(received == list(range(ITEMS)) for received in items.values())  # in order per channel
+    assert [producer.result() for producer in producers] == [ITEMS] * PRODUCERS
+    assert [channel.name for channel in arena.channels()] == ["channel %d" % index for index in range(PRODUCERS)]
+
+
+def test_timeouts(key):
+    arena = SharedArena(key, size=segment_size([(2, 64)]), log=False, backend=BACKEND)
+    start = time.time()
+    assert arena.wait(0.2) == []
+    assert time.time() - start >= 0.2
+    channel = SharedArena(key, log=False, backend=BACKEND).create_channel("channel", 2, 64)
+    channel.put(b"1")
+    channel.put(b"2")
+    with pytest.raises(abstract_ipc.TimeoutExpired):
+        channel.put(b"3", 0.2)
+    with pytest.raises(ValueError):
+        channel.put(b"x" * 65)
+    assert [ready.name for ready in arena.wait(0)] == ["channel"]
+    assert [arena.channel("channel").get() for _ in range(3)] == [b"1", b"2", None]
+
+
+def test_abort(key, monkeypatch):
+    arena = SharedArena(key, size=segment_size([(2, 64)]), log=False, backend=BACKEND)
+    channel = SharedArena(key, log=False, backend=BACKEND).create_channel("channel", 2, 64)
+    begin = channel.begin
+    monkeypatch.setattr(channel, "begin", lambda size, timeout=None: begin(size, timeout)[:-1])
+    with pytest.raises(ValueError):
+        channel.put(b"half")  # copying into the slot fails
+    monkeypatch.undo()
+    buf = channel.begin(4)
+    buf[:] = b"junk"
+    channel.abort()
+    assert arena.wait(0.1) == []  # nothing was published
+    channel.put(b"good")
+    assert arena.channel("channel").get() == b"good"
+
+
+def hang(key, ready):
+    channel = SharedArena(key, log=False, backend=BACKEND).create_channel("channel", 4, 64)
+    channel.put(b"before")
+    ready.set()
+    time.sleep(TIMEOUT * 10)  # gets killed
+
+
+def test_takeover(key):
+    arena = SharedArena(key, size=segment_size([(4, 64)]), log=False, backend=BACKEND)
+    context = multiprocessing.get_context("fork")
+    ready = context.Event()
+    process = context.Process(target=hang, args=(key, ready))
+    process.start()
+    assert ready.wait(TIMEOUT)
+    with pytest.raises(RuntimeError):
+        SharedArena(key, log=False, backend=BACKEND).create_channel("channel", 4, 64)  # its producer is running
+    os.kill(process.pid, signal.SIGKILL)
+    process.join()
+    with pytest.raises(RuntimeError):
+        SharedArena(key, log=False, backend=BACKEND).create_channel("channel", 2, 64)  # another geometry
+    # A new producer takes the channel over, keeping the unread item:
+    channel = SharedArena(key, log=False, backend=BACKEND).create_channel("channel", 4, 64)
+    channel.put(b"after")
+    consumer = arena.channel("channel")
+    assert [consumer.get(), consumer.get(), consumer.get()] == [b"before", b"after", None]
+    assert len(arena.channels()) == 1
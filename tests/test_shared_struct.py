@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import ctypes
+
+import pytest
+
+import shared_struct
+from conftest import BACKEND
+
+NAMES = ("flag", "count", "ratio", "done")
+
+
+def test_native_offsets():
+    class Native(ctypes.Structure):
+        _fields_ = [("flag", ctypes.c_byte), ("count", ctypes.c_int), ("ratio", ctypes.c_double),
+                    ("done", ctypes.c_bool)]
+
+    fields = shared_struct.parse("@bid?", NAMES)
+    assert list(fields) == list(NAMES)
+    assert [field.offset for field in fields.values()] == [getattr(Native, name).offset for name in NAMES]
+
+
+def test_packed_offsets():
+    fields = shared_struct.parse("<bid?", NAMES)
+    assert [field.offset for field in fields.values()] == [0, 1, 5, 13]
+    fields = shared_struct.parse("<2xh3sq", ("short", "name", "long"))
+    assert [(field.offset, field.size) for field in fields.values()] == [(2, 2), (4, 3), (7, 8)]
+
+
+def test_invalid_format():
+    with pytest.raises(ValueError):
+        shared_struct.parse("<bi", ("flag",))
+    with pytest.raises(ValueError):
+        shared_struct.parse("<b", ("flag", "count"))
+    with pytest.raises(ValueError):
+        shared_struct.parse("<bk", ("flag", "count"))
+
+
+@pytest.mark.parametrize("format", ["@bhiq", "<bhiq", ">bhiq"])  # atomic and locked (unaligned or swapped) updates
+def test_increment_wraps_around(key, format):
+    values = shared_struct.SharedStruct(key, format, ("b", "h", "i", "q"), create=True, log=False, backend=BACKEND)
+    for name, bits in (("b", 8), ("h", 16), ("i", 32), ("q", 64)):
+        values[name] = 2 ** (bits - 1) - 1
+        assert values.increment(name) == -2 ** (bits - 1)
+        assert values[name] == -2 ** (bits - 1)
+        assert values.increment(name, -1) == 2 ** (bits - 1) - 1
+        assert values.increment(name, -2 ** bits - 3) == 2 ** (bits - 1) - 4
+        assert values[name] == 2 ** (bits - 1) - 4
+
+
+def test_increment_rejects_non_integers(key):
+    values = shared_struct.SharedStruct(key, "@bid?", NAMES, create=True, log=False, backend=BACKEND)
+    with pytest.raises(ValueError):
+        values.increment("ratio")
+
+
+def test_attach_existing(key):
+    created = shared_struct.SharedStruct(key, "<I?8s", ("counter", "stop", "name"), create=True, log=False,
+                                         backend=BACKEND)
+    created.write(counter=41, stop=True, name=b"producer")
+    attached = shared_struct.SharedStruct(key, "<I?8s", ("counter", "stop", "name"), log=False, backend=BACKEND)
+    assert attached.read() == {"counter": 41, "stop": True, "name": b"producer"}
+    attached.increment("counter")
+    assert created["counter"] == 42
+    # Creating it again attaches to the existing segment without resetting it:
+    again = shared_struct.SharedStruct(key, "<I?8s", ("counter", "stop", "name"), create=True, log=False,
+                                       backend=BACKEND)
+    assert again["counter"] == 42
+    with pytest.raises(RuntimeError):
+        shared_struct.SharedStruct(key, "<I?8sQ", ("counter", "stop", "name", "more"), log=False, backend=BACKEND)
+
+
+def test_attach_missing(key):
+    with pytest.raises(RuntimeError):
+        shared_struct.SharedStruct(key, "<I", ("counter",), log=False, backend=BACKEND)
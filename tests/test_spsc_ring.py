@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (C) 2020 Adrian Böckenkamp
+# This code is licensed under the BSD 3-Clause license (see LICENSE for details).
+
+import time
+
+import pytest
+
+from conftest import BACKEND, TIMEOUT
+from consumer_ipc import ConsumerIPC
+from producer_ipc import ProducerIPC
+
+ITEMS = 2000
+
+
+def consume(ready, key, slots, count):
+    consumer = ConsumerIPC(key, log=False, slots=slots, lock_free=True, backend=BACKEND)
+    ready.set()
+    items = []
+    for index in range(count):
+        data = consumer.begin(TIMEOUT)
+        items.append(int(bytes(memoryview(data))))
+        consumer.end()
+        if index % 500 == 0:
+            time.sleep(0.01)  # lets the producer fill the ring and wait for a free slot
+    return items
+
+
+@pytest.mark.parametrize("slots", [2, 8])
+def test_round_trip(key, peer, slots):
+    consumer = peer(consume, key, slots, ITEMS)
+    producer = ProducerIPC(key, log=False, slots=slots, slot_size=16, lock_free=True, backend=BACKEND)
+    for index in range(ITEMS):
+        item = str(index).encode()
+        _, data = producer.begin(len(item), TIMEOUT)
+        memoryview(data)[:] = item
+        producer.end()
+        if index % 700 == 0:
+            time.sleep(0.01)  # lets the consumer wait for an item
+    assert consumer.result() == list(range(ITEMS))